@@ -243,6 +243,10 @@ function connectWS() {
             if (payload.type === 'alert') {
                 renderAlert(payload.data);
             }
+            // 1b. Resumen de alertas recientes (frame inicial al conectar)
+            else if (payload.type === 'alert_summary') {
+                (payload.data.ultimas_criticas || []).slice().reverse().forEach(renderAlert);
+            }
             // 2. Manejar Telemetría (JSON completo)
             else if (payload.temperatura_celsius !== undefined) {
                 processTelemetry(payload);
@@ -383,7 +387,7 @@ function renderAlert(alertData) {
     item.className = `alert-item ${typeClass}`;
     item.innerHTML = `
         <div style="font-weight:bold;"><i class="fas ${icon}"></i> ${alertData.message}</div>
-        <small>${new Date().toLocaleTimeString()} - Prioridad: ${alertData.priority}</small>
+        <small>${new Date(alertData.timestamp ? alertData.timestamp * 1000 : Date.now()).toLocaleTimeString()} - Prioridad: ${alertData.priority}</small>
     `;
 
     list.insertBefore(item, list.firstChild);
@@ -0,0 +1,325 @@
+# fog-layer/api_async.py
+"""
+API REST asíncrona (ASGI) del fog layer de TRANSWATCH.
+
+Reemplaza al servidor de desarrollo de Flask de api.py para el dashboard:
+  - un único TimeSeriesManager compartido (el cliente Flight de InfluxDB se
+    reutiliza entre peticiones) y las consultas bloqueantes en un pool de hilos;
+  - peticiones idénticas concurrentes se agrupan en una sola consulta;
+  - respuestas comprimidas con brotli (si está instalado) o gzip;
+  - rangos grandes se transmiten por chunks a medida que llegan de InfluxDB;
+  - exportación masiva en Parquet, Arrow IPC o CSV (services/exportador.py).
+
+Ejecutar:
+  uvicorn api_async:app --host 0.0.0.0 --port 5000
+  python api_async.py
+"""
+
+import os
+import json
+import zlib
+import contextlib
+from datetime import datetime, timezone
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from services.alert_store import AlertStore
+from services.coalescer import CoalescedorConsultas
+from services.exportador import FORMATOS, exportar_lotes
+from services.log_config import configurar_logging, obtener_logger
+from services.metrics import LATENCIA_ETAPA
+from services.tsdb_manager import TimeSeriesManager
+
+# brotli es opcional: sin él se usa gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = obtener_logger("transwatch.api")
+
+API_HOST = os.getenv('API_HOST', '0.0.0.0')
+API_PORT = int(os.getenv('API_PORT', '5000'))
+# Hilos para las consultas bloqueantes a InfluxDB
+API_HILOS_CONSULTA = int(os.getenv('API_HILOS_CONSULTA', '8'))
+# Rangos de más horas que esto se transmiten por chunks en lugar de materializarse
+API_STREAM_HORAS = float(os.getenv('API_STREAM_HORAS', '6'))
+# Respuestas menores a esto (bytes) no se comprimen
+API_COMPRESION_MIN = int(os.getenv('API_COMPRESION_MIN', '500'))
+# Formatos que ya van comprimidos (Parquet usa zstd por columna)
+TIPOS_SIN_COMPRESION = ('application/vnd.apache.parquet',)
+
+# Instancias compartidas por todas las peticiones del proceso
+tsdb = TimeSeriesManager()
+alert_store = AlertStore(tsdb)
+coalescedor = CoalescedorConsultas(API_HILOS_CONSULTA)
+
+
+class ErrorParametro(ValueError):
+    """Parámetro de consulta ausente o inválido (respuesta 400)."""
+
+
+def _parsear_fecha(texto, nombre):
+    if not texto:
+        raise ErrorParametro(f"Falta el parámetro '{nombre}'")
+    try:
+        fecha = datetime.fromisoformat(texto.replace('Z', '+00:00'))
+    except ValueError:
+        raise ErrorParametro(f"Fecha inválida en '{nombre}': {texto!r}")
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return fecha.astimezone(timezone.utc)
+
+
+def _rango(request):
+    inicio = _parsear_fecha(request.query_params.get('inicio'), 'inicio')
+    fin = _parsear_fecha(request.query_params.get('fin'), 'fin')
+    if fin < inicio:
+        raise ErrorParametro("'fin' debe ser posterior a 'inicio'")
+    return inicio, fin
+
+
+def _iso(fecha):
+    return fecha.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# --- Compresión ---
+class _Compresor:
+    def __init__(self, codificacion):
+        self.codificacion = codificacion
+        if codificacion == 'br':
+            self._c = brotli.Compressor(quality=4)
+        else:
+            self._c = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> formato gzip
+
+    def comprimir(self, datos, final):
+        if self.codificacion == 'br':
+            salida = self._c.process(datos)
+            return salida + (self._c.finish() if final else self._c.flush())
+        salida = self._c.compress(datos)
+        # Z_SYNC_FLUSH entre chunks para que el cliente pueda ir descomprimiendo
+        return salida + self._c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompresionMiddleware:
+    """Comprime respuestas (incluidas las transmitidas por chunks) con br o gzip según Accept-Encoding"""
+
+    def __init__(self, app, minimo=API_COMPRESION_MIN):
+        self.app = app
+        self.minimo = minimo
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        aceptadas = Headers(scope=scope).get('accept-encoding', '')
+        if brotli is not None and 'br' in aceptadas:
+            codificacion = 'br'
+        elif 'gzip' in aceptadas:
+            codificacion = 'gzip'
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        estado = {'inicio': None, 'compresor': None, 'sin_comprimir': False}
+
+        async def enviar(mensaje):
+            if mensaje['type'] == 'http.response.start':
+                # Se retiene hasta ver el primer chunk del cuerpo
+                estado['inicio'] = mensaje
+                return
+            if mensaje['type'] != 'http.response.body':
+                await send(mensaje)
+                return
+
+            cuerpo = mensaje.get('body', b'')
+            hay_mas = mensaje.get('more_body', False)
+
+            inicio = estado['inicio']
+            if inicio is not None:
+                estado['inicio'] = None
+                headers = MutableHeaders(raw=inicio['headers'])
+                if ('content-encoding' in headers
+                        or headers.get('content-type', '').startswith(TIPOS_SIN_COMPRESION)
+                        or (not hay_mas and len(cuerpo) < self.minimo)):
+                    estado['sin_comprimir'] = True
+                else:
+                    estado['compresor'] = _Compresor(codificacion)
+                    if 'content-length' in headers:
+                        del headers['content-length']
+                    headers['content-encoding'] = codificacion
+                    headers.add_vary_header('Accept-Encoding')
+                await send(inicio)
+
+            if estado['sin_comprimir']:
+                await send(mensaje)
+                return
+            await send({
+                'type': 'http.response.body',
+                'body': estado['compresor'].comprimir(cuerpo, final=not hay_mas),
+                'more_body': hay_mas
+            })
+
+        await self.app(scope, receive, enviar)
+
+
+# --- Endpoints ---
+async def obtener_estadisticas(request):
+    with LATENCIA_ETAPA.medir('api_estadisticas'):
+        datos = await coalescedor.ejecutar(('estadisticas',), tsdb.obtener_estadisticas_dashboard)
+    return JSONResponse(datos)
+
+
+def _historico_json(primer_lote, lotes):
+    """
+    Genera el arreglo JSON por chunks (un RecordBatch de Arrow a la vez). Los
+    encabezados ya salieron con 200: si la consulta falla a mitad se registra
+    y el arreglo se cierra igual, para que el cliente reciba JSON válido.
+    """
+    yield b'['
+    primero = True
+    try:
+        lote = primer_lote
+        while lote is not None:
+            filas = lote.to_pylist()
+            for fila in filas:
+                fila['time'] = str(fila['time'])
+            chunk = json.dumps(filas)[1:-1]
+            if chunk:
+                yield (chunk if primero else ',' + chunk).encode('utf-8')
+                primero = False
+            lote = next(lotes, None)
+    except Exception as e:
+        log.exception("Histórico por streaming interrumpido; respuesta truncada: %s", e)
+    yield b']'
+
+
+async def obtener_historico(request):
+    """Lecturas (time, temp_celsius, humedad_porcentaje) entre ?inicio= y ?fin= (ISO 8601)"""
+    try:
+        inicio, fin = _rango(request)
+    except ErrorParametro as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    if (fin - inicio).total_seconds() > API_STREAM_HORAS * 3600:
+        log.info("Histórico por streaming: %s a %s", _iso(inicio), _iso(fin))
+        lotes = tsdb.iterar_rango_fechas(_iso(inicio), _iso(fin))
+        try:
+            # El primer lote se pide antes de enviar encabezados: un fallo temprano aún puede ser 503
+            primer_lote = await run_in_threadpool(next, lotes, None)
+        except Exception as e:
+            log.exception("Error consultando el histórico: %s", e)
+            return JSONResponse({"error": "No se pudo consultar el histórico"}, status_code=503)
+        return StreamingResponse(_historico_json(primer_lote, lotes), media_type='application/json')
+
+    with LATENCIA_ETAPA.medir('api_historico'):
+        datos = await coalescedor.ejecutar(
+            ('historico', _iso(inicio), _iso(fin)),
+            tsdb.consultar_rango_fechas, _iso(inicio), _iso(fin)
+        )
+    return JSONResponse(datos)
+
+
+async def obtener_alertas(request):
+    """Historial de alertas del rango: ?tipo= &prioridad= &device_id= &limite="""
+    try:
+        inicio, fin = _rango(request)
+        limite = int(request.query_params.get('limite', '500'))
+    except (ErrorParametro, ValueError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    filtros = tuple(request.query_params.get(k) for k in ('tipo', 'prioridad', 'device_id'))
+    datos = await coalescedor.ejecutar(
+        ('alertas', _iso(inicio), _iso(fin), filtros, limite),
+        alert_store.consultar_historial, _iso(inicio), _iso(fin), *filtros, limite
+    )
+    return JSONResponse(datos)
+
+
+async def obtener_conteo_alertas(request):
+    """Línea de tiempo: alertas por tipo y prioridad en buckets de ?intervalo= (default 1h)"""
+    try:
+        inicio, fin = _rango(request)
+        intervalo = request.query_params.get('intervalo', '1h')
+        datos = await coalescedor.ejecutar(
+            ('conteo_alertas', _iso(inicio), _iso(fin), intervalo),
+            alert_store.conteo_por_tipo, _iso(inicio), _iso(fin), intervalo
+        )
+    except (ErrorParametro, ValueError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(datos)
+
+
+def _lista_parametro(request, nombre):
+    valor = request.query_params.get(nombre)
+    return [v.strip() for v in valor.split(',') if v.strip()] if valor else None
+
+
+async def exportar(request):
+    """
+    Exporta el rango transmitido por chunks.
+    ?formato=csv|parquet|arrow &dispositivos=a,b &campos=temp_celsius,... &intervalo=1m
+    """
+    try:
+        inicio, fin = _rango(request)
+        formato = request.query_params.get('formato', 'csv')
+        if formato not in FORMATOS:
+            raise ErrorParametro(f"Formato no soportado: {formato!r}")
+        # La consulta Flight es bloqueante: se abre en el pool y el cuerpo se itera en hilos de Starlette
+        lector = await run_in_threadpool(
+            tsdb.lector_exportacion, _iso(inicio), _iso(fin),
+            _lista_parametro(request, 'dispositivos'),
+            _lista_parametro(request, 'campos'),
+            request.query_params.get('intervalo')
+        )
+    except (ErrorParametro, ValueError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except ConnectionError as e:
+        return JSONResponse({"error": str(e)}, status_code=503)
+
+    media_type, extension = FORMATOS[formato]
+    nombre = f"transwatch_{inicio:%Y%m%d%H%M}_{fin:%Y%m%d%H%M}.{extension}"
+    return StreamingResponse(
+        exportar_lotes(lector, formato),
+        media_type=media_type,
+        headers={'Content-Disposition': f'attachment; filename="{nombre}"'}
+    )
+
+
+@contextlib.asynccontextmanager
+async def ciclo_vida(app):
+    yield
+    alert_store.detener()
+    coalescedor.cerrar()
+    tsdb.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/estadisticas', obtener_estadisticas, methods=['GET']),
+        Route('/api/historico', obtener_historico, methods=['GET']),
+        Route('/api/exportar', exportar, methods=['GET']),
+        Route('/api/alertas', obtener_alertas, methods=['GET']),
+        Route('/api/alertas/conteo', obtener_conteo_alertas, methods=['GET']),
+    ],
+    middleware=[
+        # Mismo comportamiento que flask_cors en api.py: cualquier origen (client-layer)
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['GET']),
+        Middleware(CompresionMiddleware),
+    ],
+    lifespan=ciclo_vida
+)
+
+
+if __name__ == '__main__':
+    configurar_logging()
+    log.info("Iniciando API asíncrona en puerto %d...", API_PORT)
+    uvicorn.run(app, host=API_HOST, port=API_PORT, log_config=None)
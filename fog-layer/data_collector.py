@@ -1,5 +1,7 @@
 import socket
 import json
+import re
+import logging
 from datetime import datetime
 import os
 import asyncio
@@ -13,60 +15,188 @@ from azure.iot.device import IoTHubDeviceClient, Message
 # Importar desde los nuevos modulos organizados
 from services.tsdb_manager import TimeSeriesManager
 from services.notification_engine import NotificationEngine
-from quality.qc import SimpleQualityControl
+from services.alert_store import AlertStore
+from services.ingest_batcher import MicroBatcher
+from services.deadband import CompresorDeadband, DEADBAND_ENABLED
+from services.lectura import parsear_lectura, ErrorEsquema
+from services.snapshot import GestorSnapshots
+from services.vivacidad import MonitorVivacidad, VIVACIDAD_ENABLED
+from services.carriles import CarrilAlertas, CarrilTelemetria, CARRILES_ENABLED, es_prioritaria
+from services.log_config import configurar_logging, obtener_logger
+from services.metrics import (registro, iniciar_servidor_metricas, MENSAJES_MQTT, BYTES_MQTT,
+                              MENSAJES_MQTT_DESCARTADOS, RESULTADOS_QC, LATENCIA_ETAPA, LATENCIA_EXTREMO)
+from quality.qc import SimpleQualityControl, detectores_para
 
 # Cargar variables de entorno
 load_dotenv()
 
+log = obtener_logger("transwatch.gateway")
+
 AZURE_CONN_STRING = os.getenv('AZURE_IOT_CONN_STRING')
 LOCAL_MQTT_BROKER = os.getenv('MQTT_BROKER')
 LOCAL_MQTT_PORT = int(os.getenv('MQTT_PORT', '1883'))
 LOCAL_MQTT_TOPIC = os.getenv('MQTT_TOPIC', 'transwatch/parking/esp32')
+LOCAL_MQTT_QOS = int(os.getenv('MQTT_QOS', '0'))
+LOCAL_MQTT_CLIENT_ID = os.getenv('MQTT_CLIENT_ID', '')
+# MQTT v5 por defecto; '3.1.1' para brokers antiguos
+LOCAL_MQTT_PROTOCOL = os.getenv('MQTT_PROTOCOL', '5')
+# Grupo de suscripción compartida ($share/<grupo>/<topico>). Vacío = suscripción normal
+LOCAL_MQTT_SHARED_GROUP = os.getenv('MQTT_SHARED_GROUP', '')
+
+# Micro-lotes: se procesa al juntar N mensajes o al pasar T ms
+MQTT_BATCH_SIZE = int(os.getenv('MQTT_BATCH_SIZE', '50'))
+MQTT_BATCH_MS = int(os.getenv('MQTT_BATCH_MS', '100'))
+# Espera máxima del hilo de red de paho con la cola llena; pasado este tiempo el mensaje se descarta
+MQTT_COLA_ESPERA_S = float(os.getenv('MQTT_COLA_ESPERA_MS', '0')) / 1000.0
+
+DEVICE_ID_DEFAULT = "ESP32-Parking-Transwatch"
 
 # Conexiones globales
 azure_client = None
 tsdbmanager = TimeSeriesManager()
 local_mqtt_client = None
+micro_batcher = None
+websocket_loop = None
+
+# Instancias globales para QC (una ventana por dispositivo) y Notificaciones
+qc_engines = {}
+notification_engine = NotificationEngine(alert_store=AlertStore(tsdbmanager))
+# Compresión por banda muerta antes de InfluxDB/Azure (None = se guarda todo)
+compresor_deadband = CompresorDeadband() if DEADBAND_ENABLED else None
+# Snapshot del estado en memoria para arrancar en caliente (ver iniciar_snapshots)
+snapshots = None
+
+# Búsqueda del device_id directamente en los bytes del payload (sin decodificar el JSON)
+DEVICE_ID_RE = re.compile(rb'"device_id"\s*:\s*"([^"]+)"')
+
+def extraer_device_id(payload_bytes):
+    """Obtiene el device_id del payload crudo; si no viene, usa el dispositivo por defecto"""
+    coincidencia = DEVICE_ID_RE.search(payload_bytes)
+    if coincidencia:
+        return coincidencia.group(1).decode('utf-8', errors='replace')
+    return DEVICE_ID_DEFAULT
+
+def obtener_qc_engine(device_id):
+    """Retorna el motor de QC del dispositivo, creándolo en su primera lectura"""
+    engine = qc_engines.get(device_id)
+    if engine is None:
+        engine = qc_engines[device_id] = SimpleQualityControl(detectores=detectores_para(device_id))
+    return engine
+
+def ventanas_qc():
+    """Muestras acumuladas en las ventanas de QC por sensor (suma de todos los dispositivos)"""
+    totales = {}
+    for engine in list(qc_engines.values()):
+        for sensor, ventana in engine.sensor_data.items():
+            totales[sensor] = totales.get(sensor, 0) + len(ventana)
+    return totales
+
+def notificar_vivacidad(device_id, online, info):
+    """Alerta de dispositivo offline/online desde el hilo del monitor de vivacidad"""
+    if not online and compresor_deadband is not None:
+        guardar_retenidas(compresor_deadband.vaciar(device_id))
+    alerta = notification_engine.alerta_vivacidad(device_id, online, info)
+    if carril_alertas.activo and es_prioritaria(alerta):
+        carril_alertas.enviar(alerta)
+    else:
+        ejecutar_async(notification_engine.enviar_notificaciones(alerta, alerta['channels']))
+
+# Último mensaje por dispositivo para detectar los que dejan de reportar (hilo propio al iniciar el gateway)
+monitor_vivacidad = MonitorVivacidad(al_cambiar=notificar_vivacidad) if VIVACIDAD_ENABLED else None
+notification_engine.monitor_vivacidad = monitor_vivacidad
+
+def exportar_qc():
+    return {device_id: engine.exportar_ventanas() for device_id, engine in list(qc_engines.items())}
+
+def restaurar_qc(estado):
+    for device_id, ventanas in estado.items():
+        obtener_qc_engine(device_id).restaurar_ventanas(ventanas)
+
+def iniciar_snapshots(nombre, pipeline=True, alertas=True):
+    """
+    Restaura el último snapshot del proceso (si no está vencido) y empieza a
+    capturar el estado. Llamar antes de procesar mensajes y de iniciar el
+    servidor WebSocket. `pipeline`: ventanas de QC y compresión; `alertas`:
+    registro de alertas recientes (evita precargarlo desde la BD).
+    """
+    global snapshots
+    snapshots = GestorSnapshots(nombre)
+    if not snapshots.habilitado:
+        return snapshots
+    if pipeline:
+        snapshots.registrar('qc', exportar_qc, restaurar_qc)
+        if compresor_deadband is not None:
+            snapshots.registrar('deadband', compresor_deadband.exportar_estado, compresor_deadband.restaurar_estado)
+        if monitor_vivacidad is not None:
+            snapshots.registrar('vivacidad', monitor_vivacidad.exportar, monitor_vivacidad.restaurar)
+    if alertas:
+        recientes = notification_engine.alertas_recientes
+        snapshots.registrar('alertas_recientes', recientes.exportar, recientes.restaurar)
+
+    if 'alertas_recientes' in snapshots.restaurar():
+        notification_engine.precargar_alertas = False
+    # Sin pipeline no hay hilo de micro-lotes que llame tal_vez_capturar: captura el propio gestor
+    snapshots.iniciar(periodico=not pipeline)
+    return snapshots
 
-# Instancias globales para QC y Notificaciones
-qc_engine = SimpleQualityControl()
-notification_engine = NotificationEngine()
+def registrar_gauges():
+    """Gauges evaluados al momento del scrape de /metrics"""
+    registro.gauge('transwatch_cola_mensajes', 'Mensajes en espera de micro-lote',
+                   lambda: micro_batcher.cola.qsize() if micro_batcher else 0)
+    registro.gauge('transwatch_websocket_clientes', 'Clientes WebSocket conectados',
+                   lambda: len(notification_engine.websocket_clients))
+    registro.gauge('transwatch_qc_dispositivos', 'Dispositivos con ventana de QC', lambda: len(qc_engines))
+    registro.gauge('transwatch_qc_ventana_muestras', 'Muestras en ventanas de QC por sensor',
+                   ventanas_qc, etiqueta='sensor')
+    registro.gauge('transwatch_carril_pendientes', 'Alertas o lotes en espera por carril',
+                   lambda: {'alertas': carril_alertas.pendientes(), 'telemetria': carril_telemetria.pendientes()},
+                   etiqueta='carril')
+
+registrar_gauges()
 
 # Función para iniciar el servidor WebSocket en un hilo separado
 def start_websocket_server():
     """Inicia el servidor WebSocket en un hilo separado"""
+    global websocket_loop
     time.sleep(2)  # Esperar a que todo esté inicializado
     try:
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        websocket_loop = loop
         loop.run_until_complete(notification_engine.start_websocket_server())
-        print("Servidor WebSocket iniciado correctamente")
+        log.info("Servidor WebSocket iniciado correctamente")
         loop.run_forever()
     except Exception as e:
-        print(f"Error crítico en WebSocket server: {e}")
+        log.critical("Error crítico en WebSocket server: %s", e)
+
+def ejecutar_async(coro):
+    """Ejecuta una corrutina en el loop del servidor WebSocket (o en uno nuevo si aún no está activo)"""
+    if websocket_loop and websocket_loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coro, websocket_loop)
+    asyncio.run(coro)
 
 # Validaciones rápidas previas al QC
-def validacion_rapida(datos):
+def validacion_rapida(lectura):
   """Validaciones básicas de rangos lógicos antes del QC avanzado"""
-  temp = datos.get('temperatura_celsius', None)
+  temp = lectura.temperatura_celsius
   TEMP_MIN_LOGICO = -10.0
   TEMP_MAX_LOGICO = 60.0
 
   # Validacion en el rango de temperatura logico
   if temp is None or temp < TEMP_MIN_LOGICO or temp > TEMP_MAX_LOGICO:
-    print(f"Lectura de temperatura anomala detectada: {temp} C°.")
+    log.debug("Lectura de temperatura anomala detectada: %s C°.", temp)
     return False, f"Temperatura fuera de rango lógico: {temp}°C"
 
-  if datos.get('humedad_porcentaje', None) is None or datos.get('luz_adc', None) is None:
-    print("Lectura de datos incompleta. Revise los sensores.")
+  if lectura.humedad_porcentaje is None or lectura.luz_adc is None:
+    log.debug("Lectura de datos incompleta. Revise los sensores.")
     return False, "Datos incompletos (humedad o luz nulos)"
 
   return True, "Validación rápida aprobada"
 
 # Aseguramiento de calidad de datos
-def aplicar_qc(datos):
+def aplicar_qc(lectura, device_id=DEVICE_ID_DEFAULT, recibido=None):
   # Primero aplicar validación rápida
-  valido_rapido, mensaje_rapido = validacion_rapida(datos)
+  valido_rapido, mensaje_rapido = validacion_rapida(lectura)
   if not valido_rapido:
     resultado_fallo = {
       'todos_aprobados': False,
@@ -81,16 +211,9 @@ def aplicar_qc(datos):
       }
     }
     return resultado_fallo
-  
-  datos_para_qc = {
-    'temperatura': datos.get('temperatura_celsius'),
-    'humedad': datos.get('humedad_porcentaje'),
-    'luz_adc': datos.get('luz_adc'),
-    'distancia_cm': datos.get('distancia_cm')
-  }
  
-  # Aplicar control de calidad
-  resultado_qc = qc_engine.aplicar_qc(datos_para_qc)
+  # Aplicar control de calidad directamente sobre la lectura
+  resultado_qc = obtener_qc_engine(device_id).aplicar_qc_lectura(lectura, recibido)
   
   return resultado_qc
 
@@ -98,154 +221,269 @@ def aplicar_qc(datos):
 def iniciar_conexion_azure():
     global azure_client
     if not AZURE_CONN_STRING:
-        print("Error: Clave de Azure IoT no definida, no se conectará al servicio de la nube.")
+        log.error("Clave de Azure IoT no definida, no se conectará al servicio de la nube.")
         return None
     
     try:
         azure_client = IoTHubDeviceClient.create_from_connection_string(AZURE_CONN_STRING)
-        print("Azure cliente IoT Hub conectado")
+        log.info("Azure cliente IoT Hub conectado")
         return azure_client
     except Exception as e:
-        print(f"Azure error al conectar con el IoT Hub: {e}")
+        log.error("Azure error al conectar con el IoT Hub: %s", e)
         return None
 
 # Lógica de mensajería MQTT
-def on_connect_local(client, userdata, flags, rc):
+def topico_suscripcion():
+    """Tópico a suscribir; con grupo compartido varios gateways se reparten los mensajes"""
+    if LOCAL_MQTT_SHARED_GROUP:
+        return f"$share/{LOCAL_MQTT_SHARED_GROUP}/{LOCAL_MQTT_TOPIC}"
+    return LOCAL_MQTT_TOPIC
+
+def on_connect_local(client, userdata, flags, rc, properties=None):
     if rc == 0:
-        print(f"MQTT Conectado al broker {LOCAL_MQTT_BROKER}:{LOCAL_MQTT_PORT}")
-        client.subscribe(LOCAL_MQTT_TOPIC)
-        print(f"Subscrito al tópico {LOCAL_MQTT_TOPIC}")
+        log.info("MQTT Conectado al broker %s:%s", LOCAL_MQTT_BROKER, LOCAL_MQTT_PORT)
+        topico = topico_suscripcion()
+        client.subscribe(topico, qos=LOCAL_MQTT_QOS)
+        log.info("Subscrito al tópico %s", topico)
     else:
-        print(f"MQTT Fallo al conectar: {rc}")
+        log.error("MQTT Fallo al conectar: %s", rc)
 
 # Lógica del envío de datos a Azure
-def enviar_a_azure_iot_hub(datos):
+def enviar_a_azure_iot_hub(lectura):
     if not azure_client:
-        print("Cliente no conectado. No es posible enviar datos a la nube")
+        log.warning("Cliente no conectado. No es posible enviar datos a la nube")
         return
     
     try:
-        telemetry_data = json.dumps(datos)
+        telemetry_data = lectura.a_json()
         message = Message(telemetry_data)
 
         message.custom_properties["QCStatus"] = "Clean"
         message.custom_properties["DeviceID"] = "ESP32-Parking"
 
-        azure_client.send_message(message)
-        print(f"Enviado a Azure: {telemetry_data}")
-        print("Mensaje limpio publicado a la nube de Azure.")
+        with LATENCIA_ETAPA.medir('enviar_a_azure_iot_hub'):
+            azure_client.send_message(message)
+        log.debug("Mensaje limpio publicado a la nube de Azure", extra={'device_id': lectura.device_id})
     except Exception as e:
-        print(f"Error al mandar mensaje a la nube de Azure: {e}")
+        log.error("Error al mandar mensaje a la nube de Azure: %s", e)
 
-async def procesar_alertas(datos, resultado_qc):
-    """Procesa las alertas de forma asíncrona"""
+def detectar_alertas(lectura, resultado_qc):
+    """
+    Evalúa las reglas apenas termina el QC. Las alertas prioritarias salen en el
+    acto por su carril (sin esperar InfluxDB, Azure ni el broadcast del lote);
+    retorna las demás, que se envían con la telemetría.
+    """
+    normales = []
     try:
-        datos_alertas = {
-            'temperatura_celsius': datos.get('temperatura_celsius'),
-            'humedad_porcentaje': datos.get('humedad_porcentaje'),
-            'luz_adc': datos.get('luz_adc'),
-            'distancia_cm': datos.get('distancia_cm'),
-            'vehiculo_en_entrada_detectado': datos.get('vehiculo_en_entrada_detectado', False),
-            'barrera_abierta': datos.get('barrera_abierta', False),
-            'luces_parking_encendidas': datos.get('luces_parking_encendidas', False),
-            'alarma_temperatura_activa': datos.get('alarma_temperatura_activa', False)
-        }
-
-        # Evaluar alertas - solo obtener las alertas activas
-        alertas = notification_engine.evaluar_alertas(datos_alertas, resultado_qc['todos_aprobados'])
-        
-        # Procesar cada alerta individualmente
-        for alerta in alertas:
-            if isinstance(alerta, dict) and 'type' in alerta:
-                print(f"Alerta disparada: {alerta['type']}")
-                await notification_engine.enviar_notificaciones(
-                    alerta,
-                    alerta.get('channels', ['email', 'database', 'websocket'])
-                )
-            else:
-                print(f"Error: formato de alerta inválido: {alerta}")
+        alertas = notification_engine.evaluar_alertas(lectura, resultado_qc['todos_aprobados'])
     except Exception as e:
-        print(f"Error procesando alertas: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Error evaluando alertas: %s", e)
+        return normales
+    detectado = time.time()
+    for alerta in alertas:
+        if not (isinstance(alerta, dict) and 'type' in alerta):
+            log.error("Formato de alerta inválido: %r", alerta)
+            continue
+        log.info("Alerta disparada: %s", alerta['type'], extra={'device_id': lectura.device_id, 'prioridad': alerta.get('priority')})
+        if carril_alertas.activo and es_prioritaria(alerta):
+            carril_alertas.enviar(alerta, detectado)
+        else:
+            normales.append(alerta)
+    return normales
 
-def on_message_local(client, userdata, msg):
-    payload = msg.payload.decode('utf-8')
-    print(f"Mensaje MQTT - Tópico: {msg.topic}")
-    print(f"Payload: {payload}")
+def entregar_alerta_prioritaria(alerta, detectado):
+    """Entrega de una alerta en un hilo del carril de alertas; el WebSocket se envía en su loop"""
+    return notification_engine.entregar_prioritaria(alerta, detectado, ejecutar_async)
+
+async def procesar_alertas(alertas):
+    """Envía las alertas no prioritarias de un lote"""
+    for alerta in alertas:
+        try:
+            await notification_engine.enviar_notificaciones(
+                alerta,
+                alerta.get('channels', ['email', 'database', 'websocket'])
+            )
+        except Exception as e:
+            log.exception("Error procesando alertas: %s", e)
 
+def procesar_mensaje(payload_bytes, topic, recibido=None):
+    """Decodifica y aplica QC a un mensaje. Retorna (lectura, resultado_qc) o None si no es válido."""
     try:
-        datos_json = json.loads(payload)
-        print("JSON decodificado correctamente")
-        
+        # Un solo paso bytes -> Lectura validada; las demás etapas la consumen directamente
+        with LATENCIA_ETAPA.medir('decode'):
+            lectura = parsear_lectura(payload_bytes)
+        if lectura.device_id is None:
+            lectura.device_id = DEVICE_ID_DEFAULT
+
         # Aplicar control de calidad
-        resultado_qc = aplicar_qc(datos_json)
+        with LATENCIA_ETAPA.medir('aplicar_qc'):
+            resultado_qc = aplicar_qc(lectura, lectura.device_id, recibido)
+        RESULTADOS_QC.inc(etiqueta='aprobado' if resultado_qc['todos_aprobados'] else 'rechazado')
         
-        # Mostrar resultado del QC
-        if 'validacion_rapida' in resultado_qc['resultados']:
-            # Caso: validación rápida fallida
-            print("Resultado QC: RECHAZADO")
-            resultado = resultado_qc['resultados']['validacion_rapida']
-            print(f"  validacion_rapida: {resultado['razon']}")
-        else:
-            # Caso: QC avanzado
-            print(f"Resultado QC: {'APROBADO' if resultado_qc['todos_aprobados'] else 'RECHAZADO'}")
+        # Detalle del QC solo si el nivel DEBUG está activo (sin costo en producción)
+        if log.isEnabledFor(logging.DEBUG):
             for sensor, resultado in resultado_qc['resultados'].items():
-                estado = "OK" if resultado['aprobado'] else "FALLA"
-                print(f"  {sensor}: {estado} - {resultado['razon']}")
-        
-        if resultado_qc['todos_aprobados']:
-            print("Control de calidad aprobado - enviando a Azure")
-            enviar_a_azure_iot_hub(datos_json)
-            print("Enviando a InfluxDB v3")
-            tsdbmanager.almacenar_lectura(
-                datos=datos_json,
-                device_id="ESP32-Parking-Transwatch",
-                qc_status="Clean"
-            )
-            print("Enviando telemetría en tiempo real a WebSockets...")
-            asyncio.run(notification_engine.broadcast_telemetry(datos_json))
-        else:
-            print("Mensaje descartado por problemas de QC.")
-        
-        # Procesar alertas en un nuevo event loop
-        asyncio.run(procesar_alertas(datos_json, resultado_qc))
+                log.debug("QC %s: %s - %s", sensor, "OK" if resultado['aprobado'] else "FALLA", resultado['razon'],
+                          extra={'device_id': lectura.device_id, 'topic': topic})
+
+        if not resultado_qc['todos_aprobados']:
+            log.info("Mensaje descartado por problemas de QC", extra={'device_id': lectura.device_id})
+
+        return lectura, resultado_qc
         
-    except json.JSONDecodeError as e:
-        print(f"Error al decodificar el JSON recibido: {e}")
-        print(f"Payload recibido: {payload}")
+    except ErrorEsquema as e:
+        RESULTADOS_QC.inc(etiqueta='invalido')
+        log.warning("Payload rechazado: %s", e, extra={'topic': topic, 'payload': payload_bytes[:200]})
     except Exception as e:
-        print(f"Error inesperado procesando el mensaje: {e}")
+        log.exception("Error inesperado procesando el mensaje: %s", e)
+    return None
+
+async def despachar_lote_async(lecturas_limpias, alertas):
+    """Broadcast de la telemetría limpia y envío de las alertas no prioritarias de un lote"""
+    for lectura in lecturas_limpias:
+        await notification_engine.broadcast_telemetry(lectura)
+        # Cede el loop entre lecturas: una alerta prioritaria no espera el lote completo
+        await asyncio.sleep(0)
+
+    if alertas:
+        await procesar_alertas(alertas)
+
+def guardar_y_difundir(lecturas_limpias, a_guardar, alertas):
+    """E/S de un lote en el carril de telemetría: Azure, InfluxDB, broadcast y alertas no prioritarias"""
+    inicio = time.perf_counter()
+    if a_guardar:
+        for lectura, _, _ in a_guardar:
+            enviar_a_azure_iot_hub(lectura)
+        tsdbmanager.almacenar_lote(a_guardar, qc_status="Clean")
+
+    if lecturas_limpias:
+        ahora = time.time()
+        for _, _, recibido in lecturas_limpias:
+            LATENCIA_EXTREMO.observar(ahora - recibido)
+
+    if lecturas_limpias or alertas:
+        ejecutar_async(despachar_lote_async([lectura for lectura, _, _ in lecturas_limpias], alertas))
+    LATENCIA_ETAPA.observar(time.perf_counter() - inicio, 'guardar_y_difundir')
+
+def guardar_retenidas(items):
+    """Lecturas retenidas por la compresión de dispositivos que dejaron de reportar"""
+    if items:
+        carril_telemetria.enviar([], items, [])
+
+def procesar_lote(lote):
+    """
+    Procesa un micro-lote de mensajes (payload, tópico, timestamp de recepción):
+    QC y detección de alertas por mensaje en este hilo; la E/S del lote (una sola
+    escritura a InfluxDB, Azure y un solo despacho al loop WebSocket) sigue en el
+    carril de telemetría.
+    """
+    inicio = time.perf_counter()
+    lecturas_limpias = []
+    alertas = []
+
+    # Espera en cola desde la recepción MQTT hasta salir en un lote (incluye la cola del worker en modo sharded)
+    ahora = time.time()
+    for _, _, recibido in lote:
+        LATENCIA_ETAPA.observar(ahora - recibido, 'espera_cola')
+
+    if monitor_vivacidad is not None:
+        # Cualquier mensaje cuenta como señal de vida, aunque luego no pase la validación
+        monitor_vivacidad.vistos([(extraer_device_id(payload), recibido) for payload, _, recibido in lote])
+
+    for payload, topic, recibido in lote:
+        resultado = procesar_mensaje(payload, topic, recibido)
+        if resultado is None:
+            continue
+        lectura, resultado_qc = resultado
+        if resultado_qc['todos_aprobados']:
+            lecturas_limpias.append((lectura, lectura.device_id, recibido))
+        alertas.extend(detectar_alertas(lectura, resultado_qc))
+
+    # La telemetría en vivo y las alertas usan todas las lecturas; InfluxDB y Azure solo las que cambian
+    a_guardar = lecturas_limpias
+    if compresor_deadband is not None and lecturas_limpias:
+        a_guardar = [item for limpia in lecturas_limpias for item in compresor_deadband.filtrar(*limpia)]
+
+    LATENCIA_ETAPA.observar(time.perf_counter() - inicio, 'procesar_lote')
+    if lecturas_limpias or alertas:
+        carril_telemetria.enviar(lecturas_limpias, a_guardar, alertas)
+
+    if snapshots is not None:
+        snapshots.tal_vez_capturar()
+
+# Alertas critical/high con hilos propios; E/S de la telemetría en su propio hilo. Sin
+# iniciar (iniciar_carriles) todo sigue en el hilo de micro-lotes y las alertas van con la telemetría
+carril_alertas = CarrilAlertas(entregar_alerta_prioritaria)
+carril_telemetria = CarrilTelemetria(guardar_y_difundir)
+
+def iniciar_carriles():
+    if CARRILES_ENABLED:
+        carril_alertas.iniciar()
+        carril_telemetria.iniciar()
+    if compresor_deadband is not None:
+        compresor_deadband.iniciar(guardar_retenidas)
+
+def detener_carriles():
+    """Tras detener el micro-batcher: vacía la telemetría pendiente y luego las alertas"""
+    if compresor_deadband is not None:
+        compresor_deadband.detener()
+    carril_telemetria.detener()
+    carril_alertas.detener()
+
+def on_message_local(client, userdata, msg):
+    # El hilo de red de paho solo encola; el procesamiento ocurre por micro-lotes
+    MENSAJES_MQTT.inc()
+    BYTES_MQTT.inc(len(msg.payload))
+    item = (msg.payload, msg.topic, time.time())
+    if micro_batcher:
+        # Nunca bloquea el hilo de red: con la cola llena se descarta y se cuenta
+        if not micro_batcher.agregar(item, timeout=MQTT_COLA_ESPERA_S):
+            MENSAJES_MQTT_DESCARTADOS.inc()
+            log.warning("Cola de micro-lotes llena; mensaje MQTT descartado", extra={'topic': msg.topic})
+    else:
+        procesar_lote([item])
 
 def iniciar_gateway_mqtt():
-    global local_mqtt_client
+    global local_mqtt_client, micro_batcher
 
     # Iniciar conexión a Azure
     iniciar_conexion_azure()
 
+    # Iniciar hilo de micro-lotes
+    micro_batcher = MicroBatcher(procesar_lote, MQTT_BATCH_SIZE, MQTT_BATCH_MS)
+    iniciar_carriles()
+    micro_batcher.iniciar()
+    log.info("Micro-lotes activos: %s mensajes / %s ms", MQTT_BATCH_SIZE, MQTT_BATCH_MS)
+    if monitor_vivacidad is not None:
+        monitor_vivacidad.iniciar()
+
     # Configurar cliente MQTT local
-    local_mqtt_client = paho.Client()
+    protocolo = paho.MQTTv5 if LOCAL_MQTT_PROTOCOL == '5' else paho.MQTTv311
+    local_mqtt_client = paho.Client(client_id=LOCAL_MQTT_CLIENT_ID, protocol=protocolo)
     local_mqtt_client.on_connect = on_connect_local
     local_mqtt_client.on_message = on_message_local
 
     try:
         local_mqtt_client.connect(LOCAL_MQTT_BROKER, LOCAL_MQTT_PORT, 60)
-        print("Cliente MQTT configurado correctamente")
+        log.info("Cliente MQTT configurado correctamente")
         
         # Iniciar loop MQTT
-        print("Iniciando loop MQTT...")
+        log.info("Iniciando loop MQTT...")
         local_mqtt_client.loop_start()  # Cambiar loop_forever() por loop_start()
     except Exception as e:
-        print(f"Error al conectar al Broker local: {e}")
+        log.error("Error al conectar al Broker local: %s", e)
         return
 
 if __name__ == "__main__":
-    print("Iniciando Gateway de TRANSWATCH...")
+    configurar_logging()
+    log.info("Iniciando Gateway de TRANSWATCH...")
+    iniciar_servidor_metricas()
+    iniciar_snapshots("gateway")
 
     # Iniciar servidor WebSocket en un hilo separado
     websocket_thread = threading.Thread(target=start_websocket_server, daemon=True)
     websocket_thread.start()
-    print("Servidor WebSocket iniciado en segundo plano (puerto 8765)")
+    log.info("Servidor WebSocket iniciado en segundo plano")
 
     # Pequeña pausa para asegurar que el WebSocket esté listo
     time.sleep(3)
@@ -258,7 +496,15 @@ if __name__ == "__main__":
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        print("\nDeteniendo el gateway...")
+        log.info("Deteniendo el gateway...")
         if local_mqtt_client:
             local_mqtt_client.loop_stop()
-            local_mqtt_client.disconnect()
\ No newline at end of file
+            local_mqtt_client.disconnect()
+        if micro_batcher:
+            micro_batcher.detener()
+        detener_carriles()
+        if monitor_vivacidad:
+            monitor_vivacidad.detener()
+        if snapshots:
+            snapshots.detener()
+        notification_engine.alert_store.detener()
\ No newline at end of file
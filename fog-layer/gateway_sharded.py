@@ -0,0 +1,237 @@
+# fog-layer/gateway_sharded.py
+"""
+Modo sharded del gateway de TRANSWATCH.
+
+Un supervisor recibe los mensajes MQTT y los reparte entre N procesos worker
+según un hash del device_id, de modo que cada dispositivo siempre cae en el
+mismo worker (mismas ventanas de QC y orden de llegada preservado). Los
+workers ejecutan el pipeline de data_collector (QC, InfluxDB, Azure, alertas)
+y publican la telemetría en un único proceso fan-out que atiende los
+clientes WebSocket.
+
+Los mensajes sin device_id son todos del dispositivo por defecto y van a un
+solo worker. El firmware actual no lo envía, así que para repartir la carga
+cada dispositivo debe incluir su device_id.
+"""
+
+import os
+import json
+import time
+import zlib
+import queue
+import asyncio
+import threading
+import multiprocessing as mp
+
+import paho.mqtt.client as paho
+
+import data_collector as dc
+from services.ingest_batcher import MicroBatcher
+from services.log_config import configurar_logging, obtener_logger
+from services.metrics import (registro, iniciar_servidor_metricas, METRICS_PORT, MENSAJES_MQTT, BYTES_MQTT,
+                              MENSAJES_MQTT_DESCARTADOS)
+
+log = obtener_logger("transwatch.sharded")
+
+GATEWAY_WORKERS = int(os.getenv('GATEWAY_WORKERS', str(os.cpu_count() or 2)))
+# Tamaño máximo de cada cola supervisor -> worker (llena: se descarta, ver MQTT_COLA_ESPERA_MS)
+GATEWAY_WORKER_QUEUE = int(os.getenv('GATEWAY_WORKER_QUEUE', '10000'))
+
+# Mensajes de telemetría que el fan-out difunde por vuelta del loop
+_MAX_GRUPO_FANOUT = 256
+
+
+def shard_de(device_id, n_workers):
+    """Índice de worker estable para un dispositivo (crc32, igual en todos los procesos)"""
+    return zlib.crc32(device_id.encode('utf-8')) % n_workers
+
+
+def proceso_worker(indice, n_workers, cola_entrada, canal_fanout, canal_alertas, evento_parada, puerto_metricas=0):
+    """Worker: ejecuta el pipeline de data_collector sobre los mensajes de su shard"""
+    configurar_logging()
+    iniciar_servidor_metricas(puerto_metricas)
+    dc.notification_engine.canal_fanout = canal_fanout
+    dc.notification_engine.canal_alertas = canal_alertas
+    dc.iniciar_conexion_azure()
+    # El nombre incluye el número de workers: con otro reparto los dispositivos cambian de shard
+    dc.iniciar_snapshots(f"gateway-worker-{indice}-de-{n_workers}", alertas=False)
+
+    batcher = MicroBatcher(dc.procesar_lote, dc.MQTT_BATCH_SIZE, dc.MQTT_BATCH_MS, cola=cola_entrada)
+    dc.micro_batcher = batcher
+    dc.iniciar_carriles()
+    batcher.iniciar()
+    if dc.monitor_vivacidad is not None:
+        dc.monitor_vivacidad.iniciar()
+    log.info("Worker %d iniciado (pid %d)", indice, os.getpid())
+
+    try:
+        evento_parada.wait()
+    except KeyboardInterrupt:
+        pass
+    batcher.detener()
+    dc.detener_carriles()
+    if dc.monitor_vivacidad is not None:
+        dc.monitor_vivacidad.detener()
+    dc.snapshots.detener()
+    dc.notification_engine.alert_store.detener()
+
+
+def proceso_fanout(canal_fanout, canal_alertas, puerto_metricas=0):
+    """Fan-out: único servidor WebSocket; difunde lo que publican los workers"""
+    configurar_logging()
+    iniciar_servidor_metricas(puerto_metricas)
+    engine = dc.notification_engine
+    # La vivacidad se sigue en los workers (ven todos los mensajes); aquí no hay datos
+    engine.monitor_vivacidad = None
+    snapshots = dc.iniciar_snapshots("gateway-fanout", pipeline=False)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def reenviar_alertas():
+        # Canal propio: una alerta no espera la telemetría que ya está en canal_fanout
+        while True:
+            mensaje = canal_alertas.get()
+            if mensaje is None:
+                break
+            engine.alertas_recientes.registrar(json.loads(mensaje)['data'])
+            asyncio.run_coroutine_threadsafe(engine.difundir(mensaje), loop)
+
+    def reenviar():
+        while True:
+            mensajes = [canal_fanout.get()]
+            while len(mensajes) < _MAX_GRUPO_FANOUT and mensajes[-1] is not None:
+                try:
+                    mensajes.append(canal_fanout.get_nowait())
+                except queue.Empty:
+                    break
+            fin = mensajes[-1] is None
+            telemetria = mensajes[:-1] if fin else mensajes
+            if telemetria:
+                # Un solo grupo en el loop a la vez y cediendo entre mensajes: las alertas
+                # programadas por reenviar_alertas se intercalan sin esperar el grupo completo
+                asyncio.run_coroutine_threadsafe(engine.difundir_varios(telemetria), loop).result()
+            if fin:
+                # Parada ordenada: último snapshot y cierre del servidor (termina run_until_complete)
+                snapshots.detener()
+                if engine.websocket_server is not None:
+                    loop.call_soon_threadsafe(engine.websocket_server.close)
+                break
+
+    threading.Thread(target=reenviar_alertas, daemon=True).start()
+    threading.Thread(target=reenviar, daemon=True).start()
+    try:
+        loop.run_until_complete(engine.start_websocket_server())
+    except KeyboardInterrupt:
+        pass
+
+
+class ShardSupervisor:
+    """Lanza los workers y el fan-out, y enruta cada mensaje MQTT por device_id"""
+
+    def __init__(self, n_workers=GATEWAY_WORKERS):
+        self.n_workers = max(1, n_workers)
+        # 'spawn' para que cada worker cree sus propios clientes (InfluxDB, Azure, SMTP)
+        self.ctx = mp.get_context('spawn')
+        self.evento_parada = self.ctx.Event()
+        self.canal_fanout = self.ctx.Queue()
+        self.canal_alertas = self.ctx.Queue()
+        self.colas = [self.ctx.Queue(maxsize=GATEWAY_WORKER_QUEUE) for _ in range(self.n_workers)]
+        self.workers = [None] * self.n_workers
+        self.fanout = None
+        self.mqtt_client = None
+        self._aviso_sin_device_id = False
+        registro.gauge('transwatch_cola_worker', 'Mensajes en cola por worker',
+                       lambda: {i: cola.qsize() for i, cola in enumerate(self.colas)}, etiqueta='worker')
+
+    def _puerto_metricas(self, desplazamiento):
+        # Supervisor en METRICS_PORT, workers en los siguientes puertos y el fan-out al final
+        return METRICS_PORT + desplazamiento if METRICS_PORT else 0
+
+    def _lanzar_worker(self, indice):
+        proceso = self.ctx.Process(
+            target=proceso_worker,
+            args=(indice, self.n_workers, self.colas[indice], self.canal_fanout, self.canal_alertas,
+                  self.evento_parada, self._puerto_metricas(1 + indice)),
+            name=f"gateway-worker-{indice}",
+            daemon=True
+        )
+        proceso.start()
+        self.workers[indice] = proceso
+
+    def on_message(self, client, userdata, msg):
+        MENSAJES_MQTT.inc()
+        BYTES_MQTT.inc(len(msg.payload))
+        device_id = dc.extraer_device_id(msg.payload)
+        indice = shard_de(device_id, self.n_workers)
+        if device_id == dc.DEVICE_ID_DEFAULT and not self._aviso_sin_device_id and self.n_workers > 1:
+            self._aviso_sin_device_id = True
+            log.warning("Mensajes sin device_id (tópico %s): todos van al worker %d; para repartir la carga "
+                        "el firmware debe enviar device_id", msg.topic, indice)
+        # Nunca bloquea el hilo de red de paho: con la cola del worker llena se descarta y se cuenta
+        item = (msg.payload, msg.topic, time.time())
+        try:
+            if dc.MQTT_COLA_ESPERA_S > 0:
+                self.colas[indice].put(item, timeout=dc.MQTT_COLA_ESPERA_S)
+            else:
+                self.colas[indice].put_nowait(item)
+        except queue.Full:
+            MENSAJES_MQTT_DESCARTADOS.inc()
+            log.warning("Cola del worker %d llena; mensaje MQTT descartado", indice)
+
+    def iniciar(self):
+        self.fanout = self.ctx.Process(
+            target=proceso_fanout,
+            args=(self.canal_fanout, self.canal_alertas, self._puerto_metricas(1 + self.n_workers)),
+            name="gateway-fanout",
+            daemon=True
+        )
+        self.fanout.start()
+        for indice in range(self.n_workers):
+            self._lanzar_worker(indice)
+        log.info("Supervisor: %d workers + proceso fan-out WebSocket", self.n_workers)
+
+        protocolo = paho.MQTTv5 if dc.LOCAL_MQTT_PROTOCOL == '5' else paho.MQTTv311
+        self.mqtt_client = paho.Client(client_id=dc.LOCAL_MQTT_CLIENT_ID, protocol=protocolo)
+        self.mqtt_client.on_connect = dc.on_connect_local
+        self.mqtt_client.on_message = self.on_message
+        self.mqtt_client.connect(dc.LOCAL_MQTT_BROKER, dc.LOCAL_MQTT_PORT, 60)
+        self.mqtt_client.loop_start()
+
+    def vigilar(self):
+        """Relanza los workers que terminen inesperadamente (su cola se conserva)"""
+        while not self.evento_parada.is_set():
+            for indice, proceso in enumerate(self.workers):
+                if proceso is not None and not proceso.is_alive():
+                    log.error("Worker %d terminó (exit %s). Relanzando...", indice, proceso.exitcode)
+                    self._lanzar_worker(indice)
+            time.sleep(1)
+
+    def detener(self):
+        log.info("Deteniendo gateway sharded...")
+        if self.mqtt_client:
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.disconnect()
+        self.evento_parada.set()
+        for proceso in self.workers:
+            if proceso is not None:
+                proceso.join(timeout=10)
+        self.canal_alertas.put(None)
+        self.canal_fanout.put(None)
+        if self.fanout:
+            self.fanout.join(timeout=5)
+            if self.fanout.is_alive():
+                self.fanout.terminate()
+
+
+if __name__ == "__main__":
+    configurar_logging()
+    log.info("Iniciando Gateway de TRANSWATCH (modo sharded)...")
+    iniciar_servidor_metricas()
+    supervisor = ShardSupervisor()
+    try:
+        supervisor.iniciar()
+        supervisor.vigilar()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.detener()
@@ -2,11 +2,20 @@ import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 import requests
 import json
-import mysql.connector
+import queue
+import threading
+import time
+import asyncio
 from datetime import datetime, timedelta
 from PIL import Image, ImageTk 
 import os
 from dotenv import load_dotenv
+import websockets
+import mysql.connector
+from mysql.connector import errorcode
+
+from services.mysql_store import conexion
+from services.serie_estadisticas import SerieCacheada
 
 # Cargar variables de entorno desde .env, requiere instalacion de python-dotenv
 load_dotenv()
@@ -20,12 +29,14 @@ import matplotlib.dates as mdates
 ESP32_IP = os.getenv('ESP32_IP', '192.168.100.65')
 ESP32_API_URL = f"http://{ESP32_IP}/api"
 
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'localhost'),
-    'user': os.getenv('DB_USER', 'root'),
-    'password': os.getenv('DB_PASSWORD'),
-    'database': os.getenv('DB_NAME', 'parking_inteligente_db')
-}
+# Telemetría en vivo desde el gateway del fog; la BD solo se sondea mientras el socket está caído
+FOG_WS_URL = os.getenv('FOG_WS_URL', 'ws://localhost:8765')
+# Dispositivo que muestra el panel (vacío = cualquiera)
+GUI_DEVICE_ID = os.getenv('GUI_DEVICE_ID', '')
+# Cada cuánto el hilo de fondo consulta el último estado en la BD (modo respaldo)
+GUI_INTERVALO_S = float(os.getenv('GUI_INTERVALO_S', '3'))
+# Cada cuánto el hilo de Tk revisa los resultados del hilo de fondo
+GUI_POLL_COLA_MS = int(os.getenv('GUI_POLL_COLA_MS', '100'))
 
 # --- Variables Globales para la GUI ---
 root = None
@@ -38,6 +49,7 @@ lbl_barrera_val = None
 lbl_luces_val = None
 lbl_alarma_val = None
 lbl_db_timestamp_val = None
+lbl_conexion_val = None
 entry_distancia_ocupado = None
 entry_umbral_luz = None
 entry_umbral_temperatura = None
@@ -49,113 +61,301 @@ oval_alarma_temp = None
 
 stats_canvas_widget = None
 stats_toolbar = None
+stats_plot = None
+stats_lineas = None
+stats_fondo = None
+serie_temperatura = None
 entry_fecha_inicio = None
 entry_fecha_fin = None
 
-# --- Funciones de Base de Datos ---
-def crear_conexion_db():
-    """Crea y retorna una conexión a la base de datos."""
-    try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        return conn
-    except mysql.connector.Error as err:
-        print(f"Error al conectar a MySQL: {err}")
-        messagebox.showerror("Error de Base de Datos", f"No se pudo conectar a MySQL: {err}")
-        return None
+trabajador = None
+suscriptor = None
+ultimo_estado = None
+ultima_fecha = None
+error_sondeo = None
+ws_conectado = False
+
+# Campos de lecturas_parking que muestra el panel (la fecha se actualiza aparte)
+CAMPOS_ESTADO = (
+    'temperatura_celsius', 'humedad_porcentaje', 'luz_adc', 'distancia_entrada_cm',
+    'vehiculo_detectado_entrada', 'barrera_abierta', 'luces_parking_encendidas', 'alarma_temperatura_activa'
+)
+# Nombres de la telemetría del gateway -> columnas de lecturas_parking
+CAMPOS_TELEMETRIA = {
+    'distancia_cm': 'distancia_entrada_cm',
+    'vehiculo_en_entrada_detectado': 'vehiculo_detectado_entrada'
+}
+
 
+class TrabajadorFondo:
+    """
+    Hilo único que ejecuta toda la E/S del panel (MySQL y API del ESP32) fuera
+    del hilo de Tk. Además de las tareas encoladas consulta periódicamente el
+    último estado. Los resultados vuelven por una cola que el hilo de Tk vacía
+    con after(); los callbacks nunca se ejecutan en este hilo.
+    """
+
+    def __init__(self, sondeo, intervalo_s=GUI_INTERVALO_S):
+        self.sondeo = sondeo            # (funcion, al_terminar, al_fallar)
+        self.intervalo_s = intervalo_s
+        # Se limpia mientras llegan datos por WebSocket: no hace falta sondear la BD
+        self.sondeo_habilitado = threading.Event()
+        self.sondeo_habilitado.set()
+        self.tareas = queue.Queue()
+        self.resultados = queue.Queue()
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, name="gui-io", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self.tareas.put(None)
+
+    def enviar(self, funcion, *args, al_terminar=None, al_fallar=None):
+        """Encola funcion(*args); al_terminar(resultado) o al_fallar(error) corren luego en el hilo de Tk"""
+        self.tareas.put((funcion, args, al_terminar, al_fallar))
+
+    def sondear_ahora(self):
+        funcion, al_terminar, al_fallar = self.sondeo
+        self.enviar(funcion, al_terminar=al_terminar, al_fallar=al_fallar)
+
+    def _bucle(self):
+        proximo_sondeo = 0.0
+        while not self._detener.is_set():
+            try:
+                tarea = self.tareas.get(timeout=max(0.0, proximo_sondeo - time.monotonic()))
+            except queue.Empty:
+                proximo_sondeo = time.monotonic() + self.intervalo_s
+                if not self.sondeo_habilitado.is_set():
+                    continue
+                funcion, al_terminar, al_fallar = self.sondeo
+                tarea = (funcion, (), al_terminar, al_fallar)
+            if tarea is None:
+                continue
+            funcion, args, al_terminar, al_fallar = tarea
+            try:
+                resultado = funcion(*args)
+            except Exception as e:
+                self.resultados.put((al_fallar, e))
+            else:
+                self.resultados.put((al_terminar, resultado))
+
+
+class SuscriptorWebSocket:
+    """
+    Hilo con su propio loop asyncio suscrito a la telemetría que difunde el
+    gateway. Mientras el socket está abierto el sondeo de la BD se pausa; al
+    caer se reanuda y se reintenta la conexión con espera creciente. Entre dos
+    vaciados de la cola de Tk solo se entrega la lectura más reciente.
+    """
+
+    def __init__(self, url=FOG_WS_URL, device_id=GUI_DEVICE_ID):
+        self.url = url
+        self.device_id = device_id
+        self._ultima = None
+        self._entrega_pendiente = threading.Event()
+        self._loop = None
+        self._tarea = None
+        self._hilo = threading.Thread(target=self._ejecutar, name="gui-ws", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        if self._loop and self._tarea:
+            self._loop.call_soon_threadsafe(self._tarea.cancel)
+
+    def _ejecutar(self):
+        self._loop = asyncio.new_event_loop()
+        self._tarea = self._loop.create_task(self._bucle())
+        try:
+            self._loop.run_until_complete(self._tarea)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    async def _bucle(self):
+        espera = 1
+        while True:
+            try:
+                async with websockets.connect(self.url, open_timeout=5) as ws:
+                    espera = 1
+                    self._cambio_estado(True)
+                    async for mensaje in ws:
+                        self._recibir(mensaje)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WebSocket del fog no disponible ({e}); se consulta la BD")
+            self._cambio_estado(False)
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 30)
+
+    def _cambio_estado(self, conectado):
+        if conectado:
+            trabajador.sondeo_habilitado.clear()
+        elif not trabajador.sondeo_habilitado.is_set():
+            trabajador.sondeo_habilitado.set()
+            trabajador.sondear_ahora()
+        trabajador.resultados.put((marcar_websocket, conectado))
+
+    def _recibir(self, mensaje):
+        try:
+            datos = json.loads(mensaje)
+        except ValueError:
+            return
+        # Solo telemetría: el historial inicial es una lista y alertas/análisis traen 'type'
+        if not isinstance(datos, dict) or 'type' in datos or 'temperatura_celsius' not in datos:
+            return
+        if self.device_id and datos.get('device_id') != self.device_id:
+            return
+        self._ultima = datos
+        if not self._entrega_pendiente.is_set():
+            self._entrega_pendiente.set()
+            trabajador.resultados.put((self._entregar, None))
+
+    def _entregar(self, _):
+        """Hilo de Tk: muestra la lectura más reciente recibida"""
+        self._entrega_pendiente.clear()
+        telemetria = self._ultima
+        datos = {CAMPOS_TELEMETRIA.get(campo, campo): valor for campo, valor in telemetria.items()}
+        datos['fecha_registro'] = datetime.now()
+        mostrar_estado(datos)
+
+
+def procesar_resultados():
+    """Hilo de Tk: ejecuta los callbacks de las tareas terminadas en el hilo de fondo"""
+    while True:
+        try:
+            callback, valor = trabajador.resultados.get_nowait()
+        except queue.Empty:
+            break
+        if callback:
+            try:
+                callback(valor)
+            except Exception as e:
+                print(f"Error actualizando la interfaz: {e}")
+    if root:
+        root.after(GUI_POLL_COLA_MS, procesar_resultados)
+
+# --- Funciones de Base de Datos (se ejecutan en el hilo de fondo; los errores se propagan) ---
 def obtener_ultimo_estado_db():
-    """Obtiene el registro más reciente de la base de datos."""
-    conn = crear_conexion_db()
-    if not conn:
-        return None
-    datos = None
-    try:
+    """Obtiene el registro más reciente: estado_actual (una fila por dispositivo) o, en BDs sin migrar, lecturas_parking."""
+    with conexion() as conn:
         cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM lecturas_parking ORDER BY fecha_registro DESC LIMIT 1")
-        datos = cursor.fetchone()
-    except mysql.connector.Error as err:
-        print(f"Error al leer de la BD (último estado): {err}")
-    finally:
-        if conn and conn.is_connected():
-            if 'cursor' in locals() and cursor:
-                 cursor.close()
-            conn.close()
-    return datos
-
-def obtener_datos_rango_fecha(fecha_inicio_str, fecha_fin_str):
-    """Obtiene datos de la BD para un rango de fechas."""
-    conn = crear_conexion_db()
-    if not conn:
-        return []
-
-    try:
-        start_date = datetime.strptime(fecha_inicio_str, "%Y-%m-%d").strftime("%Y-%m-%d 00:00:00")
-        end_date = datetime.strptime(fecha_fin_str, "%Y-%m-%d").strftime("%Y-%m-%d 23:59:59")
-    except ValueError:
-        messagebox.showerror("Error de Formato", "Formato de fecha incorrecto. Use AAAA-MM-DD.")
-        return []
+        try:
+            try:
+                if GUI_DEVICE_ID:
+                    cursor.execute("SELECT * FROM estado_actual WHERE device_id = %s", (GUI_DEVICE_ID,))
+                else:
+                    cursor.execute("SELECT * FROM estado_actual ORDER BY fecha_registro DESC LIMIT 1")
+            except mysql.connector.errors.ProgrammingError as err:
+                if err.errno != errorcode.ER_NO_SUCH_TABLE:
+                    raise
+                cursor.execute("SELECT * FROM lecturas_parking ORDER BY fecha_registro DESC LIMIT 1")
+            return cursor.fetchone()
+        finally:
+            cursor.close()
 
-    datos_rango = []
-    try:
-        cursor = conn.cursor(dictionary=True)
-        query = """
-            SELECT fecha_registro, temperatura_celsius, humedad_porcentaje, luz_adc 
-            FROM lecturas_parking 
-            WHERE fecha_registro BETWEEN %s AND %s 
-            ORDER BY fecha_registro ASC
-        """
-        cursor.execute(query, (start_date, end_date))
-        datos_rango = cursor.fetchall()
-    except mysql.connector.Error as err:
-        print(f"Error al leer datos por rango de fecha: {err}")
-        messagebox.showerror("Error de Base de Datos", f"Error al obtener datos para estadísticas: {err}")
-    finally:
-        if conn.is_connected():
+def obtener_buckets_temperatura(inicio_epoch, fin_epoch, paso_s):
+    """Temperatura agregada en la BD por buckets de paso_s: filas (t_epoch, min, media, max, muestras)."""
+    with conexion() as conn:
+        cursor = conn.cursor()
+        try:
+            query = """
+                SELECT FLOOR(UNIX_TIMESTAMP(fecha_registro) / %s) * %s AS bucket,
+                       MIN(temperatura_celsius), AVG(temperatura_celsius), MAX(temperatura_celsius),
+                       COUNT(temperatura_celsius)
+                FROM lecturas_parking
+                WHERE fecha_registro >= FROM_UNIXTIME(%s) AND fecha_registro < FROM_UNIXTIME(%s)
+                  AND temperatura_celsius IS NOT NULL
+                GROUP BY bucket
+                ORDER BY bucket ASC
+            """
+            cursor.execute(query, (paso_s, paso_s, inicio_epoch, fin_epoch))
+            return cursor.fetchall()
+        finally:
             cursor.close()
-            conn.close()
-    return datos_rango
 
 
-# --- Funciones de API REST (ESP32) ---
+# --- Funciones de API REST (ESP32) (hilo de fondo; los errores se propagan) ---
 def obtener_parametros_esp32():
     """Obtiene los parámetros de configuración actuales del ESP32."""
+    response = requests.get(f"{ESP32_API_URL}/status", timeout=5)
+    response.raise_for_status()
+    return response.json().get('config')
+
+def obtener_parametros_con_respaldo():
+    """Parámetros del ESP32 o, si no responde, los de la última lectura en la BD: (origen, params, error)"""
     try:
-        response = requests.get(f"{ESP32_API_URL}/status", timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        return data.get('config')
+        params = obtener_parametros_esp32()
+        if params:
+            return 'esp32', params, None
+        error_api = "respuesta sin configuración"
     except requests.exceptions.RequestException as e:
-        messagebox.showerror("Error de API", f"No se pudo obtener parámetros del ESP32: {e}")
-        return None
+        error_api = e
+    datos_db = obtener_ultimo_estado_db()
+    if datos_db and datos_db.get('config_distancia_ocupado_cm') is not None:
+        return 'bd', {
+            'distancia_ocupado_cm': datos_db.get('config_distancia_ocupado_cm', ''),
+            'umbral_luz_adc': datos_db.get('config_umbral_luz_adc', ''),
+            'temperatura_alerta_celsius': datos_db.get('config_temp_alerta_celsius', '')
+        }, error_api
+    return None, None, error_api
 
 def enviar_parametros_esp32(params):
     """Envía los nuevos parámetros de configuración al ESP32."""
-    try:
-        response = requests.post(f"{ESP32_API_URL}/config", json=params, timeout=5)
-        response.raise_for_status()
-        messagebox.showinfo("Éxito", "Parámetros actualizados en ESP32.")
-        return True
-    except requests.exceptions.RequestException as e:
-        messagebox.showerror("Error de API", f"No se pudo enviar parámetros al ESP32: {e}")
-        return False
+    response = requests.post(f"{ESP32_API_URL}/config", json=params, timeout=5)
+    response.raise_for_status()
+    return True
 
-def controlar_barrera_api(accion):
+def enviar_comando_barrera(accion):
     """Envía un comando para abrir o cerrar la barrera al ESP32."""
-    try:
-        response = requests.post(f"{ESP32_API_URL}/barrera", json={"accion": accion}, timeout=5)
-        response.raise_for_status()
+    response = requests.post(f"{ESP32_API_URL}/barrera", json={"accion": accion}, timeout=5)
+    response.raise_for_status()
+    return accion
+
+def controlar_barrera_api(accion):
+    """Botones de barrera: el comando viaja en el hilo de fondo y luego se refresca el estado."""
+    def al_terminar(_):
         messagebox.showinfo("Control Barrera", f"Comando '{accion}' enviado a la barrera.")
-        actualizar_datos_gui() 
-    except requests.exceptions.RequestException as e:
+        if not ws_conectado:
+            trabajador.sondear_ahora()
+
+    def al_fallar(e):
         messagebox.showerror("Error de API", f"No se pudo controlar la barrera: {e}")
 
+    trabajador.enviar(enviar_comando_barrera, accion, al_terminar=al_terminar, al_fallar=al_fallar)
+
 # --- Funciones de la GUI ---
-def actualizar_datos_gui():
-    """Actualiza los labels de la GUI con los datos más recientes de la BD."""
-    global lbl_temperatura_val, lbl_humedad_val, lbl_luz_val, lbl_distancia_val
-    global lbl_vehiculo_val, lbl_barrera_val, lbl_luces_val, lbl_alarma_val, lbl_db_timestamp_val
+def actualizar_datos_gui(datos):
+    """Resultado del sondeo de la BD (modo respaldo, hilo de Tk)."""
+    marcar_conexion(None)
+    if datos and not ws_conectado:
+        mostrar_estado(datos)
+
+def mostrar_estado(datos):
+    """Actualiza los labels y el canvas con un registro (hilo de Tk). No toca widgets si nada cambió."""
+    global ultimo_estado, ultima_fecha
+
+    fecha_dt = datos.get('fecha_registro')
+    if fecha_dt != ultima_fecha:
+        ultima_fecha = fecha_dt
+        if fecha_dt:
+            if isinstance(fecha_dt, datetime):
+                 lbl_db_timestamp_val.config(text=fecha_dt.strftime('%Y-%m-%d %H:%M:%S'))
+            else:
+                 lbl_db_timestamp_val.config(text=str(fecha_dt))
+        else:
+            lbl_db_timestamp_val.config(text="N/A")
 
-    datos = obtener_ultimo_estado_db()
+    estado = tuple(datos.get(campo) for campo in CAMPOS_ESTADO)
+    if estado == ultimo_estado:
+        return
+    ultimo_estado = estado
     if datos:
         lbl_temperatura_val.config(text=f"{datos.get('temperatura_celsius', 'N/A')} °C")
         lbl_humedad_val.config(text=f"{datos.get('humedad_porcentaje', 'N/A')} %")
@@ -176,45 +376,60 @@ def actualizar_datos_gui():
 
         actualizar_representacion_grafica(datos)
 
-        if datos.get('fecha_registro'):
-            fecha_dt = datos['fecha_registro']
-            if isinstance(fecha_dt, datetime):
-                 lbl_db_timestamp_val.config(text=fecha_dt.strftime('%Y-%m-%d %H:%M:%S'))
-            else:
-                 lbl_db_timestamp_val.config(text=str(fecha_dt))
-        else:
-            lbl_db_timestamp_val.config(text="N/A")
+def refrescar_fuente():
+    """Origen de los datos en un label (sin ventanas modales en cada ciclo de sondeo)."""
+    if ws_conectado:
+        lbl_conexion_val.config(text="En vivo (WebSocket)", fg="green")
+    elif error_sondeo is None:
+        lbl_conexion_val.config(text="Sondeo BD", fg="orange")
+    else:
+        lbl_conexion_val.config(text="Sin conexión", fg="red")
+
+def marcar_conexion(error):
+    global error_sondeo
+    if error == error_sondeo:
+        return
+    error_sondeo = error
+    if error is not None:
+        print(f"Error al leer de la BD (último estado): {error}")
+    refrescar_fuente()
+
+def marcar_websocket(conectado):
+    global ws_conectado
+    ws_conectado = conectado
+    refrescar_fuente()
+
+def error_sondeo_db(e):
+    marcar_conexion(str(e))
 
-    if root: 
-        root.after(3000, actualizar_datos_gui)
+def mostrar_parametros(params):
+    entry_distancia_ocupado.delete(0, tk.END)
+    entry_distancia_ocupado.insert(0, str(params.get('distancia_ocupado_cm', '')))
+
+    entry_umbral_luz.delete(0, tk.END)
+    entry_umbral_luz.insert(0, str(params.get('umbral_luz_adc', '')))
+
+    entry_umbral_temperatura.delete(0, tk.END)
+    entry_umbral_temperatura.insert(0, str(params.get('temperatura_alerta_celsius', '')))
 
 def cargar_parametros_actuales():
-    """Carga los parámetros desde el ESP32 y los muestra en las entradas."""
-    global entry_distancia_ocupado, entry_umbral_luz, entry_umbral_temperatura
-    
-    params = obtener_parametros_esp32()
-    if params:
-        entry_distancia_ocupado.delete(0, tk.END)
-        entry_distancia_ocupado.insert(0, str(params.get('distancia_ocupado_cm', '')))
-        
-        entry_umbral_luz.delete(0, tk.END)
-        entry_umbral_luz.insert(0, str(params.get('umbral_luz_adc', '')))
-        
-        entry_umbral_temperatura.delete(0, tk.END)
-        entry_umbral_temperatura.insert(0, str(params.get('temperatura_alerta_celsius', '')))
-    else:
-        messagebox.showwarning("Advertencia API", "No se pudieron cargar los parámetros del ESP32.\nIntentando cargar desde la última lectura de la BD.")
-        datos_db = obtener_ultimo_estado_db()
-        if datos_db and datos_db.get('config_distancia_ocupado_cm') is not None:
-            entry_distancia_ocupado.delete(0, tk.END)
-            entry_distancia_ocupado.insert(0, str(datos_db.get('config_distancia_ocupado_cm', '')))
-            entry_umbral_luz.delete(0, tk.END)
-            entry_umbral_luz.insert(0, str(datos_db.get('config_umbral_luz_adc', '')))
-            entry_umbral_temperatura.delete(0, tk.END)
-            entry_umbral_temperatura.insert(0, str(datos_db.get('config_temp_alerta_celsius', '')))
+    """Carga los parámetros desde el ESP32 (o la BD como respaldo) y los muestra en las entradas."""
+    def al_terminar(resultado):
+        origen, params, error_api = resultado
+        if origen == 'esp32':
+            mostrar_parametros(params)
+            return
+        messagebox.showwarning("Advertencia API", f"No se pudieron cargar los parámetros del ESP32: {error_api}\nSe usa la última lectura de la BD.")
+        if origen == 'bd':
+            mostrar_parametros(params)
         else:
             messagebox.showinfo("Información", "No hay datos de configuración previos en la BD.")
 
+    def al_fallar(e):
+        messagebox.showerror("Error", f"No se pudieron cargar los parámetros: {e}")
+
+    trabajador.enviar(obtener_parametros_con_respaldo, al_terminar=al_terminar, al_fallar=al_fallar)
+
 def guardar_parametros():
     """Toma los valores de las entradas y los envía al ESP32."""
     try:
@@ -227,11 +442,15 @@ def guardar_parametros():
             "umbral_luz_adc": umbral_luz_val,
             "temperatura_alerta_celsius": umbral_temp
         }
-        enviar_parametros_esp32(params)
     except ValueError:
         messagebox.showerror("Error de Entrada", "Por favor, ingrese valores numéricos válidos para los parámetros.")
-    except Exception as e:
-        messagebox.showerror("Error", f"Ocurrió un error al guardar parámetros: {e}")
+        return
+
+    trabajador.enviar(
+        enviar_parametros_esp32, params,
+        al_terminar=lambda _: messagebox.showinfo("Éxito", "Parámetros actualizados en ESP32."),
+        al_fallar=lambda e: messagebox.showerror("Error de API", f"No se pudo enviar parámetros al ESP32: {e}")
+    )
 
 def actualizar_representacion_grafica(datos):
     """Actualiza los elementos en el canvas según los datos."""
@@ -256,9 +475,7 @@ def actualizar_representacion_grafica(datos):
     canvas_parking.itemconfig(oval_alarma_temp, fill="red" if datos.get('alarma_temperatura_activa') else "grey")
 
 def generar_grafico_estadisticas():
-    """Obtiene datos del rango de fechas y muestra un gráfico de temperatura."""
-    global stats_canvas_widget, stats_toolbar
-
+    """Pide al hilo de fondo los datos del rango de fechas; el gráfico se dibuja al llegar."""
     fecha_inicio_str = entry_fecha_inicio.get()
     fecha_fin_str = entry_fecha_fin.get()
 
@@ -266,54 +483,99 @@ def generar_grafico_estadisticas():
         messagebox.showwarning("Entrada Requerida", "Por favor, ingrese fecha de inicio y fin.")
         return
 
-    datos_grafico = obtener_datos_rango_fecha(fecha_inicio_str, fecha_fin_str)
-
-    if not datos_grafico:
-        messagebox.showinfo("Sin Datos", "No se encontraron datos para el rango de fechas seleccionado.")
+    try:
+        inicio = datetime.strptime(fecha_inicio_str, "%Y-%m-%d")
+        fin = datetime.strptime(fecha_fin_str, "%Y-%m-%d") + timedelta(days=1)
+    except ValueError:
+        messagebox.showerror("Error de Formato", "Formato de fecha incorrecto. Use AAAA-MM-DD.")
         return
 
-    if stats_canvas_widget:
-        stats_canvas_widget.get_tk_widget().destroy()
-    if stats_toolbar:
-        stats_toolbar.destroy()
-    
-    fechas = [item['fecha_registro'] for item in datos_grafico if item['temperatura_celsius'] is not None]
-    temperaturas = [item['temperatura_celsius'] for item in datos_grafico if item['temperatura_celsius'] is not None]
+    # La BD agrupa por buckets del ancho del gráfico; lo ya consultado se reutiliza
+    ancho_px = int(stats_plot.bbox.width) if stats_plot else 600
+    trabajador.enviar(
+        serie_temperatura.obtener, inicio.timestamp(), fin.timestamp(), ancho_px,
+        al_terminar=dibujar_grafico_estadisticas,
+        al_fallar=lambda e: messagebox.showerror("Error de Base de Datos", f"Error al obtener datos para estadísticas: {e}")
+    )
 
-    if not fechas or not temperaturas:
-        messagebox.showinfo("Sin Datos Válidos", "No hay datos de temperatura válidos para graficar en el rango seleccionado.")
-        return
+def crear_grafico_estadisticas():
+    """Crea una sola vez la figura, las líneas y la barra de herramientas del gráfico."""
+    global stats_canvas_widget, stats_toolbar, stats_plot, stats_lineas
 
     fig = Figure(figsize=(6, 4), dpi=100)
-    plot = fig.add_subplot(111)
-    
-    plot.plot(fechas, temperaturas, marker='o', linestyle='-', color='blue')
-    plot.set_title('Temperatura vs. Tiempo')
-    plot.set_xlabel('Fecha y Hora')
-    plot.set_ylabel('Temperatura (°C)')
-    plot.grid(True)
+    stats_plot = fig.add_subplot(111)
+    linea_max, = stats_plot.plot([], [], linestyle='-', linewidth=0.8, color='red', alpha=0.4, label='Máx.')
+    linea_media, = stats_plot.plot([], [], linestyle='-', color='blue', label='Media')
+    linea_min, = stats_plot.plot([], [], linestyle='-', linewidth=0.8, color='teal', alpha=0.4, label='Mín.')
+    stats_lineas = (linea_min, linea_media, linea_max)
+    # Las líneas se dibujan aparte del fondo para poder actualizarlas con blitting
+    for linea in stats_lineas:
+        linea.set_animated(True)
+    stats_plot.set_title('Temperatura vs. Tiempo')
+    stats_plot.set_xlabel('Fecha y Hora')
+    stats_plot.set_ylabel('Temperatura (°C)')
+    stats_plot.grid(True)
+    stats_plot.legend(loc='upper right', fontsize='small')
+    stats_plot.xaxis_date()
+    stats_plot.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
     fig.autofmt_xdate()
-    
-    plot.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
-
 
     # Incrustar el gráfico en Tkinter
     stats_canvas_widget = FigureCanvasTkAgg(fig, master=stats_frame)
-    stats_canvas_widget.draw()
     stats_canvas_widget.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+    stats_canvas_widget.mpl_connect('draw_event', guardar_fondo_grafico)
 
     stats_toolbar = NavigationToolbar2Tk(stats_canvas_widget, stats_frame)
     stats_toolbar.update()
-    stats_canvas_widget._tkcanvas.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+    stats_canvas_widget.draw()
+
+def guardar_fondo_grafico(evento=None):
+    """Tras cada dibujo completo (rango nuevo, zoom, resize) guarda el fondo y agrega las líneas."""
+    global stats_fondo
+    stats_fondo = stats_canvas_widget.copy_from_bbox(stats_plot.bbox)
+    for linea in stats_lineas:
+        stats_plot.draw_artist(linea)
+
+def epoch_a_num(t):
+    """Epoch (s) -> fecha de matplotlib en hora local"""
+    return mdates.date2num([datetime.fromtimestamp(x) for x in t])
+
+def dibujar_grafico_estadisticas(serie):
+    """Actualiza en el mismo gráfico las líneas min/media/max del rango (hilo de Tk)."""
+    if len(serie['t']) == 0:
+        messagebox.showinfo("Sin Datos", "No se encontraron datos para el rango de fechas seleccionado.")
+        return
+    if stats_canvas_widget is None:
+        crear_grafico_estadisticas()
+
+    linea_min, linea_media, linea_max = stats_lineas
+    x = epoch_a_num(serie['t'])
+    linea_min.set_data(x, serie['minimo'])
+    linea_max.set_data(x, serie['maximo'])
+    linea_media.set_data(epoch_a_num(serie['t_media']), serie['media'])
+
+    limites = (stats_plot.get_xlim(), stats_plot.get_ylim())
+    stats_plot.relim()
+    stats_plot.autoscale_view()
+    if stats_fondo is not None and limites == (stats_plot.get_xlim(), stats_plot.get_ylim()):
+        # Mismos ejes: se restaura el fondo y se redibujan solo las líneas (blitting)
+        stats_canvas_widget.restore_region(stats_fondo)
+        for linea in stats_lineas:
+            stats_plot.draw_artist(linea)
+        stats_canvas_widget.blit(stats_plot.bbox)
+    else:
+        # Cambiaron los ejes (otro rango): dibujo completo, que también renueva el fondo
+        stats_canvas_widget.draw()
 
 
 def crear_interfaz_grafica():
     """Crea y configura la interfaz gráfica principal."""
     global root, lbl_temperatura_val, lbl_humedad_val, lbl_luz_val, lbl_distancia_val
-    global lbl_vehiculo_val, lbl_barrera_val, lbl_luces_val, lbl_alarma_val, lbl_db_timestamp_val
+    global lbl_vehiculo_val, lbl_barrera_val, lbl_luces_val, lbl_alarma_val, lbl_db_timestamp_val, lbl_conexion_val
     global entry_distancia_ocupado, entry_umbral_luz, entry_umbral_temperatura
     global canvas_parking, rect_plaza, rect_barrera, oval_luz_parking, oval_alarma_temp
     global stats_frame, entry_fecha_inicio, entry_fecha_fin # Hacer stats_frame global
+    global trabajador, suscriptor, serie_temperatura
 
     root = tk.Tk()
     root.title("Panel de Control - Parking Inteligente")
@@ -328,7 +590,7 @@ def crear_interfaz_grafica():
     left_column_frame.grid(row=0, column=0, padx=10, pady=10, sticky="ns")
 
     # --- Sección de Estado Actual ---
-    estado_frame = ttk.LabelFrame(left_column_frame, text="Estado Actual del Sistema (desde BD)", padding="10")
+    estado_frame = ttk.LabelFrame(left_column_frame, text="Estado Actual del Sistema", padding="10")
     estado_frame.pack(fill=tk.X, pady=5)
 
     ttk.Label(estado_frame, text="Temperatura:").grid(row=0, column=0, sticky="w", pady=2)
@@ -363,10 +625,14 @@ def crear_interfaz_grafica():
     lbl_alarma_val = tk.Label(estado_frame, text="Desconocido", width=15, anchor="w")
     lbl_alarma_val.grid(row=7, column=1, sticky="w", pady=2)
 
-    ttk.Label(estado_frame, text="Último Registro BD:").grid(row=8, column=0, sticky="w", pady=2)
+    ttk.Label(estado_frame, text="Última Lectura:").grid(row=8, column=0, sticky="w", pady=2)
     lbl_db_timestamp_val = ttk.Label(estado_frame, text="--", width=20, anchor="w")
     lbl_db_timestamp_val.grid(row=8, column=1, sticky="w", pady=2)
 
+    ttk.Label(estado_frame, text="Fuente de datos:").grid(row=9, column=0, sticky="w", pady=2)
+    lbl_conexion_val = tk.Label(estado_frame, text="Conectando...", fg="grey", width=15, anchor="w")
+    lbl_conexion_val.grid(row=9, column=1, sticky="w", pady=2)
+
     # --- Sección de Parámetros Configurables ---
     config_frame = ttk.LabelFrame(left_column_frame, text="Configuración de Parámetros (vía API ESP32)", padding="10")
     config_frame.pack(fill=tk.X, pady=10)
@@ -448,9 +714,22 @@ def crear_interfaz_grafica():
     main_frame.rowconfigure(0, weight=3)
     main_frame.rowconfigure(1, weight=2)
 
+    # Toda la E/S en un hilo de fondo; el hilo de Tk solo dibuja
+    serie_temperatura = SerieCacheada(obtener_buckets_temperatura)
+    trabajador = TrabajadorFondo((obtener_ultimo_estado_db, actualizar_datos_gui, error_sondeo_db))
+    trabajador.iniciar()
+    suscriptor = SuscriptorWebSocket()
+    suscriptor.iniciar()
+    root.after(GUI_POLL_COLA_MS, procesar_resultados)
+
+    def cerrar():
+        suscriptor.detener()
+        trabajador.detener()
+        root.destroy()
+    root.protocol("WM_DELETE_WINDOW", cerrar)
+
     # Cargar datos iniciales
     cargar_parametros_actuales() # Carga los parámetros del ESP32 al iniciar
-    actualizar_datos_gui()
 
     root.mainloop()
 
@@ -0,0 +1,192 @@
+# fog-layer/ingesta_tcp.py
+"""
+Servidor de ingesta TCP para los ESP32 con el protocolo antiguo: una lectura
+JSON por línea sobre una conexión persistente.
+
+Atiende muchas conexiones concurrentes con asyncio, separa las lecturas por
+salto de línea (aunque lleguen varias en el mismo paquete o una repartida en
+varios) y las inserta en MySQL por lotes con executemany sobre un pool de
+conexiones. Con TCP_PIPELINE=true cada línea entra además al pipeline del
+gateway MQTT (QC, InfluxDB, Azure y alertas).
+"""
+
+import os
+import json
+import time
+import queue
+import signal
+import asyncio
+
+from dotenv import load_dotenv
+
+from services.log_config import configurar_logging, obtener_logger
+from services.metrics import registro, iniciar_servidor_metricas
+from services.mysql_store import EscritorMySQL, fila_lectura, MYSQL_LOTE, MYSQL_FLUSH_MS
+
+load_dotenv()
+
+log = obtener_logger("transwatch.tcp")
+
+HOST = os.getenv('TCP_HOST', '0.0.0.0')
+PORT = int(os.getenv('TCP_PORT', '8888'))
+# Longitud máxima de una línea; una más larga cierra la conexión (cliente defectuoso)
+TCP_MAX_LINEA = int(os.getenv('TCP_MAX_LINEA', '65536'))
+# Conexión sin datos durante este tiempo se cierra (0 = sin límite)
+TCP_INACTIVIDAD_S = float(os.getenv('TCP_INACTIVIDAD_S', '300'))
+# Destinos de cada lectura
+TCP_MYSQL = os.getenv('TCP_MYSQL', 'true').lower() in ('1', 'true', 'si', 'yes')
+TCP_PIPELINE = os.getenv('TCP_PIPELINE', 'false').lower() in ('1', 'true', 'si', 'yes')
+
+LINEAS_TCP = registro.contador('transwatch_tcp_lineas_total', 'Líneas TCP recibidas por resultado', etiqueta='resultado')
+BYTES_TCP = registro.contador('transwatch_tcp_bytes_total', 'Bytes de lecturas TCP recibidos')
+
+
+class ServidorIngestaTCP:
+    """Servidor asyncio de lecturas por línea; el trabajo pesado ocurre en los hilos de los lotes"""
+
+    def __init__(self, escritor=None, pipeline=None, host=HOST, port=PORT,
+                 max_linea=TCP_MAX_LINEA, inactividad_s=TCP_INACTIVIDAD_S):
+        self.escritor = escritor      # EscritorMySQL o None
+        self.pipeline = pipeline      # MicroBatcher de data_collector o None
+        self.host = host
+        self.port = port
+        self.max_linea = max_linea
+        self.inactividad_s = inactividad_s or None
+        self.conexiones = set()
+        self._servidor = None
+        registro.gauge('transwatch_tcp_conexiones', 'Conexiones TCP abiertas', lambda: len(self.conexiones))
+
+    async def iniciar(self):
+        self._servidor = await asyncio.start_server(
+            self._atender, self.host, self.port, limit=self.max_linea
+        )
+        log.info("Servidor TCP escuchando en %s:%s", self.host, self.port)
+        return self._servidor
+
+    async def detener(self):
+        if self._servidor:
+            self._servidor.close()
+            await self._servidor.wait_closed()
+        for escritor in list(self.conexiones):
+            escritor.close()
+
+    async def _atender(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        origen = f"{peer[0]}:{peer[1]}" if peer else "desconocido"
+        topico = f"tcp/{origen}"
+        self.conexiones.add(writer)
+        log.info("Conectado %s", origen)
+        try:
+            while True:
+                try:
+                    linea = await asyncio.wait_for(reader.readuntil(b'\n'), self.inactividad_s)
+                except asyncio.IncompleteReadError as e:
+                    # Fin de la conexión: procesar el resto si quedó una lectura sin salto de línea
+                    if e.partial.strip():
+                        await self._procesar_linea(e.partial, topico)
+                    break
+                except asyncio.LimitOverrunError:
+                    LINEAS_TCP.inc(etiqueta='demasiado_larga')
+                    log.warning("Línea de más de %d bytes desde %s; se cierra la conexión", self.max_linea, origen)
+                    break
+                except asyncio.TimeoutError:
+                    log.info("Conexión %s inactiva por %.0f s; se cierra", origen, self.inactividad_s)
+                    break
+                await self._procesar_linea(linea, topico)
+        except (ConnectionResetError, BrokenPipeError):
+            log.info("Conexión cerrada por el cliente %s", origen)
+        finally:
+            self.conexiones.discard(writer)
+            writer.close()
+
+    async def _procesar_linea(self, linea, topico):
+        linea = linea.strip()
+        if not linea:
+            return
+        BYTES_TCP.inc(len(linea))
+        recibido = time.time()
+
+        if self.escritor is not None:
+            try:
+                datos = json.loads(linea)
+                if not isinstance(datos, dict):
+                    raise ValueError("se esperaba un objeto JSON")
+            except ValueError as e:
+                LINEAS_TCP.inc(etiqueta='invalida')
+                log.warning("JSON inválido desde %s: %s", topico, e, extra={'payload': linea[:200]})
+                return
+            await self._encolar(self.escritor, fila_lectura(datos))
+
+        if self.pipeline is not None:
+            # El pipeline decodifica y valida la lectura por su cuenta (rechazos en transwatch_lecturas_total)
+            await self._encolar(self.pipeline, (linea, topico, recibido))
+        LINEAS_TCP.inc(etiqueta='aceptada')
+
+    @staticmethod
+    async def _encolar(destino, item):
+        """Encola sin bloquear el loop; con la cola llena se espera en un hilo y se deja de leer ese socket"""
+        try:
+            destino.cola.put_nowait(item)
+        except queue.Full:
+            await asyncio.to_thread(destino.cola.put, item)
+
+
+def crear_pipeline():
+    """Pipeline del gateway MQTT (QC, InfluxDB, Azure, alertas) alimentado por líneas TCP"""
+    import data_collector as dc
+    from services.ingest_batcher import MicroBatcher
+
+    dc.iniciar_conexion_azure()
+    dc.iniciar_snapshots("ingesta-tcp", alertas=False)
+    dc.micro_batcher = MicroBatcher(dc.procesar_lote, dc.MQTT_BATCH_SIZE, dc.MQTT_BATCH_MS)
+    dc.iniciar_carriles()
+    dc.micro_batcher.iniciar()
+    if dc.monitor_vivacidad is not None:
+        dc.monitor_vivacidad.iniciar()
+    return dc
+
+
+async def ejecutar():
+    escritor = None
+    dc = None
+    if TCP_MYSQL:
+        escritor = EscritorMySQL()
+        log.info("Inserción MySQL por lotes: %s filas / %s ms", MYSQL_LOTE, MYSQL_FLUSH_MS)
+    if TCP_PIPELINE:
+        dc = crear_pipeline()
+        log.info("Lecturas TCP enviadas también al pipeline de QC/InfluxDB")
+
+    servidor = ServidorIngestaTCP(escritor, dc.micro_batcher if dc else None)
+    await servidor.iniciar()
+
+    parada = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(senal, parada.set)
+        except NotImplementedError:
+            pass  # Windows: se detiene con KeyboardInterrupt
+    try:
+        await parada.wait()
+    finally:
+        log.info("Deteniendo el servidor TCP...")
+        await servidor.detener()
+        # Vaciar lo pendiente antes de salir
+        if escritor:
+            await asyncio.to_thread(escritor.detener)
+        if dc:
+            await asyncio.to_thread(dc.micro_batcher.detener)
+            await asyncio.to_thread(dc.detener_carriles)
+            if dc.monitor_vivacidad is not None:
+                dc.monitor_vivacidad.detener()
+            dc.snapshots.detener()
+            dc.notification_engine.alert_store.detener()
+
+
+if __name__ == "__main__":
+    configurar_logging()
+    iniciar_servidor_metricas()
+    try:
+        asyncio.run(ejecutar())
+    except KeyboardInterrupt:
+        pass
@@ -1,70 +1,287 @@
+import os
+import math
+import time
+
+
+def _parsear_por_sensor(texto):
+    """"campo=valor,campo=valor" -> {campo: float}"""
+    valores = {}
+    for par in texto.split(','):
+        if par.strip():
+            campo, _, valor = par.partition('=')
+            valores[campo.strip()] = float(valor)
+    return valores
+
+
+def _parsear_detectores(texto):
+    return frozenset(d.strip() for d in texto.replace('+', ',').split(',') if d.strip())
+
+
+def _parsear_por_dispositivo(texto):
+    """"device=det1,det2;device2=det1" -> {device_id: frozenset}"""
+    por_dispositivo = {}
+    for entrada in texto.split(';'):
+        if entrada.strip():
+            device_id, _, detectores = entrada.partition('=')
+            por_dispositivo[device_id.strip()] = _parsear_detectores(detectores)
+    return por_dispositivo
+
+
+DETECTORES = ('zscore', 'congelado', 'tasa', 'humedad_temperatura', 'distancia_vehiculo')
+
+# Detectores activos por defecto y por dispositivo ("ESP32-A=zscore,tasa;ESP32-B=zscore")
+QC_DETECTORES = _parsear_detectores(os.getenv('QC_DETECTORES', ','.join(DETECTORES)))
+QC_DETECTORES_DISPOSITIVO = _parsear_por_dispositivo(os.getenv('QC_DETECTORES_DISPOSITIVO', ''))
+# Sensor congelado: segundos sin moverse ni un paso de resolución. El DHT11 entrega enteros
+# y en un estacionamiento tranquilo puede repetir el mismo valor durante horas, así que el
+# plazo se mide en tiempo y no en lecturas. La distancia queda fuera por defecto: sin
+# vehículo el ultrasónico repite el mismo valor
+QC_CONGELADO_SEGUNDOS = _parsear_por_sensor(
+    os.getenv('QC_CONGELADO_SEGUNDOS', 'temperatura_celsius=43200,humedad_porcentaje=43200,luz_adc=14400')
+)
+# Resolución de cada sensor: un cambio menor a un paso no cuenta como movimiento
+QC_RESOLUCION = _parsear_por_sensor(
+    os.getenv('QC_RESOLUCION', 'temperatura_celsius=1,humedad_porcentaje=1,luz_adc=1,distancia_cm=1')
+)
+# Lecturas mínimas dentro del plazo (un dispositivo que vuelve tras horas apagado no está congelado)
+QC_CONGELADO_MIN_LECTURAS = int(os.getenv('QC_CONGELADO_MIN_LECTURAS', '30'))
+# Cambio máximo por segundo respecto al último valor aceptado. Luz y distancia cambian
+# de golpe legítimamente (luces, vehículos), así que no se limitan por defecto
+QC_TASA_MAX = _parsear_por_sensor(os.getenv('QC_TASA_MAX', 'temperatura_celsius=2,humedad_porcentaje=10'))
+# Salto máximo de humedad absoluta (g/m³) entre lecturas: la humedad relativa puede variar
+# con la temperatura, pero el agua contenida en el aire cambia despacio
+QC_SALTO_HUMEDAD_ABS = float(os.getenv('QC_SALTO_HUMEDAD_ABS', '3'))
+# El firmware marca vehículo cuando 0 < distancia <= umbral (distancia_ocupado_cm)
+QC_DISTANCIA_OCUPADO_CM = float(os.getenv('QC_DISTANCIA_OCUPADO_CM', '15'))
+QC_DISTANCIA_MARGEN_CM = float(os.getenv('QC_DISTANCIA_MARGEN_CM', '5'))
+# Lecturas inconsistentes seguidas antes de marcar la distancia / de aceptar una nueva referencia de humedad
+QC_INCONSISTENCIA_LECTURAS = int(os.getenv('QC_INCONSISTENCIA_LECTURAS', '3'))
+
+
+def detectores_para(device_id):
+    """Detectores del dispositivo: su entrada en QC_DETECTORES_DISPOSITIVO o los de QC_DETECTORES"""
+    return QC_DETECTORES_DISPOSITIVO.get(device_id, QC_DETECTORES)
+
+
+def humedad_absoluta(temperatura, humedad_relativa):
+    """g/m³ de vapor de agua (fórmula de Magnus)"""
+    presion_saturacion = 6.112 * math.exp(17.62 * temperatura / (243.12 + temperatura))
+    return 216.7 * (humedad_relativa / 100.0 * presion_saturacion) / (273.15 + temperatura)
+
+
+class _EstadoSensor:
+    # Estado incremental compartido por los detectores de un sensor
+    __slots__ = ('repetido', 'desde', 'repeticiones', 'ultimo_aceptado', 'ts_aceptado')
+
+    def __init__(self):
+        self.repetido = None
+        self.desde = None
+        self.repeticiones = 0
+        self.ultimo_aceptado = None
+        self.ts_aceptado = None
+
+
 class SimpleQualityControl:
-    def __init__(self, window_size=10, z_threshold=2.5):
+    SENSORES_CRITICOS = ('temperatura_celsius', 'humedad_porcentaje')
+
+    def __init__(self, window_size=10, z_threshold=2.5, detectores=None):
         self.window_size = window_size
         self.z_threshold = z_threshold
+        self.detectores = frozenset(detectores) if detectores is not None else QC_DETECTORES
+        desconocidos = self.detectores.difference(DETECTORES)
+        if desconocidos:
+            raise ValueError(f"Detectores de QC desconocidos: {', '.join(sorted(desconocidos))}")
         self.sensor_data = {
-            'temperatura_celsius': [],      
-            'humedad_porcentaje': [],           
-            'luz_adc': [],          
-            'distancia_cm': []      
+            'temperatura_celsius': [],
+            'humedad_porcentaje': [],
+            'luz_adc': [],
+            'distancia_cm': []
         }
+        self._estado = {sensor: _EstadoSensor() for sensor in self.sensor_data}
+        self._humedad_abs = None
+        self._saltos_humedad = 0
+        self._inconsistencias_distancia = 0
 
-    def aplicar_qc(self, datos):
+    def aplicar_qc(self, datos, ts=None):
+        ts = ts if ts is not None else time.time()
         resultados = {}
 
         for sensor, valor in datos.items():
             if sensor not in self.sensor_data:
                 continue
+            resultados[sensor] = self._evaluar_sensor(sensor, valor, ts)
+
+        self._evaluar_cruzados(resultados, datos.get)
+        self._aceptar(resultados, datos.get, ts)
+
+        # Verificar que temperatura y humedad sean válidos
+        todos_aprobados = all(
+            resultados.get(s, {}).get('aprobado', True)
+            for s in self.SENSORES_CRITICOS if s in datos
+        )
+
+        return {
+            'todos_aprobados': todos_aprobados,
+            'resultados': resultados
+        }
+
+    def aplicar_qc_lectura(self, lectura, ts=None):
+        """Igual que aplicar_qc pero leyendo los atributos de una Lectura (sin dict intermedio)"""
+        ts = ts if ts is not None else time.time()
+        resultados = {}
+
+        for sensor in self.sensor_data:
+            resultados[sensor] = self._evaluar_sensor(sensor, getattr(lectura, sensor), ts)
+
+        self._evaluar_cruzados(resultados, lectura.get)
+        self._aceptar(resultados, lectura.get, ts)
+
+        todos_aprobados = all(resultados[s]['aprobado'] for s in self.SENSORES_CRITICOS)
 
-            # Manejar valores None/nulos
-            if valor is None:
-                resultados[sensor] = {
+        return {
+            'todos_aprobados': todos_aprobados,
+            'resultados': resultados
+        }
+
+    def exportar_ventanas(self):
+        """Copia de las ventanas y del estado de los detectores para el snapshot de arranque en caliente"""
+        return {
+            'ventanas': {sensor: list(ventana) for sensor, ventana in self.sensor_data.items()},
+            'estado': {sensor: tuple(getattr(e, campo) for campo in _EstadoSensor.__slots__)
+                       for sensor, e in self._estado.items()},
+            'cruzados': (self._humedad_abs, self._saltos_humedad, self._inconsistencias_distancia)
+        }
+
+    def restaurar_ventanas(self, estado):
+        # Snapshots anteriores: solo {sensor: ventana}
+        ventanas = estado.get('ventanas', estado)
+        for sensor, valores in ventanas.items():
+            if sensor in self.sensor_data:
+                self.sensor_data[sensor] = list(valores)[-self.window_size:]
+        for sensor, valores in estado.get('estado', {}).items():
+            if sensor in self._estado:
+                for campo, valor in zip(_EstadoSensor.__slots__, valores):
+                    setattr(self._estado[sensor], campo, valor)
+        if 'cruzados' in estado:
+            self._humedad_abs, self._saltos_humedad, self._inconsistencias_distancia = estado['cruzados']
+
+    def _evaluar_sensor(self, sensor, valor, ts):
+        # Manejar valores None/nulos
+        if valor is None:
+            return {
+                'aprobado': False,
+                'razon': 'Valor nulo'
+            }
+
+        estado = self._estado[sensor]
+
+        # Sensor congelado: con la ventana constante el z-score es 0 y nunca fallaría
+        limite = QC_CONGELADO_SEGUNDOS.get(sensor)
+        if 'congelado' in self.detectores and limite:
+            if estado.repetido is not None and abs(valor - estado.repetido) < QC_RESOLUCION.get(sensor, 0.0):
+                estado.repeticiones += 1
+            else:
+                estado.repetido = valor
+                estado.desde = ts
+                estado.repeticiones = 1
+            quieto = ts - estado.desde
+            if quieto >= limite and estado.repeticiones >= QC_CONGELADO_MIN_LECTURAS:
+                return {
                     'aprobado': False,
-                    'razon': 'Valor nulo'
+                    'razon': f'Sensor congelado (sin cambios desde hace {quieto / 3600:.1f} h, '
+                             f'{estado.repeticiones} lecturas)'
                 }
-                continue
-
-            ventana = self.sensor_data[sensor]
 
-            # Si no hay suficientes datos, aceptar el valor
-            if len(ventana) < 5:
-                ventana.append(valor)
-                resultados[sensor] = {
-                    'aprobado': True,
-                    'razon': 'Datos insuficientes para validación'
+        # Tasa de cambio respecto al último valor aceptado (dt mínimo de 1 s para ráfagas)
+        tasa_max = QC_TASA_MAX.get(sensor)
+        if 'tasa' in self.detectores and tasa_max and estado.ultimo_aceptado is not None:
+            tasa = abs(valor - estado.ultimo_aceptado) / max(ts - estado.ts_aceptado, 1.0)
+            if tasa > tasa_max:
+                return {
+                    'aprobado': False,
+                    'razon': f'Cambio demasiado rápido ({tasa:.2f}/s, máximo {tasa_max:g}/s)'
                 }
-                continue
 
-            # Calcular media y desviación estándar
-            promedio = sum(ventana) / len(ventana)
-            desviacion = (sum((x - promedio) ** 2 for x in ventana) / len(ventana)) ** 0.5
+        if 'zscore' not in self.detectores:
+            return {
+                'aprobado': True,
+                'razon': 'Dentro del rango normal'
+            }
 
-            # Calcular z-score
-            z = 0 if desviacion == 0 else abs(valor - promedio) / desviacion
-            aprobado = z <= self.z_threshold
+        ventana = self.sensor_data[sensor]
 
-            resultados[sensor] = {
-                'aprobado': aprobado,
-                'razon': 'Dentro del rango normal' if aprobado else f'Valor atípico (z={z:.2f})',
-                'promedio': round(promedio, 2),
-                'desviacion': round(desviacion, 2),
-                'z_score': round(z, 2)
+        # Si no hay suficientes datos, aceptar el valor
+        if len(ventana) < 5:
+            return {
+                'aprobado': True,
+                'razon': 'Datos insuficientes para validación'
             }
 
-            # Solo agregar a la ventana si es válido
-            if aprobado:
-                if len(ventana) >= self.window_size:
-                    ventana.pop(0)
-                ventana.append(valor)
+        # Calcular media y desviación estándar
+        promedio = sum(ventana) / len(ventana)
+        desviacion = (sum((x - promedio) ** 2 for x in ventana) / len(ventana)) ** 0.5
 
-        # Verificar que temperatura y humedad sean válidos
-        sensores_criticos = ['temperatura_celsius', 'humedad_porcentaje']
-        todos_aprobados = all(
-            resultados.get(s, {}).get('aprobado', True)
-            for s in sensores_criticos if s in datos
-        )
+        # Calcular z-score. La desviación no baja de la resolución del sensor: con el DHT11
+        # (grados enteros) una ventana estable tiene desviación ~0 y un paso real de 1 °C
+        # quedaría fuera para siempre, porque solo los valores aceptados entran a la ventana
+        escala = max(desviacion, QC_RESOLUCION.get(sensor, 0.0))
+        z = 0 if escala == 0 else abs(valor - promedio) / escala
+        aprobado = z <= self.z_threshold
 
         return {
-            'todos_aprobados': todos_aprobados,
-            'resultados': resultados
+            'aprobado': aprobado,
+            'razon': 'Dentro del rango normal' if aprobado else f'Valor atípico (z={z:.2f})',
+            'promedio': round(promedio, 2),
+            'desviacion': round(desviacion, 2),
+            'z_score': round(z, 2)
         }
+
+    def _evaluar_cruzados(self, resultados, valor):
+        """Consistencia entre sensores; marca como fallidos los sensores involucrados"""
+        temperatura = resultados.get('temperatura_celsius')
+        humedad = resultados.get('humedad_porcentaje')
+        if ('humedad_temperatura' in self.detectores and temperatura and humedad
+                and temperatura['aprobado'] and humedad['aprobado']):
+            actual = humedad_absoluta(valor('temperatura_celsius'), valor('humedad_porcentaje'))
+            salto = 0.0 if self._humedad_abs is None else abs(actual - self._humedad_abs)
+            if salto > QC_SALTO_HUMEDAD_ABS and self._saltos_humedad + 1 < QC_INCONSISTENCIA_LECTURAS:
+                self._saltos_humedad += 1
+                fallo = {
+                    'aprobado': False,
+                    'razon': f'Humedad y temperatura inconsistentes (salto de {salto:.1f} g/m³)'
+                }
+                resultados['temperatura_celsius'] = resultados['humedad_porcentaje'] = fallo
+            else:
+                # Consistente, o el cambio persiste: se acepta como nueva referencia
+                self._humedad_abs = actual
+                self._saltos_humedad = 0
+
+        distancia = valor('distancia_cm')
+        if 'distancia_vehiculo' in self.detectores and distancia is not None and 'distancia_cm' in resultados:
+            vehiculo = bool(valor('vehiculo_en_entrada_detectado'))
+            inconsistente = (
+                (vehiculo and distancia > QC_DISTANCIA_OCUPADO_CM + QC_DISTANCIA_MARGEN_CM)
+                or (not vehiculo and 0 < distancia < QC_DISTANCIA_OCUPADO_CM - QC_DISTANCIA_MARGEN_CM)
+            )
+            # El firmware puede tardar una lectura en actualizar la bandera: solo si persiste
+            self._inconsistencias_distancia = self._inconsistencias_distancia + 1 if inconsistente else 0
+            if self._inconsistencias_distancia >= QC_INCONSISTENCIA_LECTURAS:
+                resultados['distancia_cm'] = {
+                    'aprobado': False,
+                    'razon': f'Distancia {distancia} cm inconsistente con vehiculo_en_entrada_detectado={vehiculo}'
+                }
+
+    def _aceptar(self, resultados, valor, ts):
+        # Solo los valores aprobados entran a la ventana y a la referencia de tasa
+        for sensor, resultado in resultados.items():
+            if not resultado['aprobado']:
+                continue
+            actual = valor(sensor)
+            if 'zscore' in self.detectores:
+                ventana = self.sensor_data[sensor]
+                if len(ventana) >= self.window_size:
+                    ventana.pop(0)
+                ventana.append(actual)
+            estado = self._estado[sensor]
+            estado.ultimo_aceptado = actual
+            estado.ts_aceptado = ts
@@ -0,0 +1,141 @@
+# fog-layer/services/alert_store.py
+
+import os
+import time
+import threading
+
+from services.ingest_batcher import MicroBatcher
+from services.log_config import obtener_logger
+from services.metrics import LATENCIA_ETAPA
+from services.tsdb_manager import TimeSeriesManager, INTERVALO_RE, UNIDADES_INTERVALO
+
+log = obtener_logger("transwatch.alertas")
+
+# Measurement propio de las alertas (antes se escribían como 'sensor_reading' de device "ALERT")
+ALERTAS_MEASUREMENT = os.getenv('ALERTAS_MEASUREMENT', 'alerta')
+# Escritura por lotes: N alertas o T ms, lo que ocurra primero
+ALERTAS_LOTE = int(os.getenv('ALERTAS_LOTE', '100'))
+ALERTAS_FLUSH_MS = int(os.getenv('ALERTAS_FLUSH_MS', '1000'))
+
+
+class AlertStore:
+    """
+    Almacén de alertas en InfluxDB: measurement 'alerta' con tags tipo,
+    prioridad y device_id, y campos mensaje y la temperatura que la disparó.
+    Las alertas se encolan y se escriben por lotes en un hilo propio, que
+    arranca con la primera alerta: construir el almacén (p. ej. al importar
+    data_collector o api_async) no inicia hilos.
+    """
+
+    def __init__(self, tsdb=None, max_lote=ALERTAS_LOTE, flush_ms=ALERTAS_FLUSH_MS):
+        self.tsdb = tsdb or TimeSeriesManager()
+        self._batcher = MicroBatcher(self._escribir_lote, max_lote, flush_ms)
+        self._iniciado = False
+        self._lock = threading.Lock()
+
+    def _iniciar_batcher(self):
+        with self._lock:
+            if not self._iniciado:
+                self._batcher.iniciar()
+                self._iniciado = True
+
+    @staticmethod
+    def construir_punto(alerta, timestamp=None):
+        datos = alerta.get("data") or {}
+        campos = {"mensaje": str(alerta.get("message", ""))}
+        temperatura = datos.get("temperatura_celsius")
+        if isinstance(temperatura, (int, float)) and not isinstance(temperatura, bool):
+            campos["temperatura_celsius"] = float(temperatura)
+        return {
+            "measurement": ALERTAS_MEASUREMENT,
+            "tags": {
+                "tipo": alerta.get("type", "unknown"),
+                "prioridad": alerta.get("priority", "low"),
+                "device_id": datos.get("device_id") or "desconocido"
+            },
+            "fields": campos,
+            "time": int((timestamp if timestamp is not None else time.time()) * 1000)
+        }
+
+    def registrar(self, alerta, timestamp=None):
+        """Encola la alerta para la próxima escritura por lote (no bloquea al loop async)"""
+        if not self._iniciado:
+            self._iniciar_batcher()
+        self._batcher.agregar(self.construir_punto(alerta, timestamp))
+
+    def _escribir_lote(self, puntos):
+        if not self.tsdb.client:
+            log.warning("Cliente InfluxDB no inicializado; se descartan %d alertas", len(puntos))
+            return
+        try:
+            with LATENCIA_ETAPA.medir('almacenar_alertas'):
+                self.tsdb.client.write(record=puntos, write_precision="ms")
+            log.debug("Lote de %d alertas almacenado", len(puntos))
+        except Exception as e:
+            log.error("Error almacenando alertas en InfluxDB: %s", e)
+
+    def detener(self):
+        """Escribe las alertas pendientes y detiene el hilo (si llegó a iniciarse)"""
+        with self._lock:
+            if self._iniciado:
+                self._batcher.detener()
+                self._iniciado = False
+
+    # --- Consultas ---
+    def consultar_historial(self, fecha_inicio, fecha_fin, tipo=None, prioridad=None, device_id=None, limite=500):
+        """Alertas del rango, más recientes primero"""
+        if not self.tsdb.client:
+            return []
+        limite = max(1, min(int(limite), 10000))
+        parametros = {"inicio": fecha_inicio, "fin": fecha_fin}
+        filtros = ""
+        for nombre, valor in (("tipo", tipo), ("prioridad", prioridad), ("device_id", device_id)):
+            if valor:
+                parametros[nombre] = valor
+                filtros += f' AND "{nombre}" = ${nombre}'
+
+        query = f"""
+            SELECT time, tipo, prioridad, device_id, mensaje, temperatura_celsius
+            FROM "{ALERTAS_MEASUREMENT}"
+            WHERE time >= $inicio AND time <= $fin{filtros}
+            ORDER BY time DESC
+            LIMIT {limite}
+        """
+        try:
+            df = self.tsdb.client.query(query=query, mode="pandas", query_parameters=parametros)
+            if df.empty:
+                return []
+            df['time'] = df['time'].astype(str)
+            return df.astype(object).where(df.notna(), None).to_dict('records')
+        except Exception as e:
+            log.error("Error consultando historial de alertas: %s", e)
+            return []
+
+    def conteo_por_tipo(self, fecha_inicio, fecha_fin, intervalo="1h"):
+        """Cantidad de alertas por tipo y prioridad en buckets de `intervalo` (línea de tiempo)"""
+        if not self.tsdb.client:
+            return []
+        coincidencia = INTERVALO_RE.match(intervalo)
+        if not coincidencia:
+            raise ValueError(f"Intervalo inválido: {intervalo!r} (ej. 5m, 1h, 1d)")
+        cantidad, unidad = coincidencia.groups()
+
+        query = f"""
+            SELECT date_bin(INTERVAL '{cantidad} {UNIDADES_INTERVALO[unidad]}', time) AS bucket,
+                   tipo, prioridad, count(*) AS conteo
+            FROM "{ALERTAS_MEASUREMENT}"
+            WHERE time >= $inicio AND time <= $fin
+            GROUP BY 1, tipo, prioridad
+            ORDER BY 1 ASC
+        """
+        try:
+            df = self.tsdb.client.query(
+                query=query, mode="pandas", query_parameters={"inicio": fecha_inicio, "fin": fecha_fin}
+            )
+            if df.empty:
+                return []
+            df['bucket'] = df['bucket'].astype(str)
+            return df.to_dict('records')
+        except Exception as e:
+            log.error("Error contando alertas: %s", e)
+            return []
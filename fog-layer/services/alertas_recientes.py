@@ -0,0 +1,172 @@
+# fog-layer/services/alertas_recientes.py
+
+import os
+import time
+import calendar
+import threading
+from collections import deque
+
+from services.log_config import obtener_logger
+
+log = obtener_logger("transwatch.alertas")
+
+# Alertas conservadas por (dispositivo, prioridad)
+ALERTAS_RECIENTES_MAX = int(os.getenv('ALERTAS_RECIENTES_MAX', '50'))
+# Cuántas alertas críticas recientes recibe un cliente al conectarse
+ALERTAS_RESUMEN_CRITICAS = int(os.getenv('ALERTAS_RESUMEN_CRITICAS', '10'))
+# Ventana de los conteos por tipo del resumen
+ALERTAS_VENTANA_H = float(os.getenv('ALERTAS_VENTANA_H', '24'))
+
+PRIORIDADES_CRITICAS = ('critical', 'high')
+_BUCKET_S = 60
+
+
+class _ConteoVentana:
+    """Conteo deslizante con buckets de 1 minuto: O(1) amortizado por evento"""
+
+    __slots__ = ('buckets', 'total')
+
+    def __init__(self):
+        self.buckets = deque()  # [inicio_bucket, conteo]
+        self.total = 0
+
+    def sumar(self, ts):
+        bucket = int(ts // _BUCKET_S) * _BUCKET_S
+        if self.buckets and self.buckets[-1][0] == bucket:
+            self.buckets[-1][1] += 1
+        elif self.buckets and bucket < self.buckets[-1][0]:
+            # Alerta con timestamp anterior (precarga desordenada): cuenta en el bucket más reciente
+            self.buckets[-1][1] += 1
+        else:
+            self.buckets.append([bucket, 1])
+        self.total += 1
+
+    def expirar(self, limite):
+        while self.buckets and self.buckets[0][0] < limite:
+            self.total -= self.buckets.popleft()[1]
+
+
+class RegistroAlertasRecientes:
+    """
+    Registro en memoria, acotado e indexado por tiempo, de las alertas recientes
+    por dispositivo y prioridad. Alimenta el resumen que recibe cada cliente
+    WebSocket al conectarse, sin consultar la base de datos por conexión.
+    """
+
+    def __init__(self, max_por_clave=ALERTAS_RECIENTES_MAX, max_criticas=ALERTAS_RESUMEN_CRITICAS,
+                 ventana_h=ALERTAS_VENTANA_H):
+        self.max_por_clave = max_por_clave
+        self.ventana_s = ventana_h * 3600
+        self._por_clave = {}                      # (device_id, prioridad) -> deque de alertas
+        self._criticas = deque(maxlen=max_criticas)
+        self._conteos = {}                        # tipo -> _ConteoVentana
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def compactar(alerta, ts=None):
+        """Forma compacta (sin la lectura completa) para el resumen y las consultas"""
+        datos = alerta.get('data') or {}
+        return {
+            'type': alerta.get('type', 'unknown'),
+            'message': alerta.get('message', ''),
+            'priority': alerta.get('priority', 'low'),
+            'device_id': alerta.get('device_id') or datos.get('device_id') or 'desconocido',
+            'timestamp': ts if ts is not None else alerta.get('timestamp', time.time())
+        }
+
+    def registrar(self, alerta, ts=None):
+        compacta = self.compactar(alerta, ts)
+        clave = (compacta['device_id'], compacta['priority'])
+        with self._lock:
+            cola = self._por_clave.get(clave)
+            if cola is None:
+                cola = self._por_clave[clave] = deque(maxlen=self.max_por_clave)
+            cola.append(compacta)
+            if compacta['priority'] in PRIORIDADES_CRITICAS:
+                self._criticas.append(compacta)
+            conteo = self._conteos.get(compacta['type'])
+            if conteo is None:
+                conteo = self._conteos[compacta['type']] = _ConteoVentana()
+            conteo.sumar(compacta['timestamp'])
+
+    def recientes(self, device_id=None, prioridad=None, desde=None):
+        """Alertas en memoria filtradas, más recientes primero"""
+        with self._lock:
+            seleccion = [
+                alerta
+                for (dispositivo, prio), cola in self._por_clave.items()
+                if (device_id is None or dispositivo == device_id) and (prioridad is None or prio == prioridad)
+                for alerta in cola
+                if desde is None or alerta['timestamp'] >= desde
+            ]
+        seleccion.sort(key=lambda a: a['timestamp'], reverse=True)
+        return seleccion
+
+    def resumen(self, ahora=None):
+        """Conteos por tipo en la ventana y las últimas alertas críticas (para el frame inicial)"""
+        ahora = ahora if ahora is not None else time.time()
+        with self._lock:
+            conteos = {}
+            for tipo, conteo in self._conteos.items():
+                conteo.expirar(ahora - self.ventana_s)
+                if conteo.total:
+                    conteos[tipo] = conteo.total
+            criticas = list(reversed(self._criticas))
+        return {
+            'ventana_h': self.ventana_s / 3600,
+            'conteos': conteos,
+            'ultimas_criticas': criticas
+        }
+
+    def exportar(self):
+        """Contenido del registro en tipos básicos (snapshot de arranque en caliente)"""
+        with self._lock:
+            return {
+                'por_clave': [(clave, list(cola)) for clave, cola in self._por_clave.items()],
+                'criticas': list(self._criticas),
+                'conteos': {tipo: [list(b) for b in c.buckets] for tipo, c in self._conteos.items()}
+            }
+
+    def restaurar(self, estado):
+        with self._lock:
+            self._por_clave = {
+                tuple(clave): deque(alertas, maxlen=self.max_por_clave) for clave, alertas in estado['por_clave']
+            }
+            self._criticas = deque(estado['criticas'], maxlen=self._criticas.maxlen)
+            self._conteos = {}
+            for tipo, buckets in estado['conteos'].items():
+                conteo = self._conteos[tipo] = _ConteoVentana()
+                conteo.buckets.extend([inicio, n] for inicio, n in buckets)
+                conteo.total = sum(n for _, n in buckets)
+
+    def precargar(self, alert_store, horas=None):
+        """Llena el registro desde el AlertStore (al iniciar el servidor WebSocket)"""
+        horas = horas if horas is not None else self.ventana_s / 3600
+        fin = time.time()
+        inicio = fin - horas * 3600
+        formato = '%Y-%m-%dT%H:%M:%SZ'
+        filas = alert_store.consultar_historial(
+            time.strftime(formato, time.gmtime(inicio)), time.strftime(formato, time.gmtime(fin)),
+            limite=10000
+        )
+        # consultar_historial devuelve las más recientes primero
+        for fila in reversed(filas):
+            try:
+                ts = _epoch(fila['time'])
+            except (KeyError, ValueError):
+                continue
+            self.registrar({
+                'type': fila.get('tipo'),
+                'message': fila.get('mensaje'),
+                'priority': fila.get('prioridad'),
+                'device_id': fila.get('device_id')
+            }, ts)
+        log.info("Registro de alertas recientes precargado con %d alertas", len(filas))
+        return len(filas)
+
+
+def _epoch(texto):
+    # 'YYYY-MM-DD HH:MM:SS[.ffffff...]' en UTC, como lo entrega consultar_historial
+    base, _, fraccion = str(texto).partition('.')
+    segundos = calendar.timegm(time.strptime(base, '%Y-%m-%d %H:%M:%S'))
+    return segundos + (float('0.' + fraccion[:6]) if fraccion else 0.0)
@@ -0,0 +1,223 @@
+# fog-layer/services/anomalias.py
+"""
+Detección de anomalías multivariadas sobre el histórico guardado.
+
+Complementa el QC por lectura con banderas retrospectivas: recorre
+'sensor_reading' por tramos, ajusta por dispositivo un modelo multivariado
+(temperatura, humedad, luz, distancia y banderas) con
+MachineLearningEngine.puntuar_anomalias y escribe en InfluxDB:
+
+  anomalia        una fila por lectura anómala (score >= 1, variable principal)
+  anomalia_tramo  una fila por dispositivo y tramo (muestras, anómalas, score máximo)
+
+Los dispositivos de un tramo se puntúan en paralelo en un pool de procesos.
+La marca de agua (hasta dónde se puntuó) solo avanza con el tramo escrito,
+así que los tramos ya puntuados no se repiten. Corre fuera del gateway: no
+toca el camino en tiempo real.
+
+  python -m services.anomalias --una-vez
+  python -m services.anomalias --cada 900
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from dotenv import load_dotenv
+
+from services.log_config import configurar_logging, obtener_logger
+from services.ml_engine import MachineLearningEngine, MODELOS_ANOMALIA
+from services.snapshot import escribir_atomico
+from services.tsdb_manager import TimeSeriesManager, CAMPOS_EXPORTABLES, CAMPOS_BOOLEANOS_INFLUX
+
+load_dotenv()
+
+log = obtener_logger("transwatch.anomalias")
+
+# 'covarianza_robusta' (NumPy, Mahalanobis robusta) o 'isolation_forest' (scikit-learn)
+ANOMALIAS_MODELO = os.getenv('ANOMALIAS_MODELO', 'covarianza_robusta')
+# Cuantil de chi² que define score = 1 en covarianza_robusta
+ANOMALIAS_CUANTIL = float(os.getenv('ANOMALIAS_CUANTIL', '0.999'))
+# Tamaño del tramo; solo se puntúan tramos completos (el modelo se ajusta por tramo)
+ANOMALIAS_TRAMO_S = int(os.getenv('ANOMALIAS_TRAMO_S', '3600'))
+# Espera para datos que llegan tarde antes de cerrar un tramo
+ANOMALIAS_GRACIA_S = int(os.getenv('ANOMALIAS_GRACIA_S', '300'))
+# Primera ejecución: cuánto histórico se puntúa hacia atrás
+ANOMALIAS_HISTORIA_S = int(os.getenv('ANOMALIAS_HISTORIA_S', str(86400)))
+# Dispositivos con menos lecturas en el tramo no se puntúan
+ANOMALIAS_MIN_MUESTRAS = int(os.getenv('ANOMALIAS_MIN_MUESTRAS', '50'))
+# Paso mínimo de cada variable (DHT11: 1 °C y 1 %; ADC y ultrasónico: 1 unidad). Con datos
+# cuantizados el MAD suele ser 0 y sin este piso un cambio de un paso parecería enorme
+ANOMALIAS_RESOLUCION = dict(
+    (campo.strip(), float(valor)) for campo, _, valor in (
+        par.partition('=') for par in os.getenv(
+            'ANOMALIAS_RESOLUCION', 'temp_celsius=1,humedad_porcentaje=1,luz_adc=1,distancia_cm=1'
+        ).split(',') if par.strip()
+    )
+)
+# Procesos del pool (0 = todo en el proceso actual)
+ANOMALIAS_PROCESOS = int(os.getenv('ANOMALIAS_PROCESOS', str(os.cpu_count() or 1)))
+ANOMALIAS_ESTADO = os.path.expanduser(os.getenv('ANOMALIAS_ESTADO', '~/.transwatch/anomalias.json'))
+
+MEASUREMENT_ANOMALIA = 'anomalia'
+MEASUREMENT_TRAMO = 'anomalia_tramo'
+CAMPOS = CAMPOS_EXPORTABLES
+BINARIAS = np.array([c in CAMPOS_BOOLEANOS_INFLUX for c in CAMPOS])
+RESOLUCION = np.array([ANOMALIAS_RESOLUCION.get(c, 0.0) for c in CAMPOS])
+# Tramos con menos filas se puntúan sin pool (el costo de enviar los datos no compensa)
+_MIN_FILAS_PARALELO = 20000
+
+
+def _iso(segundos):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(segundos))
+
+
+def separar_dispositivos(tabla):
+    """Tabla Arrow ordenada por device_id -> [(device_id, tiempos_ms, X)] con X float (banderas 0/1)"""
+    if tabla.num_rows == 0:
+        return []
+    ids = tabla['device_id'].to_numpy(zero_copy_only=False)
+    tiempos = pc.cast(pc.cast(tabla['time'], pa.timestamp('ms')), pa.int64()).to_numpy(zero_copy_only=False)
+    X = np.column_stack([
+        pc.cast(tabla[c], pa.float64()).to_numpy(zero_copy_only=False) for c in CAMPOS
+    ])
+    cortes = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+    inicios = np.concatenate(([0], cortes))
+    fines = np.concatenate((cortes, [len(ids)]))
+    return [(ids[i], tiempos[i:f], X[i:f]) for i, f in zip(inicios, fines)]
+
+
+def puntuar_dispositivo(device_id, tiempos, X, modelo=ANOMALIAS_MODELO, cuantil=ANOMALIAS_CUANTIL):
+    """Ajusta y puntúa un dispositivo (en el pool). Retorna las lecturas anómalas y el resumen del tramo."""
+    puntaje, variable = MachineLearningEngine().puntuar_anomalias(X, BINARIAS, modelo, cuantil, RESOLUCION)
+    anomalas = np.flatnonzero(puntaje >= 1.0)
+    resumen = {
+        'muestras': len(puntaje),
+        'anomalas': len(anomalas),
+        'score_max': float(puntaje.max()) if len(puntaje) else 0.0
+    }
+    return device_id, tiempos[anomalas], puntaje[anomalas], variable[anomalas], resumen
+
+
+class DetectorAnomalias:
+    """Puntúa los tramos pendientes y mantiene la marca de agua"""
+
+    def __init__(self, tsdb=None, modelo=ANOMALIAS_MODELO, procesos=ANOMALIAS_PROCESOS, ruta_estado=ANOMALIAS_ESTADO):
+        if modelo not in MODELOS_ANOMALIA:
+            raise ValueError(f"Modelo de anomalías desconocido: {modelo!r} (use {', '.join(MODELOS_ANOMALIA)})")
+        self.tsdb = tsdb or TimeSeriesManager()
+        self.modelo = modelo
+        self.ruta_estado = ruta_estado
+        self.marcas = self._leer_estado()
+        self._pool = ProcessPoolExecutor(procesos) if procesos > 1 else None
+
+    def _leer_estado(self):
+        try:
+            with open(self.ruta_estado, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.error("Estado de anomalías ilegible (%s); se puntúa desde ANOMALIAS_HISTORIA_S", e)
+            return {}
+
+    def _guardar_estado(self):
+        escribir_atomico(self.ruta_estado, json.dumps(self.marcas, indent=2).encode('utf-8'))
+
+    def puntuar_tramo(self, inicio, fin):
+        """Puntúa [inicio, fin) de todos los dispositivos. Retorna (lecturas, anómalas)."""
+        tabla = self.tsdb.tabla_lecturas(_iso(inicio), _iso(fin), CAMPOS)
+        grupos = [g for g in separar_dispositivos(tabla) if len(g[1]) >= ANOMALIAS_MIN_MUESTRAS]
+        if not grupos:
+            return 0, 0
+
+        argumentos = [(device_id, tiempos, X, self.modelo) for device_id, tiempos, X in grupos]
+        if self._pool is not None and tabla.num_rows >= _MIN_FILAS_PARALELO:
+            resultados = self._pool.map(puntuar_dispositivo, *zip(*argumentos))
+        else:
+            resultados = (puntuar_dispositivo(*a) for a in argumentos)
+
+        puntos, lecturas, anomalas = [], 0, 0
+        for device_id, tiempos, puntajes, variables, resumen in resultados:
+            tags = {"device_id": device_id, "modelo": self.modelo}
+            for t, puntaje, variable in zip(tiempos.tolist(), puntajes.tolist(), variables.tolist()):
+                campos = {"score": round(puntaje, 3)}
+                if variable >= 0:
+                    campos["variable"] = CAMPOS[variable]
+                puntos.append({"measurement": MEASUREMENT_ANOMALIA, "tags": tags, "fields": campos, "time": t})
+            puntos.append({
+                "measurement": MEASUREMENT_TRAMO, "tags": tags,
+                "fields": {
+                    "muestras": resumen['muestras'], "anomalas": resumen['anomalas'],
+                    "score_max": round(resumen['score_max'], 3)
+                },
+                "time": int(inicio * 1000)
+            })
+            lecturas += resumen['muestras']
+            anomalas += resumen['anomalas']
+
+        self.tsdb.client.write(record=puntos, write_precision="ms")
+        return lecturas, anomalas
+
+    def ejecutar(self, ahora=None):
+        """Puntúa todos los tramos completos desde la marca de agua. Retorna la cantidad de tramos."""
+        ahora = ahora if ahora is not None else time.time()
+        limite = int((ahora - ANOMALIAS_GRACIA_S) // ANOMALIAS_TRAMO_S * ANOMALIAS_TRAMO_S)
+        marca = self.marcas.get(self.modelo)
+        if marca is None:
+            marca = int((ahora - ANOMALIAS_HISTORIA_S) // ANOMALIAS_TRAMO_S * ANOMALIAS_TRAMO_S)
+
+        tramos = 0
+        while marca + ANOMALIAS_TRAMO_S <= limite:
+            fin = marca + ANOMALIAS_TRAMO_S
+            inicio_tramo = time.perf_counter()
+            lecturas, anomalas = self.puntuar_tramo(marca, fin)
+            log.info("Tramo %s puntuado: %d lecturas, %d anómalas (%.2f s)",
+                     _iso(marca), lecturas, anomalas, time.perf_counter() - inicio_tramo)
+            # La marca solo avanza con el tramo ya escrito (reintentar reescribe los mismos puntos)
+            marca = fin
+            self.marcas[self.modelo] = marca
+            self._guardar_estado()
+            tramos += 1
+        return tramos
+
+    def cerrar(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+        self.tsdb.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detección de anomalías multivariadas sobre el histórico de TRANSWATCH")
+    grupo = parser.add_mutually_exclusive_group()
+    grupo.add_argument('--una-vez', action='store_true', help="Una sola pasada (para cron/systemd timer)")
+    grupo.add_argument('--cada', type=int, default=900, help="Segundos entre pasadas (default 900)")
+    parser.add_argument('--modelo', default=ANOMALIAS_MODELO, help="covarianza_robusta o isolation_forest")
+    args = parser.parse_args()
+
+    configurar_logging()
+    detector = DetectorAnomalias(modelo=args.modelo)
+    try:
+        while True:
+            try:
+                detector.ejecutar()
+            except Exception as e:
+                log.exception("Pasada de anomalías falló: %s", e)
+            if args.una_vez:
+                break
+            time.sleep(args.cada)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        detector.cerrar()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
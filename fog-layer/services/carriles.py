@@ -0,0 +1,186 @@
+# fog-layer/services/carriles.py
+
+import os
+import time
+import queue
+import itertools
+import threading
+
+from services.log_config import obtener_logger
+from services.metrics import registro, LATENCIA_ALERTA
+
+log = obtener_logger("transwatch.carriles")
+
+CARRILES_ENABLED = os.getenv('CARRILES_ENABLED', 'true').lower() in ('1', 'true', 'si', 'yes')
+# Prioridades que van por el carril de alertas (el resto sigue con la telemetría)
+CARRIL_PRIORIDADES = frozenset(
+    p.strip() for p in os.getenv('CARRIL_PRIORIDADES', 'critical,high').split(',') if p.strip()
+)
+# Hilos propios del carril de alertas (WebSocket y BD) y de sus emails (un SMTP lento no frena la siguiente alerta)
+CARRIL_ALERTAS_WORKERS = int(os.getenv('CARRIL_ALERTAS_WORKERS', '2'))
+CARRIL_EMAIL_WORKERS = int(os.getenv('CARRIL_EMAIL_WORKERS', '2'))
+# Presupuesto de latencia desde la detección hasta la primera entrega
+CARRIL_ALERTAS_PRESUPUESTO_MS = float(os.getenv('CARRIL_ALERTAS_PRESUPUESTO_MS', '250'))
+# Lotes esperando E/S (Azure, InfluxDB, broadcast) en el carril de telemetría
+CARRIL_TELEMETRIA_COLA = int(os.getenv('CARRIL_TELEMETRIA_COLA', '100'))
+# Con la cola llena: descartar el lote más antiguo (true) o bloquear el QC hasta que haya lugar (false)
+CARRIL_TELEMETRIA_DESCARTAR = os.getenv('CARRIL_TELEMETRIA_DESCARTAR', 'false').lower() in ('1', 'true', 'si', 'yes')
+
+PRIORIDADES = {'critical': 0, 'high': 1, 'medium': 2, 'info': 3}
+
+ALERTAS_FUERA_PRESUPUESTO = registro.contador(
+    'transwatch_alertas_fuera_presupuesto_total', 'Alertas prioritarias entregadas fuera de presupuesto',
+    etiqueta='prioridad'
+)
+LOTES_DESCARTADOS = registro.contador(
+    'transwatch_telemetria_lotes_descartados_total', 'Lotes de telemetría descartados con el carril lleno'
+)
+
+
+def es_prioritaria(alerta):
+    return alerta.get('priority') in CARRIL_PRIORIDADES
+
+
+class _Carril:
+    """Hilos que consumen una cola; sin iniciar, `enviar` procesa en el hilo que llama"""
+
+    nombre = 'carril'
+
+    def __init__(self, workers):
+        self.n_workers = max(1, workers)
+        self._hilos = []
+
+    @property
+    def activo(self):
+        return any(hilo.is_alive() for hilo in self._hilos)
+
+    def pendientes(self):
+        return self._cola.qsize()
+
+    def iniciar(self):
+        if self.activo:
+            return
+        self._hilos = [
+            threading.Thread(target=self._bucle, name=f"{self.nombre}-{i}", daemon=True)
+            for i in range(self.n_workers)
+        ]
+        for hilo in self._hilos:
+            hilo.start()
+
+    def detener(self, timeout=10):
+        """Vacía la cola y detiene los hilos"""
+        for _ in self._hilos:
+            self._poner_fin()
+        limite = time.monotonic() + timeout
+        for hilo in self._hilos:
+            hilo.join(max(0.0, limite - time.monotonic()))
+        self._hilos = []
+
+    def _bucle(self):
+        while True:
+            item = self._tomar()
+            if item is None:
+                break
+            try:
+                self._procesar(item)
+            except Exception as e:
+                log.exception("Error en el carril %s: %s", self.nombre, e)
+
+
+class CarrilAlertas(_Carril):
+    """
+    Carril de alertas prioritarias (critical y high): cola sin límite ordenada
+    por prioridad, con sus propios hilos. Nunca descarta y no comparte cola ni
+    hilos con la telemetría, así una alerta de incendio no espera escrituras
+    a InfluxDB ni envíos a Azure.
+
+    `entregar(alerta, detectado)` envía por WebSocket y BD, deja el email en
+    su propio pool y retorna {canal: segundos desde la detección}; el carril
+    lo registra en transwatch_alerta_entrega_segundos y cuenta las que
+    superan el presupuesto.
+    """
+
+    nombre = 'carril-alertas'
+    _FIN = 99   # después de cualquier prioridad: al detener se entregan primero las pendientes
+
+    def __init__(self, entregar, workers=CARRIL_ALERTAS_WORKERS, presupuesto_ms=CARRIL_ALERTAS_PRESUPUESTO_MS):
+        super().__init__(workers)
+        self.entregar = entregar
+        self.presupuesto_s = presupuesto_ms / 1000.0
+        self._cola = queue.PriorityQueue()
+        self._secuencia = itertools.count()
+
+    def enviar(self, alerta, detectado=None):
+        detectado = detectado if detectado is not None else time.time()
+        if not self.activo:
+            self._procesar((detectado, alerta))
+            return
+        # La secuencia mantiene el orden de llegada dentro de una misma prioridad
+        prioridad = PRIORIDADES.get(alerta.get('priority'), len(PRIORIDADES))
+        self._cola.put((prioridad, next(self._secuencia), detectado, alerta))
+
+    def _poner_fin(self):
+        self._cola.put((self._FIN, next(self._secuencia), 0.0, None))
+
+    def _tomar(self):
+        _, _, detectado, alerta = self._cola.get()
+        return None if alerta is None else (detectado, alerta)
+
+    def _procesar(self, item):
+        detectado, alerta = item
+        tiempos = self.entregar(alerta, detectado)
+        for canal, segundos in tiempos.items():
+            LATENCIA_ALERTA.observar(segundos, canal)
+        primera = min(tiempos.values(), default=None)
+        if primera is not None and primera > self.presupuesto_s:
+            ALERTAS_FUERA_PRESUPUESTO.inc(etiqueta=alerta.get('priority', ''))
+            log.warning("Alerta %s entregada en %.0f ms (presupuesto %.0f ms)", alerta.get('type'),
+                        primera * 1000, self.presupuesto_s * 1000)
+
+
+class CarrilTelemetria(_Carril):
+    """
+    Carril de E/S de la telemetría: un hilo (mantiene el orden de los lotes y
+    un solo cliente de InfluxDB/Azure) que ejecuta `procesar(*lote)` mientras
+    el hilo de micro-lotes sigue con el QC y la detección de alertas.
+
+    Con la cola llena bloquea al productor (contrapresión, como MicroBatcher)
+    o, con `descartar`, desecha el lote más antiguo. Las alertas prioritarias
+    ya salieron por su carril antes de encolar el lote: el descarte nunca las
+    alcanza.
+    """
+
+    nombre = 'carril-telemetria'
+
+    def __init__(self, procesar, max_cola=CARRIL_TELEMETRIA_COLA, descartar=CARRIL_TELEMETRIA_DESCARTAR):
+        super().__init__(1)
+        self.procesar = procesar
+        self.descartar = descartar
+        self._cola = queue.Queue(maxsize=max(1, max_cola))
+
+    def enviar(self, *lote):
+        if not self.activo:
+            self.procesar(*lote)
+            return
+        if not self.descartar:
+            self._cola.put(lote)
+            return
+        while True:
+            try:
+                self._cola.put_nowait(lote)
+                return
+            except queue.Full:
+                try:
+                    self._cola.get_nowait()
+                    LOTES_DESCARTADOS.inc()
+                except queue.Empty:
+                    pass
+
+    def _poner_fin(self):
+        self._cola.put(None)
+
+    def _tomar(self):
+        return self._cola.get()
+
+    def _procesar(self, lote):
+        self.procesar(*lote)
@@ -0,0 +1,45 @@
+# fog-layer/services/coalescer.py
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from services.log_config import obtener_logger
+from services.metrics import registro
+
+log = obtener_logger("transwatch.coalescer")
+
+PETICIONES_COALESCIDAS = registro.contador(
+    'transwatch_api_coalescidas_total',
+    'Peticiones atendidas con el resultado de una consulta ya en curso',
+    etiqueta='consulta'
+)
+
+
+class CoalescedorConsultas:
+    """
+    Ejecuta consultas bloqueantes (cliente InfluxDB síncrono) en un pool de
+    hilos y agrupa las peticiones idénticas concurrentes: N llamadas con la
+    misma clave mientras la primera sigue en curso esperan el mismo futuro,
+    así que el backend recibe una sola consulta.
+    """
+
+    def __init__(self, max_hilos=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix="consulta-tsdb")
+        self._en_curso = {}
+
+    async def ejecutar(self, clave, funcion, *args):
+        futuro = self._en_curso.get(clave)
+        if futuro is None:
+            loop = asyncio.get_running_loop()
+            futuro = loop.run_in_executor(self.executor, functools.partial(funcion, *args))
+            self._en_curso[clave] = futuro
+            futuro.add_done_callback(lambda _: self._en_curso.pop(clave, None))
+        else:
+            PETICIONES_COALESCIDAS.inc(etiqueta=clave[0])
+            log.debug("Petición coalescida", extra={'consulta': clave[0]})
+        # shield: si un cliente se desconecta no se cancela la consulta de los demás
+        return await asyncio.shield(futuro)
+
+    def cerrar(self):
+        self.executor.shutdown(wait=False)
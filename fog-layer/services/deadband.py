@@ -0,0 +1,255 @@
+# fog-layer/services/deadband.py
+
+import os
+import time
+import threading
+
+from services.lectura import CAMPOS_BOOLEANOS, Lectura
+from services.log_config import obtener_logger
+from services.metrics import registro
+
+log = obtener_logger("transwatch.deadband")
+
+# Compresión antes de InfluxDB/Azure. Deshabilitada por defecto
+DEADBAND_ENABLED = os.getenv('DEADBAND_ENABLED', 'false').lower() in ('1', 'true', 'si', 'yes')
+# 'deadband': se guarda cuando un campo se aleja más de su tolerancia del último valor guardado
+#             (la serie se reconstruye en escalón).
+# 'swinging_door': se guardan los vértices de la polilínea que aproxima la serie dentro de la
+#             tolerancia (se reconstruye por interpolación lineal). El punto guardado es el
+#             anterior al que rompe la puerta, así que llega con una lectura de retraso.
+DEADBAND_MODO = os.getenv('DEADBAND_MODO', 'deadband')
+# Tolerancia absoluta por campo: "campo=valor,campo=valor"
+DEADBAND_TOLERANCIAS = os.getenv(
+    'DEADBAND_TOLERANCIAS',
+    'temperatura_celsius=0.2,humedad_porcentaje=1.0,luz_adc=50,distancia_cm=5'
+)
+# Se guarda al menos una lectura por dispositivo cada este intervalo aunque nada cambie. Si el
+# dispositivo deja de reportar, su última lectura retenida se guarda al pasar a offline o, como
+# tarde, cuando cumple este tiempo sin lecturas nuevas
+DEADBAND_HEARTBEAT_S = float(os.getenv('DEADBAND_HEARTBEAT_S', '300'))
+
+MODOS = ('deadband', 'swinging_door')
+
+LECTURAS_DEADBAND = registro.contador(
+    'transwatch_deadband_lecturas_total', 'Lecturas limpias guardadas u omitidas por la compresión',
+    etiqueta='resultado'
+)
+
+
+def parsear_tolerancias(texto):
+    tolerancias = {}
+    for par in texto.split(','):
+        if not par.strip():
+            continue
+        campo, _, valor = par.partition('=')
+        tolerancias[campo.strip()] = float(valor)
+    return tolerancias
+
+
+class _EstadoDispositivo:
+    __slots__ = ('ancla', 'retenida', 'guardado_en', 'pend_sup', 'pend_inf')
+
+    def __init__(self):
+        self.ancla = None          # (lectura, device_id, recibido) del último punto guardado
+        self.retenida = None       # última lectura vista y no guardada
+        self.guardado_en = 0.0
+        self.pend_sup = {}         # campo -> pendiente máxima de la puerta superior
+        self.pend_inf = {}         # campo -> pendiente mínima de la puerta inferior
+
+
+class CompresorDeadband:
+    """
+    Decide por dispositivo qué lecturas limpias se guardan. Un cambio en
+    cualquier bandera booleana o un campo que sale de su tolerancia fuerzan
+    el guardado de la lectura, y el heartbeat garantiza al menos un punto
+    cada DEADBAND_HEARTBEAT_S. Costo O(campos) por lectura.
+
+    La última lectura no guardada queda retenida: la siguiente lectura decide
+    si se descarta o (swinging door) pasa a vértice. Para un dispositivo que
+    deja de reportar, `vaciar` (transición a offline) y el barrido periódico
+    (`iniciar`) la guardan, así la serie no termina en el último punto guardado.
+    """
+
+    def __init__(self, modo=DEADBAND_MODO, tolerancias=None, heartbeat_s=DEADBAND_HEARTBEAT_S):
+        if modo not in MODOS:
+            raise ValueError(f"Modo de compresión desconocido: {modo!r} (use {', '.join(MODOS)})")
+        self.modo = modo
+        self.tolerancias = tolerancias if tolerancias is not None else parsear_tolerancias(DEADBAND_TOLERANCIAS)
+        self.heartbeat_s = heartbeat_s
+        self._estados = {}
+        # filtrar corre en el hilo de micro-lotes; vaciar en el de vivacidad o el del barrido
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def filtrar(self, lectura, device_id, recibido):
+        """Retorna la lista de (lectura, device_id, recibido) a guardar: 0, 1 o 2 elementos"""
+        with self._lock:
+            return self._filtrar(lectura, device_id, recibido)
+
+    def _filtrar(self, lectura, device_id, recibido):
+        estado = self._estados.get(device_id)
+        if estado is None:
+            estado = self._estados[device_id] = _EstadoDispositivo()
+        item = (lectura, device_id, recibido)
+
+        if estado.ancla is None:
+            guardar = [item]
+        elif self.modo == 'deadband':
+            guardar = [item] if self._fuera_de_banda(estado, lectura, recibido) else []
+        else:
+            guardar = self._puerta_giratoria(estado, item)
+
+        if guardar:
+            self._anclar(estado, guardar[-1])
+            LECTURAS_DEADBAND.inc(len(guardar), etiqueta='guardada')
+
+        # La retenida anterior ya no se guardará nunca salvo que sea un vértice (swinging door)
+        descartada = estado.retenida
+        if descartada is not None and not any(g is descartada for g in guardar):
+            LECTURAS_DEADBAND.inc(etiqueta='omitida')
+
+        # La lectura actual queda retenida salvo que se haya guardado
+        estado.retenida = None if guardar and guardar[-1] is item else item
+        return guardar
+
+    def vaciar(self, device_id):
+        """Guarda la lectura retenida de un dispositivo que dejó de reportar; retorna [] o [item]"""
+        with self._lock:
+            estado = self._estados.get(device_id)
+            if estado is None or estado.retenida is None:
+                return []
+            return self._vaciar(estado)
+
+    def vaciar_inactivos(self, ahora=None):
+        """Lecturas retenidas de los dispositivos sin lecturas nuevas durante el heartbeat"""
+        ahora = ahora if ahora is not None else time.time()
+        with self._lock:
+            return [
+                item
+                for estado in self._estados.values()
+                if estado.retenida is not None and ahora - estado.retenida[2] >= self.heartbeat_s
+                for item in self._vaciar(estado)
+            ]
+
+    def _vaciar(self, estado):
+        item = estado.retenida
+        estado.retenida = None
+        self._anclar(estado, item)
+        LECTURAS_DEADBAND.inc(etiqueta='guardada')
+        return [item]
+
+    def iniciar(self, al_vaciar):
+        """Barrido periódico: `al_vaciar(items)` recibe las lecturas retenidas de dispositivos inactivos"""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, args=(al_vaciar,), name="deadband", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(5)
+
+    def _bucle(self, al_vaciar):
+        while not self._detener.wait(max(1.0, self.heartbeat_s / 4)):
+            try:
+                items = self.vaciar_inactivos()
+                if items:
+                    al_vaciar(items)
+            except Exception as e:
+                log.exception("Error guardando lecturas retenidas por la compresión: %s", e)
+
+    def _anclar(self, estado, item):
+        estado.ancla = item
+        estado.guardado_en = item[2]
+        estado.pend_sup.clear()
+        estado.pend_inf.clear()
+
+    def _cambio_discreto(self, estado, lectura, recibido):
+        ancla = estado.ancla[0]
+        if recibido - estado.guardado_en >= self.heartbeat_s:
+            return True
+        for campo in CAMPOS_BOOLEANOS:
+            if getattr(lectura, campo) != getattr(ancla, campo):
+                return True
+        return False
+
+    def _fuera_de_banda(self, estado, lectura, recibido):
+        if self._cambio_discreto(estado, lectura, recibido):
+            return True
+        ancla = estado.ancla[0]
+        for campo, tolerancia in self.tolerancias.items():
+            valor, referencia = getattr(lectura, campo), getattr(ancla, campo)
+            if valor is None or referencia is None:
+                if valor is not referencia:
+                    return True
+            elif abs(valor - referencia) > tolerancia:
+                return True
+        return False
+
+    def _puerta_giratoria(self, estado, item):
+        lectura, _, recibido = item
+        if self._cambio_discreto(estado, lectura, recibido):
+            # El escalón se conserva guardando también el punto anterior al cambio
+            return [estado.retenida, item] if estado.retenida is not None else [item]
+
+        if self._abrir_puertas(estado, lectura, recibido):
+            retenida = estado.retenida
+            if retenida is None:
+                return [item]
+            # El punto retenido pasa a ser el nuevo vértice; la lectura actual
+            # se evalúa contra él (una sola muestra: la puerta sigue cerrada)
+            self._anclar(estado, retenida)
+            if self._abrir_puertas(estado, lectura, recibido):
+                return [retenida, item]
+            return [retenida]
+        return []
+
+    def _abrir_puertas(self, estado, lectura, recibido):
+        """Actualiza las puertas con la lectura; True si alguna se abrió (punto fuera de tolerancia)"""
+        ancla, t0 = estado.ancla[0], estado.ancla[2]
+        dt = recibido - t0
+        violacion = False
+        for campo, tolerancia in self.tolerancias.items():
+            valor, referencia = getattr(lectura, campo), getattr(ancla, campo)
+            if valor is None or referencia is None:
+                violacion = violacion or valor is not referencia
+                continue
+            if dt <= 0:
+                violacion = violacion or abs(valor - referencia) > tolerancia
+                continue
+            sup = max(estado.pend_sup.get(campo, float('-inf')), (valor - referencia - tolerancia) / dt)
+            inf = min(estado.pend_inf.get(campo, float('inf')), (valor - referencia + tolerancia) / dt)
+            estado.pend_sup[campo] = sup
+            estado.pend_inf[campo] = inf
+            if sup > inf:
+                violacion = True
+        return violacion
+
+    def dispositivos(self):
+        return len(self._estados)
+
+    def exportar_estado(self):
+        """Estado por dispositivo en tipos básicos (snapshot de arranque en caliente)"""
+        def item(valor):
+            return None if valor is None else (valor[0].a_tupla(), valor[1], valor[2])
+        return {
+            'modo': self.modo,
+            'dispositivos': {
+                device_id: (item(e.ancla), item(e.retenida), e.guardado_en, dict(e.pend_sup), dict(e.pend_inf))
+                for device_id, e in list(self._estados.items())
+            }
+        }
+
+    def restaurar_estado(self, estado):
+        if estado['modo'] != self.modo:
+            raise ValueError(f"snapshot en modo {estado['modo']!r}, compresor en {self.modo!r}")
+
+        def item(valor):
+            return None if valor is None else (Lectura.desde_tupla(valor[0]), valor[1], valor[2])
+        for device_id, (ancla, retenida, guardado_en, pend_sup, pend_inf) in estado['dispositivos'].items():
+            e = self._estados[device_id] = _EstadoDispositivo()
+            e.ancla, e.retenida, e.guardado_en = item(ancla), item(retenida), guardado_en
+            e.pend_sup, e.pend_inf = dict(pend_sup), dict(pend_inf)
@@ -0,0 +1,117 @@
+# fog-layer/services/exportador.py
+"""
+Exportación masiva de lecturas desde InfluxDB a Parquet, Arrow IPC o CSV.
+
+Los datos se leen como RecordBatch de Arrow (TimeSeriesManager.lector_exportacion)
+y se escriben lote a lote, así que la memoria queda acotada al tamaño de un
+lote sin importar el rango. Lo usan el endpoint /api/exportar de api_async.py
+y la línea de comandos para análisis offline:
+
+  python -m services.exportador --inicio 2025-01-01 --fin 2025-02-01 \\
+      --formato parquet --dispositivos ESP32-Parking-Transwatch --intervalo 1m -o enero.parquet
+"""
+
+import io
+import sys
+import argparse
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+FORMATOS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'csv': ('text/csv', 'csv'),
+}
+
+
+class _SalidaIncremental(io.RawIOBase):
+    """Sink para los writers de Arrow: acumula bytes hasta que se vacía y conserva la posición total"""
+
+    def __init__(self):
+        super().__init__()
+        self._partes = []
+        self._posicion = 0
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        # Parquet calcula los offsets del footer con tell(): debe ser la posición absoluta
+        return self._posicion
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes.clear()
+        return datos
+
+
+def exportar_lotes(lector, formato):
+    """
+    Genera los bytes del archivo exportado a partir de un RecordBatchReader,
+    un chunk por lote. Un rango sin datos produce un archivo vacío con el esquema.
+    """
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato no soportado: {formato!r} (use {', '.join(FORMATOS)})")
+
+    salida = _SalidaIncremental()
+    if formato == 'parquet':
+        writer = pq.ParquetWriter(salida, lector.schema, compression='zstd')
+    elif formato == 'arrow':
+        writer = pa.ipc.new_stream(salida, lector.schema)
+    else:
+        writer = pa_csv.CSVWriter(salida, lector.schema)
+
+    try:
+        for lote in lector:
+            if not lote.num_rows:
+                continue
+            writer.write_batch(lote)
+            datos = salida.vaciar()
+            if datos:
+                yield datos
+    finally:
+        writer.close()
+    datos = salida.vaciar()
+    if datos:
+        yield datos
+
+
+def main():
+    from services.tsdb_manager import TimeSeriesManager
+
+    parser = argparse.ArgumentParser(description="Exporta lecturas de TRANSWATCH desde InfluxDB")
+    parser.add_argument('--inicio', required=True, help="Fecha inicial ISO 8601")
+    parser.add_argument('--fin', required=True, help="Fecha final ISO 8601")
+    parser.add_argument('--formato', choices=list(FORMATOS), default='parquet')
+    parser.add_argument('--dispositivos', nargs='*', help="device_id a incluir (default: todos)")
+    parser.add_argument('--campos', nargs='*', help="Campos a incluir (default: todos)")
+    parser.add_argument('--intervalo', help="Agregación en el servidor, p. ej. 1m, 1h")
+    parser.add_argument('-o', '--salida', required=True, help="Archivo de salida")
+    args = parser.parse_args()
+
+    tsdb = TimeSeriesManager()
+    try:
+        lector = tsdb.lector_exportacion(args.inicio, args.fin, args.dispositivos, args.campos, args.intervalo)
+        total = 0
+        with open(args.salida, 'wb') as f:
+            for chunk in exportar_lotes(lector, args.formato):
+                f.write(chunk)
+                total += len(chunk)
+        print(f"Exportados {total:,} bytes a {args.salida}")
+    except (ValueError, ConnectionError) as e:
+        print(f"Error: {e}")
+        return 1
+    finally:
+        tsdb.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+# fog-layer/services/ingest_batcher.py
+
+import queue
+import threading
+import time
+
+from services.log_config import obtener_logger
+
+log = obtener_logger("transwatch.batcher")
+
+
+class MicroBatcher:
+    """
+    Agrupa mensajes entrantes en micro-lotes (por cantidad N o por tiempo T ms)
+    y los entrega a una función de procesamiento en un hilo dedicado.
+
+    El hilo de red del cliente MQTT solo encola; QC, almacenamiento y
+    broadcast se ejecutan por lote fuera de ese hilo. Se puede pasar una cola
+    existente (p. ej. multiprocessing.Queue en los workers del modo sharded).
+    """
+
+    def __init__(self, procesar_lote, max_mensajes=50, max_espera_ms=100, max_cola=10000, cola=None):
+        self.procesar_lote = procesar_lote
+        self.max_mensajes = max(1, int(max_mensajes))
+        self.max_espera = max(0, int(max_espera_ms)) / 1000.0
+        self.cola = cola if cola is not None else queue.Queue(maxsize=max_cola)
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def agregar(self, item, timeout=None):
+        """
+        Encola un mensaje. Sin `timeout` bloquea con la cola llena (contrapresión);
+        con `timeout` (0 = sin esperar) retorna False si no hubo lugar. El hilo de red
+        de paho usa timeout: bloquearlo atrasa keepalives y PUBACKs y el broker lo desconecta.
+        """
+        if timeout is None:
+            self.cola.put(item)
+            return True
+        try:
+            if timeout > 0:
+                self.cola.put(item, timeout=timeout)
+            else:
+                self.cola.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="micro-batcher", daemon=True)
+        self._hilo.start()
+
+    def detener(self, timeout=5):
+        """Detiene el hilo tras vaciar lo que quede en la cola."""
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def _tomar_lote(self):
+        """Espera el primer mensaje y completa el lote hasta N mensajes o T ms."""
+        try:
+            primero = self.cola.get(timeout=0.5)
+        except queue.Empty:
+            return []
+
+        lote = [primero]
+        limite = time.monotonic() + self.max_espera
+        while len(lote) < self.max_mensajes:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                # Tiempo agotado: solo recoger lo que ya esté en cola
+                try:
+                    lote.append(self.cola.get_nowait())
+                    continue
+                except queue.Empty:
+                    break
+            try:
+                lote.append(self.cola.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote
+
+    def _bucle(self):
+        while not (self._detener.is_set() and self.cola.empty()):
+            lote = self._tomar_lote()
+            if not lote:
+                continue
+            try:
+                self.procesar_lote(lote)
+            except Exception as e:
+                log.exception("Error procesando micro-lote de %d mensajes: %s", len(lote), e)
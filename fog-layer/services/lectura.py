@@ -0,0 +1,144 @@
+# fog-layer/services/lectura.py
+
+import json
+
+# orjson es opcional: decodifica directamente desde bytes y es varias veces más rápido
+try:
+    import orjson
+    _decodificar = orjson.loads
+except ImportError:
+    _decodificar = json.loads
+
+CAMPOS_NUMERICOS = ('temperatura_celsius', 'humedad_porcentaje', 'luz_adc', 'distancia_cm')
+CAMPOS_BOOLEANOS = (
+    'vehiculo_en_entrada_detectado',
+    'barrera_abierta',
+    'luces_parking_encendidas',
+    'alarma_temperatura_activa'
+)
+
+# Nombres alternativos que envían firmwares antiguos -> nombre canónico
+ALIAS_CAMPOS = {
+    'temperatura': 'temperatura_celsius',
+    'humedad': 'humedad_porcentaje',
+    'distancia_entrada_cm': 'distancia_cm',
+    'vehiculo_detectado_entrada': 'vehiculo_en_entrada_detectado'
+}
+
+
+class ErrorEsquema(ValueError):
+    """El payload no es JSON válido o no cumple el esquema de lectura."""
+
+
+class Lectura:
+    """
+    Registro compacto de una lectura de sensores. Se construye una sola vez
+    por mensaje y lo consumen directamente QC, alertas, InfluxDB, Azure y
+    WebSocket, sin reconstruir diccionarios en cada etapa.
+    """
+
+    __slots__ = (
+        'device_id', 'timestamp',
+        'temperatura_celsius', 'humedad_porcentaje', 'luz_adc', 'distancia_cm',
+        'vehiculo_en_entrada_detectado', 'barrera_abierta',
+        'luces_parking_encendidas', 'alarma_temperatura_activa',
+        'qc_approved', 'qc_message', 'payload'
+    )
+
+    @classmethod
+    def desde_dict(cls, datos, payload=None):
+        """Valida el esquema y mapea los nombres de campo. `payload` son los bytes originales."""
+        if any(alias in datos for alias in ALIAS_CAMPOS):
+            datos = dict(datos)
+            for origen, destino in ALIAS_CAMPOS.items():
+                if origen in datos:
+                    datos.setdefault(destino, datos.pop(origen))
+            # El JSON original no usa los nombres canónicos: no se puede reenviar tal cual
+            payload = None
+
+        lectura = cls.__new__(cls)
+        for campo in CAMPOS_NUMERICOS:
+            valor = datos.get(campo)
+            if valor is not None and (type(valor) is bool or not isinstance(valor, (int, float))):
+                raise ErrorEsquema(f"Campo '{campo}' debe ser numérico: {valor!r}")
+            setattr(lectura, campo, valor)
+
+        for campo in CAMPOS_BOOLEANOS:
+            valor = datos.get(campo)
+            # Solo true/false o 0/1: bool("false") sería True y abriría la barrera
+            if valor is None:
+                valor = False
+            elif type(valor) is not bool:
+                if type(valor) is not int or valor not in (0, 1):
+                    raise ErrorEsquema(f"Campo '{campo}' debe ser booleano: {valor!r}")
+                valor = bool(valor)
+            setattr(lectura, campo, valor)
+
+        device_id = datos.get('device_id')
+        lectura.device_id = str(device_id) if device_id else None
+        lectura.timestamp = datos.get('timestamp')
+        lectura.qc_approved = True
+        lectura.qc_message = "OK"
+        lectura.payload = payload
+        return lectura
+
+    # --- Acceso compatible con dict (reglas de alertas, email) ---
+    def get(self, campo, default=None):
+        return getattr(self, campo, default)
+
+    def __getitem__(self, campo):
+        try:
+            return getattr(self, campo)
+        except AttributeError:
+            raise KeyError(campo)
+
+    def __setitem__(self, campo, valor):
+        setattr(self, campo, valor)
+
+    # --- Serialización ---
+    def a_dict(self):
+        datos = {'device_id': self.device_id, 'timestamp': self.timestamp}
+        for campo in CAMPOS_NUMERICOS + CAMPOS_BOOLEANOS:
+            datos[campo] = getattr(self, campo)
+        return datos
+
+    def a_tupla(self):
+        """Todos los slots en orden (snapshot de estado); inverso de desde_tupla"""
+        return tuple(getattr(self, campo) for campo in self.__slots__)
+
+    @classmethod
+    def desde_tupla(cls, valores):
+        lectura = cls.__new__(cls)
+        for campo, valor in zip(cls.__slots__, valores):
+            setattr(lectura, campo, valor)
+        return lectura
+
+    def a_json(self):
+        """JSON para Azure/WebSocket: reutiliza el payload original cuando es posible"""
+        if self.payload is not None:
+            return self.payload.decode('utf-8')
+        return json.dumps(self.a_dict())
+
+    def campos_influx(self):
+        """Campos del punto 'sensor_reading' de InfluxDB"""
+        return {
+            "temp_celsius": float(self.temperatura_celsius or 0.0),
+            "humedad_porcentaje": float(self.humedad_porcentaje or 0.0),
+            "luz_adc": float(self.luz_adc or 0.0),
+            "distancia_cm": float(self.distancia_cm or 0.0),
+            "vehiculo_en_entrada_detectado": self.vehiculo_en_entrada_detectado,
+            "barrera_abierta": self.barrera_abierta,
+            "luces_parking_encendidas": self.luces_parking_encendidas,
+            "alarma_temperatura_activa": self.alarma_temperatura_activa
+        }
+
+
+def parsear_lectura(payload_bytes):
+    """Bytes MQTT -> Lectura validada. Lanza ErrorEsquema si el payload no es válido."""
+    try:
+        datos = _decodificar(payload_bytes)
+    except ValueError as e:
+        raise ErrorEsquema(f"JSON inválido: {e}") from e
+    if not isinstance(datos, dict):
+        raise ErrorEsquema("El payload debe ser un objeto JSON")
+    return Lectura.desde_dict(datos, payload_bytes)
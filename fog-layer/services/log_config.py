@@ -0,0 +1,193 @@
+# fog-layer/services/log_config.py
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'texto' (clave=valor) o 'json' (una línea JSON por registro, útil con journald/Loki)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'texto').lower()
+# Máximo de registros con la misma plantilla por ventana; el resto se suprime y se resume
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', '20'))
+LOG_RATE_WINDOW_S = float(os.getenv('LOG_RATE_WINDOW_S', '10'))
+# Desde este nivel los registros nunca se limitan (una ráfaga de errores de BD debe verse completa)
+LOG_RATE_EXENTO = logging.getLevelName(os.getenv('LOG_RATE_EXENTO', 'ERROR').upper())
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Atributos propios de LogRecord; todo lo demás llegó vía extra={...} (campos estructurados)
+_ATRIBUTOS_ESTANDAR = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+_barrido = None
+
+
+def obtener_logger(nombre):
+    return logging.getLogger(nombre)
+
+
+class FormateadorEstructurado(logging.Formatter):
+    """Formatea el mensaje y agrega los campos recibidos por extra={...}"""
+
+    def __init__(self, como_json=False):
+        super().__init__()
+        self.como_json = como_json
+
+    def format(self, record):
+        campos = {k: v for k, v in record.__dict__.items() if k not in _ATRIBUTOS_ESTANDAR}
+        mensaje = record.getMessage()
+
+        if self.como_json:
+            salida = {
+                'ts': round(record.created, 3),
+                'level': record.levelname,
+                'logger': record.name,
+                'msg': mensaje,
+                **campos
+            }
+            if record.exc_info:
+                salida['exc'] = self.formatException(record.exc_info)
+            return json.dumps(salida, default=str, ensure_ascii=False)
+
+        linea = f"{self.formatTime(record)} {record.levelname:<7} {record.name}: {mensaje}"
+        if campos:
+            linea += ' ' + ' '.join(f"{k}={v}" for k, v in campos.items())
+        if record.exc_info:
+            linea += '\n' + self.formatException(record.exc_info)
+        return linea
+
+
+class FiltroFrecuencia(logging.Filter):
+    """
+    Limita la frecuencia por plantilla de mensaje (logger + msg sin formatear).
+    Los mensajes repetitivos por lectura se suprimen tras LOG_RATE_LIMIT en la
+    ventana y el siguiente registro que pasa indica cuántos se omitieron; si la
+    plantilla no se repite, `vencidos()` (llamado periódicamente) entrega el
+    resumen al cerrar la ventana. Los registros desde `exento` no se limitan.
+    """
+
+    def __init__(self, limite=LOG_RATE_LIMIT, ventana_s=LOG_RATE_WINDOW_S, exento=LOG_RATE_EXENTO):
+        super().__init__()
+        self.limite = limite
+        self.ventana_s = ventana_s
+        self.exento = exento
+        self._contadores = {}   # (logger, msg) -> (inicio, emitidos, suprimidos, nivel máximo suprimido)
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.limite <= 0 or record.levelno >= self.exento:
+            return True
+        clave = (record.name, record.msg)
+        ahora = time.monotonic()
+        with self._lock:
+            inicio, emitidos, suprimidos, nivel = self._contadores.get(clave, (ahora, 0, 0, 0))
+            if ahora - inicio >= self.ventana_s:
+                if suprimidos:
+                    record.suprimidos = suprimidos
+                self._contadores[clave] = (ahora, 1, 0, 0)
+                return True
+            if emitidos < self.limite:
+                self._contadores[clave] = (inicio, emitidos + 1, suprimidos, nivel)
+                return True
+            self._contadores[clave] = (inicio, emitidos, suprimidos + 1, max(nivel, record.levelno))
+            return False
+
+    def vencidos(self, ahora=None):
+        """Quita las ventanas cerradas; retorna [(logger, msg, suprimidos, nivel)] de las que suprimieron algo"""
+        ahora = ahora if ahora is not None else time.monotonic()
+        resumen = []
+        with self._lock:
+            for clave, (inicio, _, suprimidos, nivel) in list(self._contadores.items()):
+                if ahora - inicio >= self.ventana_s:
+                    del self._contadores[clave]
+                    if suprimidos:
+                        resumen.append((clave[0], clave[1], suprimidos, nivel))
+        return resumen
+
+
+class QueueHandlerNoBloqueante(QueueHandler):
+    """
+    Encola el registro sin formatearlo y sin bloquear: si la cola está llena
+    el registro se descarta (el hilo de ingesta nunca espera por stdout/journald).
+    """
+
+    def __init__(self, cola):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def prepare(self, record):
+        # El formateo ocurre en el hilo del listener, no en el hot path
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+def configurar_logging(nivel=None):
+    """
+    Configura el logging del proceso: QueueHandler no bloqueante + listener en
+    segundo plano que escribe a stderr. Es idempotente.
+    """
+    global _listener, _barrido
+    if _listener is not None:
+        return
+
+    cola = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    salida = logging.StreamHandler(sys.stderr)
+    salida.setFormatter(FormateadorEstructurado(como_json=(LOG_FORMAT == 'json')))
+
+    handler = QueueHandlerNoBloqueante(cola)
+    filtro = FiltroFrecuencia()
+    handler.addFilter(filtro)
+
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [handler]
+    raiz.setLevel(nivel or LOG_LEVEL)
+
+    _listener = QueueListener(cola, salida, respect_handler_level=False)
+    _listener.start()
+    if filtro.limite > 0:
+        _barrido = _BarridoSuprimidos(filtro, handler)
+        _barrido.start()
+    atexit.register(_detener_listener)
+
+
+class _BarridoSuprimidos(threading.Thread):
+    """Emite el conteo de registros suprimidos al cerrar su ventana, aunque la plantilla no se repita"""
+
+    def __init__(self, filtro, handler):
+        super().__init__(name="log-suprimidos", daemon=True)
+        self.filtro = filtro
+        self.handler = handler
+        self.detener = threading.Event()
+
+    def run(self):
+        while not self.detener.wait(self.filtro.ventana_s / 2):
+            self.emitir()
+
+    def emitir(self, ahora=None):
+        for nombre, msg, suprimidos, nivel in self.filtro.vencidos(ahora):
+            registro = logging.LogRecord(nombre, nivel, __file__, 0, "Registros suprimidos por frecuencia: %r",
+                                         (msg,), None)
+            registro.suprimidos = suprimidos
+            # Directo a la cola: el resumen no pasa por el filtro
+            self.handler.enqueue(registro)
+
+
+def _detener_listener():
+    global _listener, _barrido
+    if _barrido is not None:
+        _barrido.detener.set()
+        _barrido.emitir(float('inf'))
+        _barrido = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,243 @@
+# fog-layer/services/metrics.py
+
+import os
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from services.log_config import obtener_logger
+
+log = obtener_logger("transwatch.metrics")
+
+# Puerto del endpoint /metrics (formato Prometheus). 0 = deshabilitado
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+BUCKETS_LATENCIA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _formatear_etiqueta(nombre, valor):
+    if nombre is None:
+        return ''
+    valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{nombre}="{valor}"'
+
+
+class Contador:
+    """Contador monótono, opcionalmente con una etiqueta."""
+
+    tipo = 'counter'
+
+    def __init__(self, nombre, ayuda, etiqueta=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiqueta = etiqueta
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def inc(self, valor=1, etiqueta=''):
+        with self._lock:
+            self._valores[etiqueta] = self._valores.get(etiqueta, 0) + valor
+
+    def valores(self):
+        with self._lock:
+            return dict(self._valores)
+
+    def muestras(self):
+        with self._lock:
+            valores = dict(self._valores)
+        for etiqueta, valor in valores.items():
+            etiquetas = _formatear_etiqueta(self.etiqueta, etiqueta)
+            yield f"{self.nombre}{{{etiquetas}}} {valor}" if etiquetas else f"{self.nombre} {valor}"
+
+
+class Gauge:
+    """Valor instantáneo calculado al momento del scrape por `funcion` (número o dict etiqueta->número)."""
+
+    tipo = 'gauge'
+
+    def __init__(self, nombre, ayuda, funcion, etiqueta=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.funcion = funcion
+        self.etiqueta = etiqueta
+
+    def muestras(self):
+        try:
+            valor = self.funcion()
+        except Exception as e:
+            log.debug("Error evaluando gauge %s: %s", self.nombre, e)
+            return
+        if isinstance(valor, dict):
+            for etiqueta, v in valor.items():
+                yield f"{self.nombre}{{{_formatear_etiqueta(self.etiqueta, etiqueta)}}} {v}"
+        else:
+            yield f"{self.nombre} {valor}"
+
+
+class _Medicion:
+    __slots__ = ('histograma', 'etiqueta', 'inicio')
+
+    def __init__(self, histograma, etiqueta):
+        self.histograma = histograma
+        self.etiqueta = etiqueta
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histograma.observar(time.perf_counter() - self.inicio, self.etiqueta)
+        return False
+
+
+class Histograma:
+    """Histograma de latencias con buckets fijos, opcionalmente con una etiqueta."""
+
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiqueta=None, buckets=BUCKETS_LATENCIA):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiqueta = etiqueta
+        self.buckets = tuple(buckets)
+        self._series = {}  # etiqueta -> [conteos por bucket (+Inf al final), suma, total]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, etiqueta=''):
+        indice = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(etiqueta)
+            if serie is None:
+                serie = self._series[etiqueta] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def medir(self, etiqueta=''):
+        """Context manager: `with HISTOGRAMA.medir('etapa'): ...`"""
+        return _Medicion(self, etiqueta)
+
+    def percentil(self, p, etiqueta=''):
+        """Estimación del percentil p (0-100) por el límite superior del bucket."""
+        with self._lock:
+            serie = self._series.get(etiqueta)
+            if not serie or not serie[2]:
+                return None
+            conteos, total = list(serie[0]), serie[2]
+        objetivo = total * p / 100.0
+        acumulado = 0
+        for limite, conteo in zip(self.buckets + (float('inf'),), conteos):
+            acumulado += conteo
+            if acumulado >= objetivo:
+                return limite
+        return float('inf')
+
+    def resumen(self):
+        """{etiqueta: (total de observaciones, suma)} para reportes fuera de Prometheus."""
+        with self._lock:
+            return {k: (v[2], v[1]) for k, v in self._series.items()}
+
+    def muestras(self):
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        for etiqueta, (conteos, suma, total) in series.items():
+            base = _formatear_etiqueta(self.etiqueta, etiqueta)
+            prefijo = f"{base}," if base else ''
+            acumulado = 0
+            for limite, conteo in zip(self.buckets, conteos):
+                acumulado += conteo
+                yield f'{self.nombre}_bucket{{{prefijo}le="{limite}"}} {acumulado}'
+            yield f'{self.nombre}_bucket{{{prefijo}le="+Inf"}} {total}'
+            sufijo = f"{{{base}}}" if base else ''
+            yield f"{self.nombre}_sum{sufijo} {suma}"
+            yield f"{self.nombre}_count{sufijo} {total}"
+
+
+class RegistroMetricas:
+    """Registro de métricas del proceso, expuesto en formato de texto de Prometheus."""
+
+    def __init__(self):
+        self._metricas = {}
+        self._lock = threading.Lock()
+
+    def _registrar(self, metrica):
+        with self._lock:
+            existente = self._metricas.get(metrica.nombre)
+            if existente is not None:
+                return existente
+            self._metricas[metrica.nombre] = metrica
+            return metrica
+
+    def contador(self, nombre, ayuda, etiqueta=None):
+        return self._registrar(Contador(nombre, ayuda, etiqueta))
+
+    def histograma(self, nombre, ayuda, etiqueta=None, buckets=BUCKETS_LATENCIA):
+        return self._registrar(Histograma(nombre, ayuda, etiqueta, buckets))
+
+    def gauge(self, nombre, ayuda, funcion, etiqueta=None):
+        # Los gauges se reemplazan: la función puede apuntar a un objeto recreado
+        with self._lock:
+            self._metricas[nombre] = Gauge(nombre, ayuda, funcion, etiqueta)
+            return self._metricas[nombre]
+
+    def exportar(self):
+        with self._lock:
+            metricas = list(self._metricas.values())
+        lineas = []
+        for metrica in metricas:
+            lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+            lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+            lineas.extend(metrica.muestras())
+        return '\n'.join(lineas) + '\n'
+
+
+# Registro global del proceso
+registro = RegistroMetricas()
+
+# --- Métricas del pipeline del gateway ---
+MENSAJES_MQTT = registro.contador('transwatch_mqtt_mensajes_total', 'Mensajes MQTT recibidos')
+BYTES_MQTT = registro.contador('transwatch_mqtt_bytes_total', 'Bytes de payload MQTT recibidos')
+MENSAJES_MQTT_DESCARTADOS = registro.contador(
+    'transwatch_mqtt_descartados_total', 'Mensajes MQTT descartados con la cola de micro-lotes llena'
+)
+RESULTADOS_QC = registro.contador('transwatch_lecturas_total', 'Lecturas procesadas por resultado', etiqueta='resultado')
+LATENCIA_ETAPA = registro.histograma('transwatch_etapa_segundos', 'Latencia por etapa del pipeline', etiqueta='etapa')
+LATENCIA_EXTREMO = registro.histograma(
+    'transwatch_extremo_a_extremo_segundos',
+    'Tiempo desde la recepción MQTT hasta almacenar/enviar la lectura'
+)
+LATENCIA_ALERTA = registro.histograma(
+    'transwatch_alerta_entrega_segundos', 'Desde la detección de una alerta prioritaria hasta su entrega',
+    etiqueta='canal'
+)
+
+
+class _ManejadorMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        cuerpo = registro.exportar().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *args):
+        pass
+
+
+def iniciar_servidor_metricas(puerto=METRICS_PORT):
+    """Expone /metrics en un hilo daemon. Retorna el servidor o None si está deshabilitado."""
+    if not puerto:
+        return None
+    try:
+        servidor = ThreadingHTTPServer(('0.0.0.0', puerto), _ManejadorMetricas)
+    except OSError as e:
+        log.error("No se pudo iniciar el endpoint de métricas en el puerto %d: %s", puerto, e)
+        return None
+    threading.Thread(target=servidor.serve_forever, name="metrics-http", daemon=True).start()
+    log.info("Métricas Prometheus en http://0.0.0.0:%d/metrics", puerto)
+    return servidor
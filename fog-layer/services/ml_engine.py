@@ -2,6 +2,14 @@ import pandas as pd
 import numpy as np
 from sklearn.cluster import KMeans
 from sklearn.linear_model import LinearRegression
+from sklearn.ensemble import IsolationForest
+from scipy.stats import chi2
+
+MODELOS_ANOMALIA = ('covarianza_robusta', 'isolation_forest')
+# Combinaciones de banderas con menos filas usan la mediana global
+_MIN_FILAS_GRUPO = 5
+# Factor máximo de la corrección de consistencia (con datos continuos queda cerca de 1)
+_MAX_CORRECCION = 2.0
 
 class MachineLearningEngine:
     def procesar_datos(self, datos_historicos, n_clusters=3):
@@ -50,5 +58,77 @@ class MachineLearningEngine:
             "prediccion_futura": predicciones.tolist(),
             "mensaje": "Análisis completado exitosamente"
         }
+
+    def puntuar_anomalias(self, X, binarias=None, modelo='covarianza_robusta', cuantil=0.999, resolucion=None):
+        """
+        Puntaje de anomalía multivariado por fila de X (n_muestras x n_variables),
+        ajustado sobre las mismas filas. Retorna (puntaje, variable): puntaje >= 1
+        es anómalo; variable es el índice de la columna que más aporta (-1 si el
+        modelo no lo indica). `binarias` marca las columnas 0/1 (banderas): en
+        covarianza_robusta condicionan el centro y no se puntúan. `resolucion` es
+        el paso mínimo de cada columna (p. ej. 1 para el DHT11): un cambio de un
+        paso nunca cuenta como más de una desviación.
+        """
+        X = np.asarray(X, dtype=float)
+        binarias = np.zeros(X.shape[1], dtype=bool) if binarias is None else np.asarray(binarias, dtype=bool)
+        # Valores faltantes: mediana de la columna
+        if np.isnan(X).any():
+            X = np.where(np.isnan(X), np.nan_to_num(np.nanmedian(X, axis=0)), X)
+
+        if modelo == 'isolation_forest':
+            bosque = IsolationForest(n_estimators=100, random_state=42)
+            bosque.fit(X)
+            # score_samples en (-1, 0); con contamination='auto' el corte es -0.5
+            return -bosque.score_samples(X) / 0.5, np.full(len(X), -1)
+        if modelo != 'covarianza_robusta':
+            raise ValueError(f"Modelo de anomalías desconocido: {modelo!r} (use {', '.join(MODELOS_ANOMALIA)})")
+
+        # Las banderas condicionan el centro: cada combinación (p. ej. vehículo presente) tiene su
+        # propia mediana, así un estado raro pero legítimo no es anómalo por sí solo
+        continuas = ~binarias
+        C = X[:, continuas]
+        centro = np.broadcast_to(np.median(C, axis=0), C.shape).copy()
+        if binarias.any():
+            _, grupo, tamanos = np.unique(X[:, binarias], axis=0, return_inverse=True, return_counts=True)
+            grupo = grupo.ravel()
+            for g in np.flatnonzero(tamanos >= _MIN_FILAS_GRUPO):
+                filas = grupo == g
+                centro[filas] = np.median(C[filas], axis=0)
+        R = C - centro
+
+        # Estandarización robusta de los residuos con el MAD, nunca menor a la resolución.
+        # Con datos cuantizados el MAD suele ser 0: sin resolución esa variable no se puntúa
+        paso = np.zeros(C.shape[1]) if resolucion is None else np.asarray(resolucion, dtype=float)[continuas]
+        escala = np.maximum(1.4826 * np.median(np.abs(R), axis=0), paso)
+        activas = escala > 0
+        Z = R[:, activas] / escala[activas]
+        k = Z.shape[1]
+        if k == 0:
+            return np.zeros(len(X)), np.full(len(X), -1)
+        # Varianza mínima de un paso de resolución: el subconjunto recortado puede no variar nada
+        ridge = np.diag(np.maximum((paso[activas] / escala[activas]) ** 2, 1e-3))
+
+        # Dos pasadas tipo MCD: covarianza de todo y luego del 90 % más central
+        media, subconjunto = Z.mean(axis=0), Z
+        for _ in range(2):
+            inversa = np.linalg.pinv(np.atleast_2d(np.cov(subconjunto, rowvar=False)) + ridge)
+            D = Z - media
+            d2 = np.einsum('ij,jk,ik->i', D, inversa, D)
+            subconjunto = Z[d2 <= np.quantile(d2, 0.9)]
+            media = subconjunto.mean(axis=0)
+        D = Z - media
+        cov = np.atleast_2d(np.cov(subconjunto, rowvar=False))
+        inversa = np.linalg.pinv(cov + ridge)
+        aportes = D * (D @ inversa)
+        d2 = aportes.sum(axis=1)
+        # Grados de libertad efectivos: una variable que no supera su paso de resolución
+        # (varianza dominada por el piso) casi no aporta dispersión a d2
+        k = max(float(np.trace(cov @ inversa)), 0.5)
+        # Corrección de consistencia: la mediana de d2 debe coincidir con la de chi² con k g.l.
+        # Acotada: con datos cuantizados la mediana puede ser ~0 y el factor explotaría
+        d2 *= np.clip(chi2.ppf(0.5, k) / max(np.median(d2), 1e-12), 0.5, _MAX_CORRECCION)
+
+        indices = np.flatnonzero(continuas)[activas]
+        return d2 / chi2.ppf(cuantil, k), indices[aportes.argmax(axis=1)]
     
     
\ No newline at end of file
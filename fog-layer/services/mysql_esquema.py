@@ -0,0 +1,301 @@
+# fog-layer/services/mysql_esquema.py
+"""
+Esquema MySQL de TRANSWATCH: lecturas_parking particionada por mes y
+estado_actual (última lectura por dispositivo).
+
+lecturas_parking se particiona con RANGE COLUMNS(fecha_registro), una
+partición por mes más 'pmax' para lo que quede fuera. La rotación crea por
+adelantado las particiones de los próximos meses (dividiendo pmax, que está
+vacía) y, si hay retención configurada, elimina las de meses vencidos con
+DROP PARTITION, sin recorrer filas.
+
+estado_actual tiene una fila por dispositivo que EscritorMySQL actualiza
+(upsert) en la misma transacción que cada lote, así la consulta del último
+estado no depende del tamaño del historial.
+
+  python -m services.mysql_esquema --crear          # tablas nuevas
+  python -m services.mysql_esquema --migrar         # tabla existente: índices, device_id y particiones
+  python -m services.mysql_esquema --rotar          # una pasada de rotación (cron)
+  python -m services.mysql_esquema --cada 86400     # rotación periódica
+"""
+
+import re
+import os
+import sys
+import time
+import argparse
+from datetime import date
+
+from dotenv import load_dotenv
+
+from services.log_config import configurar_logging, obtener_logger
+from services.mysql_store import conexion, DB_CONFIG, DEVICE_ID_DEFAULT
+
+load_dotenv()
+
+log = obtener_logger("transwatch.mysql")
+
+# Particiones mensuales que se mantienen creadas por delante del mes actual
+MYSQL_PARTICIONES_ADELANTE = int(os.getenv('MYSQL_PARTICIONES_ADELANTE', '3'))
+# Meses de lecturas que se conservan (0 = sin límite)
+MYSQL_RETENCION_MESES = int(os.getenv('MYSQL_RETENCION_MESES', '0'))
+
+_COLUMNAS_LECTURA = f"""
+    device_id VARCHAR(64) NOT NULL DEFAULT '{DEVICE_ID_DEFAULT}',
+    fecha_registro DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    timestamp_esp VARCHAR(32) NULL,
+    temperatura_celsius FLOAT NULL,
+    humedad_porcentaje FLOAT NULL,
+    luz_adc INT NULL,
+    distancia_entrada_cm FLOAT NULL,
+    vehiculo_detectado_entrada TINYINT(1) NULL,
+    barrera_abierta TINYINT(1) NULL,
+    luces_parking_encendidas TINYINT(1) NULL,
+    alarma_temperatura_activa TINYINT(1) NULL,
+    config_distancia_ocupado_cm INT NULL,
+    config_umbral_luz_adc INT NULL,
+    config_temp_alerta_celsius FLOAT NULL"""
+
+# La clave primaria incluye fecha_registro: MySQL exige la columna de partición en toda clave única
+SQL_CREAR_LECTURAS = f"""
+    CREATE TABLE IF NOT EXISTS lecturas_parking (
+        id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,{_COLUMNAS_LECTURA},
+        PRIMARY KEY (id, fecha_registro),
+        KEY idx_fecha_registro (fecha_registro),
+        KEY idx_device_fecha (device_id, fecha_registro)
+    ) ENGINE=InnoDB
+    PARTITION BY RANGE COLUMNS(fecha_registro) ({{particiones}})
+"""
+
+SQL_CREAR_ESTADO_ACTUAL = f"""
+    CREATE TABLE IF NOT EXISTS estado_actual ({_COLUMNAS_LECTURA},
+        PRIMARY KEY (device_id)
+    ) ENGINE=InnoDB
+"""
+
+_PARTICION_RE = re.compile(r'^p(\d{4})(\d{2})$')
+
+
+def _sumar_meses(dia, meses):
+    indice = dia.year * 12 + dia.month - 1 + meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+
+def _definicion_particion(mes):
+    """Partición del mes `mes` (primer día): p202610 VALUES LESS THAN ('2026-11-01')"""
+    return f"PARTITION p{mes:%Y%m} VALUES LESS THAN ('{_sumar_meses(mes, 1):%Y-%m-%d}')"
+
+
+def _particiones_iniciales(hoy, adelante):
+    mes = date(hoy.year, hoy.month, 1)
+    definiciones = [_definicion_particion(_sumar_meses(mes, i)) for i in range(adelante + 1)]
+    definiciones.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+    return ", ".join(definiciones)
+
+
+def _ejecutar(cursor, sql, parametros=None):
+    log.info("MySQL: %s", " ".join(sql.split())[:200])
+    cursor.execute(sql, parametros)
+
+
+def particiones_actuales(cursor):
+    """Nombres de las particiones de lecturas_parking (vacío si no está particionada)"""
+    cursor.execute("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'lecturas_parking' AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """, (DB_CONFIG['database'],))
+    return [fila[0] for fila in cursor.fetchall()]
+
+
+def _existe_tabla(cursor, tabla):
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+    """, (DB_CONFIG['database'], tabla))
+    return cursor.fetchone()[0] > 0
+
+
+def _columnas(cursor, tabla):
+    cursor.execute("""
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+    """, (DB_CONFIG['database'], tabla))
+    return {fila[0] for fila in cursor.fetchall()}
+
+
+def _indices(cursor, tabla):
+    cursor.execute("""
+        SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+    """, (DB_CONFIG['database'], tabla))
+    return {fila[0] for fila in cursor.fetchall()}
+
+
+def crear_esquema(hoy=None, adelante=MYSQL_PARTICIONES_ADELANTE):
+    """Crea lecturas_parking (particionada) y estado_actual si no existen"""
+    hoy = hoy or date.today()
+    with conexion() as conn:
+        cursor = conn.cursor()
+        try:
+            _ejecutar(cursor, SQL_CREAR_LECTURAS.format(particiones=_particiones_iniciales(hoy, adelante)))
+            _ejecutar(cursor, SQL_CREAR_ESTADO_ACTUAL)
+            conn.commit()
+        finally:
+            cursor.close()
+
+
+def migrar(particionar=True, hoy=None, adelante=MYSQL_PARTICIONES_ADELANTE):
+    """
+    Lleva una lecturas_parking existente al esquema actual: device_id, índices
+    por fecha y, con `particionar`, la clave primaria (id, fecha_registro) y las
+    particiones mensuales. Particionar reescribe la tabla completa: conviene
+    hacerlo en una ventana de mantenimiento (y requiere fecha_registro sin NULL).
+    """
+    hoy = hoy or date.today()
+    with conexion() as conn:
+        cursor = conn.cursor()
+        try:
+            existe = _existe_tabla(cursor, 'lecturas_parking')
+        finally:
+            cursor.close()
+    if not existe:
+        crear_esquema(hoy, adelante)
+        return
+
+    with conexion() as conn:
+        cursor = conn.cursor()
+        try:
+            if 'device_id' not in _columnas(cursor, 'lecturas_parking'):
+                _ejecutar(cursor, f"""
+                    ALTER TABLE lecturas_parking
+                    ADD COLUMN device_id VARCHAR(64) NOT NULL DEFAULT '{DEVICE_ID_DEFAULT}' FIRST
+                """)
+            indices = _indices(cursor, 'lecturas_parking')
+            if 'idx_fecha_registro' not in indices:
+                _ejecutar(cursor, "ALTER TABLE lecturas_parking ADD INDEX idx_fecha_registro (fecha_registro)")
+            if 'idx_device_fecha' not in indices:
+                _ejecutar(cursor, "ALTER TABLE lecturas_parking ADD INDEX idx_device_fecha (device_id, fecha_registro)")
+
+            if particionar and not particiones_actuales(cursor):
+                # La fecha de partición debe ser NOT NULL y formar parte de la clave primaria
+                _ejecutar(cursor, """
+                    ALTER TABLE lecturas_parking
+                    MODIFY fecha_registro DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    DROP PRIMARY KEY, ADD PRIMARY KEY (id, fecha_registro)
+                """)
+                cursor.execute("SELECT MIN(fecha_registro) FROM lecturas_parking")
+                primera = cursor.fetchone()[0]
+                desde = date(primera.year, primera.month, 1) if primera else date(hoy.year, hoy.month, 1)
+                meses = (hoy.year - desde.year) * 12 + hoy.month - desde.month + adelante
+                definiciones = [_definicion_particion(_sumar_meses(desde, i)) for i in range(meses + 1)]
+                definiciones.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+                _ejecutar(cursor, f"""
+                    ALTER TABLE lecturas_parking
+                    PARTITION BY RANGE COLUMNS(fecha_registro) ({", ".join(definiciones)})
+                """)
+
+            _ejecutar(cursor, SQL_CREAR_ESTADO_ACTUAL)
+            if not _filas(cursor, 'estado_actual'):
+                poblar_estado_actual(cursor)
+            conn.commit()
+        finally:
+            cursor.close()
+
+
+def _filas(cursor, tabla):
+    cursor.execute(f"SELECT COUNT(*) FROM {tabla}")
+    return cursor.fetchone()[0]
+
+
+def poblar_estado_actual(cursor):
+    """Llena estado_actual con la última lectura de cada dispositivo (una vez, al migrar)"""
+    columnas = [c.split()[0] for c in _COLUMNAS_LECTURA.strip().split(',\n')]
+    lista = ", ".join(columnas)
+    _ejecutar(cursor, f"""
+        REPLACE INTO estado_actual ({lista})
+        SELECT {", ".join('l.' + c for c in columnas)}
+        FROM lecturas_parking l
+        JOIN (SELECT device_id, MAX(fecha_registro) AS ultima FROM lecturas_parking GROUP BY device_id) u
+          ON u.device_id = l.device_id AND u.ultima = l.fecha_registro
+        ORDER BY l.id
+    """)
+
+
+def rotar_particiones(hoy=None, adelante=MYSQL_PARTICIONES_ADELANTE, retencion_meses=MYSQL_RETENCION_MESES):
+    """
+    Crea las particiones que falten hasta `adelante` meses y elimina las
+    anteriores a la retención. Idempotente. Retorna (creadas, eliminadas).
+    """
+    hoy = hoy or date.today()
+    mes_actual = date(hoy.year, hoy.month, 1)
+    creadas, eliminadas = [], []
+    with conexion() as conn:
+        cursor = conn.cursor()
+        try:
+            nombres = particiones_actuales(cursor)
+            if not nombres:
+                log.warning("lecturas_parking no está particionada; ejecute --migrar")
+                return creadas, eliminadas
+            meses = sorted(
+                date(int(m.group(1)), int(m.group(2)), 1)
+                for m in (_PARTICION_RE.match(n) for n in nombres) if m
+            )
+
+            # Nuevas particiones: se separan de pmax, que solo recibe fechas posteriores a la última
+            ultimo = meses[-1] if meses else _sumar_meses(mes_actual, -1)
+            faltantes = []
+            mes = _sumar_meses(ultimo, 1)
+            while mes <= _sumar_meses(mes_actual, adelante):
+                faltantes.append(mes)
+                mes = _sumar_meses(mes, 1)
+            if faltantes:
+                definiciones = [_definicion_particion(m) for m in faltantes]
+                definiciones.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+                _ejecutar(cursor, f"""
+                    ALTER TABLE lecturas_parking REORGANIZE PARTITION pmax INTO ({", ".join(definiciones)})
+                """)
+                creadas = [f"p{m:%Y%m}" for m in faltantes]
+
+            if retencion_meses > 0:
+                limite = _sumar_meses(mes_actual, -retencion_meses)
+                vencidas = [f"p{m:%Y%m}" for m in meses if m < limite]
+                # Siempre queda al menos una partición con rango
+                if vencidas and len(vencidas) < len(meses) + len(faltantes):
+                    _ejecutar(cursor, f"ALTER TABLE lecturas_parking DROP PARTITION {', '.join(vencidas)}")
+                    eliminadas = vencidas
+            conn.commit()
+        finally:
+            cursor.close()
+    if creadas or eliminadas:
+        log.info("Particiones creadas: %s; eliminadas: %s", creadas or '-', eliminadas or '-')
+    return creadas, eliminadas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Esquema y rotación de particiones MySQL de TRANSWATCH")
+    grupo = parser.add_mutually_exclusive_group(required=True)
+    grupo.add_argument('--crear', action='store_true', help="Crear las tablas si no existen")
+    grupo.add_argument('--migrar', action='store_true', help="Actualizar una lecturas_parking existente")
+    grupo.add_argument('--rotar', action='store_true', help="Una pasada de rotación de particiones")
+    grupo.add_argument('--cada', type=int, help="Rotar cada N segundos")
+    parser.add_argument('--sin-particionar', action='store_true',
+                        help="Con --migrar: solo índices y estado_actual, sin reescribir la tabla")
+    args = parser.parse_args()
+
+    configurar_logging()
+    if args.crear:
+        crear_esquema()
+    elif args.migrar:
+        migrar(particionar=not args.sin_particionar)
+    elif args.rotar:
+        rotar_particiones()
+    else:
+        try:
+            while True:
+                rotar_particiones()
+                time.sleep(args.cada)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# fog-layer/services/mysql_store.py
+
+import os
+import time
+import queue
+import threading
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector import pooling
+from dotenv import load_dotenv
+
+from services.ingest_batcher import MicroBatcher
+from services.log_config import obtener_logger
+from services.metrics import registro, LATENCIA_ETAPA
+
+load_dotenv()
+
+log = obtener_logger("transwatch.mysql")
+
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'localhost'),
+    'user': os.getenv('DB_USER', 'root'),
+    'password': os.getenv('DB_PASSWORD'),
+    'database': os.getenv('DB_NAME', 'parking_inteligente_db')
+}
+# Conexiones reutilizables compartidas por los hilos del proceso (máximo 32 en mysql-connector)
+MYSQL_POOL_SIZE = int(os.getenv('MYSQL_POOL_SIZE', '4'))
+# Espera máxima por una conexión libre cuando todas están prestadas
+MYSQL_POOL_ESPERA_S = float(os.getenv('MYSQL_POOL_ESPERA_S', '5'))
+# Inserción por lotes: N filas o T ms, lo que ocurra primero
+MYSQL_LOTE = int(os.getenv('MYSQL_LOTE', '200'))
+MYSQL_FLUSH_MS = int(os.getenv('MYSQL_FLUSH_MS', '500'))
+# Con el esquema antiguo se vuelve a revisar cada este intervalo (toma la migración sin reiniciar)
+MYSQL_ESQUEMA_REVISION_S = float(os.getenv('MYSQL_ESQUEMA_REVISION_S', '60'))
+
+DEVICE_ID_DEFAULT = "ESP32-Parking-Transwatch"
+
+COLUMNAS_LECTURA = (
+    'device_id', 'timestamp_esp', 'temperatura_celsius', 'humedad_porcentaje', 'luz_adc',
+    'distancia_entrada_cm', 'vehiculo_detectado_entrada', 'barrera_abierta',
+    'luces_parking_encendidas', 'alarma_temperatura_activa',
+    'config_distancia_ocupado_cm', 'config_umbral_luz_adc', 'config_temp_alerta_celsius'
+)
+
+
+def _sql_insertar(tabla, columnas):
+    return f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({', '.join(['%s'] * len(columnas))})"
+
+
+SQL_INSERTAR_LECTURA = _sql_insertar('lecturas_parking', COLUMNAS_LECTURA)
+# Esquema anterior a services.mysql_esquema (sin device_id)
+SQL_INSERTAR_LECTURA_ANTIGUA = _sql_insertar('lecturas_parking', COLUMNAS_LECTURA[1:])
+# Última lectura por dispositivo: una fila por device_id, actualizada en el mismo commit del lote
+SQL_UPSERT_ESTADO_ACTUAL = _sql_insertar('estado_actual', COLUMNAS_LECTURA) + " ON DUPLICATE KEY UPDATE " + ", ".join(
+    ['fecha_registro = CURRENT_TIMESTAMP'] + [f"{c} = VALUES({c})" for c in COLUMNAS_LECTURA[1:]]
+)
+
+FILAS_MYSQL = registro.contador(
+    'transwatch_mysql_filas_total', 'Filas de lecturas_parking insertadas o descartadas', etiqueta='resultado'
+)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool():
+    """Pool de conexiones del proceso, creado en el primer uso"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name="transwatch", pool_size=MYSQL_POOL_SIZE, pool_reset_session=True, **DB_CONFIG
+                )
+                log.info("Pool MySQL creado (%d conexiones) hacia %s", MYSQL_POOL_SIZE, DB_CONFIG['host'])
+    return _pool
+
+
+@contextmanager
+def conexion():
+    """Conexión prestada del pool; al salir vuelve al pool (close() no la cierra)"""
+    pool = obtener_pool()
+    limite = time.monotonic() + MYSQL_POOL_ESPERA_S
+    while True:
+        try:
+            conn = pool.get_connection()
+            break
+        except pooling.PoolError:
+            # mysql-connector no espera: reintentar hasta que se libere una conexión
+            if time.monotonic() >= limite:
+                raise
+            time.sleep(0.05)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def _primero(datos, *claves):
+    for clave in claves:
+        valor = datos.get(clave)
+        if valor is not None:
+            return valor
+    return None
+
+
+def fila_lectura(datos):
+    """JSON del ESP32 (nombres antiguos o canónicos) -> tupla para SQL_INSERTAR_LECTURA"""
+    config = datos.get('config') or {}
+    return (
+        str(datos.get('device_id') or DEVICE_ID_DEFAULT),
+        datos.get('timestamp'),
+        _primero(datos, 'temperatura', 'temperatura_celsius'),
+        _primero(datos, 'humedad', 'humedad_porcentaje'),
+        datos.get('luz_adc'),
+        _primero(datos, 'distancia_cm', 'distancia_entrada_cm'),
+        _primero(datos, 'vehiculo_en_entrada_detectado', 'vehiculo_detectado_entrada'),
+        datos.get('barrera_abierta'),
+        datos.get('luces_parking_encendidas'),
+        datos.get('alarma_temperatura_activa'),
+        config.get('distancia_ocupado_cm'),
+        config.get('umbral_luz_adc'),
+        config.get('temperatura_alerta_celsius')
+    )
+
+
+class EscritorMySQL:
+    """
+    Inserta filas en lecturas_parking por lotes con executemany y un solo
+    commit por lote, usando conexiones del pool. En el mismo commit actualiza
+    estado_actual con la última fila de cada dispositivo del lote. Las filas
+    se encolan y se escriben en el hilo del MicroBatcher; un lote fallido por
+    conexión caída se reintenta una vez con otra conexión.
+
+    Si la BD aún tiene el esquema antiguo (sin device_id ni estado_actual) se
+    usa el INSERT anterior hasta que se ejecute services.mysql_esquema --migrar;
+    el esquema se vuelve a revisar cada MYSQL_ESQUEMA_REVISION_S mientras sea
+    el antiguo, y también si el INSERT actual falla por columnas o tablas
+    inexistentes (BD restaurada desde un respaldo previo).
+    """
+
+    def __init__(self, max_lote=MYSQL_LOTE, flush_ms=MYSQL_FLUSH_MS, revision_s=MYSQL_ESQUEMA_REVISION_S):
+        self._esquema_actual = None   # se detecta con el primer lote
+        self._revisar_en = 0.0
+        self.revision_s = revision_s
+        self._batcher = MicroBatcher(self._escribir_lote, max_lote, flush_ms)
+        self._batcher.iniciar()
+
+    @property
+    def cola(self):
+        return self._batcher.cola
+
+    def agregar(self, fila):
+        """Encola una fila; bloquea si la cola está llena (contrapresión)"""
+        self._batcher.agregar(fila)
+
+    def agregar_sin_esperar(self, fila):
+        """Encola una fila sin bloquear. Retorna False si la cola está llena."""
+        try:
+            self._batcher.cola.put_nowait(fila)
+            return True
+        except queue.Full:
+            return False
+
+    def _escribir_lote(self, filas):
+        for intento in (1, 2):
+            try:
+                with LATENCIA_ETAPA.medir('mysql_executemany'), conexion() as conn:
+                    cursor = conn.cursor()
+                    try:
+                        if self._esquema_actual is None or (
+                                not self._esquema_actual and time.monotonic() >= self._revisar_en):
+                            self._actualizar_esquema(cursor)
+                        if self._esquema_actual:
+                            cursor.executemany(SQL_INSERTAR_LECTURA, filas)
+                            # dict conserva la última fila de cada dispositivo
+                            ultimas = list({fila[0]: fila for fila in filas}.values())
+                            cursor.executemany(SQL_UPSERT_ESTADO_ACTUAL, ultimas)
+                        else:
+                            cursor.executemany(SQL_INSERTAR_LECTURA_ANTIGUA, [fila[1:] for fila in filas])
+                        conn.commit()
+                    finally:
+                        cursor.close()
+                FILAS_MYSQL.inc(len(filas), etiqueta='insertada')
+                log.debug("Lote de %d filas insertado en MySQL", len(filas))
+                return
+            except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError) as e:
+                if intento == 1:
+                    log.warning("Conexión MySQL perdida (%s); se reintenta el lote", e)
+                    continue
+                log.error("Error de conexión MySQL; se descartan %d filas: %s", len(filas), e)
+            except mysql.connector.errors.ProgrammingError as e:
+                # Columna o tabla inexistente: el esquema cambió desde la detección
+                log.error("Error insertando lote de %d filas en MySQL: %s", len(filas), e)
+                self._esquema_actual = None
+            except mysql.connector.Error as e:
+                log.error("Error insertando lote de %d filas en MySQL: %s", len(filas), e)
+            except Exception as e:
+                log.exception("Error inesperado insertando en MySQL: %s", e)
+            FILAS_MYSQL.inc(len(filas), etiqueta='descartada')
+            return
+
+    def _actualizar_esquema(self, cursor):
+        anterior = self._esquema_actual
+        self._esquema_actual = self._detectar_esquema(cursor)
+        self._revisar_en = time.monotonic() + self.revision_s
+        if self._esquema_actual and anterior is False:
+            log.info("Esquema MySQL migrado detectado; se usa device_id y estado_actual")
+        elif not self._esquema_actual and anterior is not False:
+            log.warning("Esquema MySQL antiguo (sin device_id/estado_actual); ejecute python -m services.mysql_esquema "
+                        "--migrar (se detecta sin reiniciar, se revisa cada %.0f s)", self.revision_s)
+
+    @staticmethod
+    def _detectar_esquema(cursor):
+        cursor.execute("""
+            SELECT COUNT(DISTINCT TABLE_NAME) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND COLUMN_NAME = 'device_id'
+              AND TABLE_NAME IN ('lecturas_parking', 'estado_actual')
+        """)
+        return cursor.fetchone()[0] == 2
+
+    def detener(self):
+        """Escribe las filas pendientes y detiene el hilo"""
+        self._batcher.detener()
@@ -2,64 +2,107 @@ import os
 import json
 import smtplib
 import asyncio
-import traceback
 from datetime import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
-from services.ml_engine import MachineLearningEngine
 import websockets
 from services.tsdb_manager import TimeSeriesManager
+from services.alert_store import AlertStore
+from services.alertas_recientes import RegistroAlertasRecientes
+from services.lectura import Lectura
+from services.log_config import obtener_logger
+from services.metrics import LATENCIA_ETAPA, LATENCIA_ALERTA, registro
+from services.carriles import CARRIL_EMAIL_WORKERS
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 # Cargar variables de entorno
 load_dotenv()
 
+log = obtener_logger("transwatch.notificaciones")
+
+WEBSOCKET_PORT = int(os.getenv('WEBSOCKET_PORT', '8765'))
+
+ALERTAS_ENVIADAS = registro.contador('transwatch_alertas_total', 'Alertas notificadas por tipo', etiqueta='tipo')
+
+# Espera máxima del carril de alertas por el envío WebSocket en el loop
+_ESPERA_WEBSOCKET_S = 5.0
+
 class NotificationEngine:
-    def __init__(self):
+    def __init__(self, canal_fanout=None, alert_store=None):
         self.websocket_clients = set()
         self.alert_rules = self._cargar_reglas_alertas()
         self.websocket_server = None
+        # En modo sharded los workers no tienen clientes propios: publican los
+        # mensajes ya serializados en este canal y el proceso fan-out los difunde
+        self.canal_fanout = canal_fanout
+        # Canal aparte para las alertas: no esperan detrás de la telemetría encolada al fan-out
+        self.canal_alertas = None
+        # Se crea al almacenar la primera alerta (el proceso fan-out y la API no lo necesitan)
+        self.alert_store = alert_store
+        # Alertas recientes en memoria para el resumen que recibe cada cliente al conectarse
+        self.alertas_recientes = RegistroAlertasRecientes()
+        # False cuando el registro ya se restauró desde un snapshot
+        self.precargar_alertas = True
+        # MonitorVivacidad del proceso (None en el fan-out del modo sharded)
+        self.monitor_vivacidad = None
+        # Emails de alertas prioritarias: pool propio, no el executor que comparten los análisis
+        self._pool_email = None
 
     async def start_websocket_server(self):
         """Inicia el servidor WebSocket"""
         try:
+            if self.precargar_alertas:
+                await asyncio.get_running_loop().run_in_executor(None, self._precargar_alertas)
             self.websocket_server = await websockets.serve(
                 self.handle_websocket_connection,
                 "0.0.0.0",  # Permitir conexiones desde cualquier IP
-                8765
+                WEBSOCKET_PORT
             )
-            print("Servidor WebSocket iniciado en ws://0.0.0.0:8765")
+            log.info("Servidor WebSocket iniciado en ws://0.0.0.0:%d", WEBSOCKET_PORT)
             await self.websocket_server.wait_closed()
         except Exception as e:
-            print(f"Error iniciando servidor WebSocket: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error iniciando servidor WebSocket: %s", e)
     
+    def _precargar_alertas(self):
+        """Llena el registro de alertas recientes desde la base de datos al arrancar"""
+        try:
+            if self.alert_store is None:
+                self.alert_store = AlertStore()
+            self.alertas_recientes.precargar(self.alert_store)
+        except Exception as e:
+            log.error("No se pudo precargar el historial de alertas: %s", e)
+
+    @staticmethod
+    def _ejecutar_analisis(start, end, n_clusters):
+        """Consulta el rango y ejecuta el clustering (en un hilo del executor)"""
+        # pandas/scikit-learn se importan con la primera solicitud de análisis, no al arrancar
+        from services.ml_engine import MachineLearningEngine
+
+        tsdb = TimeSeriesManager()
+        try:
+            historico = tsdb.consultar_rango_fechas(start, end)
+        finally:
+            tsdb.close()
+        return MachineLearningEngine().procesar_datos(historico, n_clusters)
+
     def _almacenar_alerta_bd(self, alerta):
-        """Almacena una alerta en la base de datos usando TimeSeriesManager"""
+        """Encola la alerta en el AlertStore (measurement 'alerta', escrito por lotes)"""
         try:
-            ts_manager = TimeSeriesManager()
-            datos_alerta = {
-                "timestamp": datetime.now().isoformat(),
-                "tipo_alerta": alerta.get("type", "unknown"),
-                "mensaje": alerta.get("message", ""),
-                "prioridad": alerta.get("priority", "low")
-            }
-            ts_manager.almacenar_lectura(datos_alerta, "ALERT", "sistema_alertas")
-            print("Alerta almacenada en BD exitosamente")
+            if self.alert_store is None:
+                self.alert_store = AlertStore()
+            self.alert_store.registrar(alerta)
         except Exception as e:
-            print(f"Error almacenando alerta en BD: {e}")
-            
+            log.error("Error almacenando alerta en BD: %s", e)
 
     async def handle_websocket_connection(self, websocket):
         """Maneja conexiones WebSocket e interacciones de IA"""
         try:
             self.websocket_clients.add(websocket)
-            print(f"Nueva conexión WebSocket establecida. Total clientes: {len(self.websocket_clients)}")
+            log.info("Nueva conexión WebSocket establecida", extra={'clientes': len(self.websocket_clients)})
             
             # --- 1. ENVÍO DE DATOS HISTÓRICOS INICIALES ---
-            print("Cliente conectado. Enviando datos históricos recientes...")
             try:
                 tsdb = TimeSeriesManager()
                 # Mantenemos esto para que la gráfica principal no empiece vacía
@@ -68,11 +111,22 @@ class NotificationEngine:
                 
                 if historico:
                     await websocket.send(json.dumps(historico))
-                    print(f"Enviados {len(historico)} puntos históricos al nuevo cliente.")
+                    log.debug("Enviados %d puntos históricos al nuevo cliente.", len(historico))
                 else:
-                    print("No se encontró historial reciente.")
+                    log.debug("No se encontró historial reciente.")
             except Exception as e:
-                print(f"Error al enviar datos históricos: {e}")
+                log.error("Error al enviar datos históricos: %s", e)
+
+            # Resumen de alertas recientes desde memoria (sin consulta a la BD por conexión)
+            try:
+                await websocket.send(json.dumps({
+                    "type": "alert_summary",
+                    "data": self.alertas_recientes.resumen()
+                }))
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            except Exception as e:
+                log.error("Error al enviar resumen de alertas: %s", e)
 
             # --- 2. BUCLE PRINCIPAL DE MENSAJES ---
             try:
@@ -86,21 +140,17 @@ class NotificationEngine:
 
                         # B) LÓGICA DE IA: SOLICITUD DE ANÁLISIS
                         elif data.get('type') == 'request_analysis':
-                            print("Solicitud de análisis IA recibida...")
+                            log.info("Solicitud de análisis IA recibida")
                             
                             # 1. Obtener parámetros desde el Frontend
                             start = data.get('start_date')
                             end = data.get('end_date')
                             n_clusters = int(data.get('n_clusters', 3))
                             
-                            # 2. Consultar Base de Datos (Usando la nueva función de rangos)
-                            tsdb = TimeSeriesManager()
-                            historico = tsdb.consultar_rango_fechas(start, end)
-                            tsdb.close()
-                            
-                            # 3. Ejecutar el Motor de IA (Clustering + Inferencia)
-                            ml_engine = MachineLearningEngine()
-                            resultado = ml_engine.procesar_datos(historico, n_clusters)
+                            # 2-3. Consulta y motor de IA fuera del loop (no frena telemetría ni alertas)
+                            resultado = await asyncio.get_running_loop().run_in_executor(
+                                None, self._ejecutar_analisis, start, end, n_clusters
+                            )
                             
                             # 4. Enviar resultados de vuelta al cliente
                             response = {
@@ -108,23 +158,27 @@ class NotificationEngine:
                                 "data": resultado
                             }
                             await websocket.send(json.dumps(response))
-                            print("Resultados de IA enviados al cliente correctamente.")
+                            log.info("Resultados de IA enviados al cliente correctamente.")
+
+                        # C) Estado de vivacidad y estadísticas de gaps por dispositivo
+                        elif data.get('type') == 'device_liveness':
+                            estadisticas = None
+                            if self.monitor_vivacidad is not None:
+                                estadisticas = self.monitor_vivacidad.estadisticas(data.get('device_id'))
+                            await websocket.send(json.dumps({"type": "device_liveness", "data": estadisticas}))
 
                     except json.JSONDecodeError:
-                        print("Mensaje no JSON recibido")
+                        log.warning("Mensaje no JSON recibido")
                     except Exception as e:
-                        print(f"Error procesando mensaje: {e}")
-                        traceback.print_exc()
+                        log.exception("Error procesando mensaje: %s", e)
 
             except websockets.exceptions.ConnectionClosed:
                 pass
             finally:
                 self.websocket_clients.remove(websocket)
-                print(f"Cliente WebSocket desconectado. Total clientes: {len(self.websocket_clients)}")
+                log.info("Cliente WebSocket desconectado", extra={'clientes': len(self.websocket_clients)})
         except Exception as e:
-            print(f"Error crítico en conexión WebSocket: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error crítico en conexión WebSocket: %s", e)
 
     # async def handle_websocket_connection(self, websocket):
     #     """Maneja conexiones WebSocket"""
@@ -188,74 +242,102 @@ class NotificationEngine:
             }
         }
 
+    @staticmethod
+    def alerta_vivacidad(device_id, online, info):
+        """Alerta de dispositivo sin datos (offline) o que volvió a reportar (online)"""
+        if online:
+            return {
+                "type": "dispositivo_online",
+                "message": f"Dispositivo {device_id} volvió a reportar tras {info['segundos_sin_datos']:.0f}s sin datos",
+                "priority": "info",
+                "channels": ["websocket", "database"],
+                "data": info
+            }
+        return {
+            "type": "dispositivo_offline",
+            "message": f"DISPOSITIVO SIN DATOS: {device_id} no reporta desde hace {info['segundos_sin_datos']:.0f}s",
+            "priority": "high",
+            "channels": ["websocket", "database", "email"],
+            "data": info
+        }
+
     def evaluar_alertas(self, datos, qc_status=True, qc_message="OK"):
         """Evalúa los datos y retorna las alertas activadas"""
         alertas = []
         datos["qc_approved"] = qc_status
         datos["qc_message"] = qc_message
+        datos_alerta = None
 
         for alert_id, rule in self.alert_rules.items():
             try:
                 if rule["condition"](datos):
+                    # Solo se materializa un dict serializable cuando realmente hay alerta
+                    if datos_alerta is None:
+                        datos_alerta = datos.a_dict() if isinstance(datos, Lectura) else datos
                     alertas.append({
                         "type": alert_id,
                         "message": rule["message"](datos),
                         "priority": rule["priority"],
                         "channels": rule["channels"],
-                        "data": datos
+                        "data": datos_alerta
                     })
             except Exception as e:
-                print(f"Error evaluando regla {alert_id}: {e}")
+                log.error("Error evaluando regla %s: %s", alert_id, e)
 
         return alertas
 
-    async def _enviar_email(self, alerta):
-        """Envía una alerta por email"""
-        try:
-            smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-            smtp_port = int(os.getenv("SMTP_PORT", "587"))
-            email_from = os.getenv("EMAIL_FROM")
-            email_pass = os.getenv("EMAIL_PASSWORD").strip()
-            email_to = os.getenv("EMAIL_TO")
+    def _mensaje_email(self, alerta):
+        """Arma el email de una alerta: (servidor, puerto, remitente, clave, mensaje) o None sin credenciales"""
+        smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+        smtp_port = int(os.getenv("SMTP_PORT", "587"))
+        email_from = os.getenv("EMAIL_FROM")
+        email_pass = (os.getenv("EMAIL_PASSWORD") or "").strip()
+        email_to = os.getenv("EMAIL_TO")
 
-            print(f"DEBUG - Enviando email con credenciales: {email_from} -> {email_to}")
+        log.debug("Enviando email de alerta: %s -> %s", email_from, email_to)
 
-            if not all([email_from, email_pass, email_to]):
-                print("Error: Faltan credenciales de email")
-                return
+        if not all([email_from, email_pass, email_to]):
+            log.error("Faltan credenciales de email")
+            return None
 
-            msg = MIMEMultipart()
-            msg["From"] = email_from
-            msg["To"] = email_to
-            msg["Subject"] = f"Alerta Transwatch - {alerta['type']}"
+        msg = MIMEMultipart()
+        msg["From"] = email_from
+        msg["To"] = email_to
+        msg["Subject"] = f"Alerta Transwatch - {alerta['type']}"
 
-            # Acceder a los datos correctamente
-            datos = alerta.get('data', {})
-            body = f"""
-            ALERTA DEL SISTEMA TRANSWATCH
-            
-            Tipo: {alerta['type']}
-            Mensaje: {alerta['message']}
-            Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-            
-            Estado del sistema:
-            - Vehículo detectado: {datos.get('vehiculo_en_entrada_detectado', 'N/A')}
-            - Temperatura: {datos.get('temperatura_celsius', 'N/A')}°C
-            - Humedad: {datos.get('humedad_porcentaje', 'N/A')}%
-            """
+        # Acceder a los datos correctamente
+        datos = alerta.get('data', {})
+        body = f"""
+        ALERTA DEL SISTEMA TRANSWATCH
+        
+        Tipo: {alerta['type']}
+        Mensaje: {alerta['message']}
+        Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        
+        Estado del sistema:
+        - Vehículo detectado: {datos.get('vehiculo_en_entrada_detectado', 'N/A')}
+        - Temperatura: {datos.get('temperatura_celsius', 'N/A')}°C
+        - Humedad: {datos.get('humedad_porcentaje', 'N/A')}%
+        """
 
-            msg.attach(MIMEText(body, "plain"))
+        msg.attach(MIMEText(body, "plain"))
+        return smtp_server, smtp_port, email_from, email_pass, msg
+
+    async def _enviar_email(self, alerta):
+        """Envía una alerta por email"""
+        try:
+            email = self._mensaje_email(alerta)
+            if email is None:
+                return
 
             # Usar run_in_executor para operaciones bloqueantes
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, self._send_email_sync, smtp_server, smtp_port, email_from, email_pass, msg)
+            await loop.run_in_executor(None, self._send_email_sync, *email)
             
-            print(f"Email de alerta enviado: {alerta['type']}")
+            log.info("Email de alerta enviado: %s", alerta['type'])
             
         except Exception as e:
-            print(f"Error enviando email: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error enviando email: %s", e)
 
     def _send_email_sync(self, smtp_server, smtp_port, email_from, email_pass, msg):
         """Método síncrono para enviar email"""
@@ -266,8 +348,13 @@ class NotificationEngine:
 
     async def _enviar_websocket(self, alerta):
         """Envía alerta a todos los clientes WebSocket conectados"""
+        canal = self.canal_alertas or self.canal_fanout
+        if canal is not None:
+            canal.put(json.dumps({"type": "alert", "data": alerta}))
+            return
+
         if not self.websocket_clients:
-            print("No hay clientes WebSocket conectados")
+            log.debug("No hay clientes WebSocket conectados")
             return
             
         try:
@@ -275,20 +362,16 @@ class NotificationEngine:
                 "type": "alert",
                 "data": alerta
             })
-            print(f"Enviando mensaje WebSocket: {mensaje}")
             
             clientes_desconectados = []
             for cliente in self.websocket_clients:
                 try:
-                    print(f"Intentando enviar mensaje a cliente WebSocket...")
                     await cliente.send(mensaje)
-                    print("Mensaje enviado exitosamente")
                 except websockets.exceptions.ConnectionClosed:
-                    print("Cliente WebSocket desconectado durante el envío")
+                    log.info("Cliente WebSocket desconectado durante el envío")
                     clientes_desconectados.append(cliente)
                 except Exception as e:
-                    print(f"Error enviando mensaje a cliente: {e}")
-                    traceback.print_exc()
+                    log.exception("Error enviando mensaje a cliente: %s", e)
                     clientes_desconectados.append(cliente)
             
             # Eliminar clientes desconectados
@@ -296,48 +379,112 @@ class NotificationEngine:
                 self.websocket_clients.remove(cliente)
                 
             if clientes_desconectados:
-                print(f"Se eliminaron {len(clientes_desconectados)} clientes desconectados. Clientes activos: {len(self.websocket_clients)}")
+                log.info("Se eliminaron %d clientes desconectados", len(clientes_desconectados), extra={'clientes': len(self.websocket_clients)})
             else:
-                print(f"Mensaje enviado a todos los clientes. Clientes activos: {len(self.websocket_clients)}")
+                log.debug("Alerta enviada a todos los clientes", extra={'clientes': len(self.websocket_clients)})
                 
         except Exception as e:
-            print(f"Error enviando por WebSocket: {e}")
-            traceback.print_exc()
+            log.exception("Error enviando por WebSocket: %s", e)
 
     async def broadcast_telemetry(self, datos_json):
-        if not self.websocket_clients:
+        if self.canal_fanout is None and not self.websocket_clients:
             return
+        if isinstance(datos_json, Lectura):
+            message = datos_json.a_json()
+        else:
+            message = json.dumps(datos_json)
+        if self.canal_fanout is not None:
+            self.canal_fanout.put(message)
+            return
+        with LATENCIA_ETAPA.medir('broadcast_telemetry'):
+            await self.difundir(message)
+
+    async def difundir(self, message):
+        """Envía un mensaje ya serializado a todos los clientes conectados"""
         try:
-            message = json.dumps(datos_json) 
-            
             for cliente in list(self.websocket_clients):
                 await cliente.send(message)
         except Exception as e:
-            print(f"Error broadcast: {e}")
+            log.error("Error broadcast: %s", e)
+
+    async def difundir_varios(self, mensajes):
+        """Difunde varios mensajes cediendo el loop entre cada uno (una alerta no espera el grupo completo)"""
+        for mensaje in mensajes:
+            await self.difundir(mensaje)
+            await asyncio.sleep(0)
     
     async def enviar_notificaciones(self, alerta, canales):
         """Envía notificaciones por los canales especificados"""
+        with LATENCIA_ETAPA.medir('enviar_notificaciones'):
+            await self._enviar_notificaciones(alerta, canales)
+        ALERTAS_ENVIADAS.inc(etiqueta=alerta.get('type', 'desconocida') if isinstance(alerta, dict) else 'invalida')
+
+    def entregar_prioritaria(self, alerta, detectado, programar):
+        """
+        Entrega desde un hilo del carril de alertas: WebSocket (en el loop mediante
+        `programar`, o al canal del fan-out) y BD en el mismo hilo; el email va a
+        un pool propio. Retorna {canal: segundos desde `detectado`} de WebSocket y BD.
+        """
+        canales = alerta.get('channels', ['email', 'database', 'websocket'])
+        tiempos = {}
+        with LATENCIA_ETAPA.medir('enviar_notificaciones'):
+            if self.canal_fanout is None:
+                self.alertas_recientes.registrar(alerta)
+
+            if 'websocket' in canales:
+                try:
+                    futuro = programar(self._enviar_websocket(alerta))
+                    if futuro is not None:
+                        futuro.result(_ESPERA_WEBSOCKET_S)
+                    tiempos['websocket'] = time.time() - detectado
+                except Exception as e:
+                    log.error("Error entregando alerta %s por WebSocket: %s", alerta['type'], e)
+
+            if 'database' in canales:
+                self._almacenar_alerta_bd(alerta)
+                tiempos['database'] = time.time() - detectado
+
+            if 'email' in canales:
+                if self._pool_email is None:
+                    self._pool_email = ThreadPoolExecutor(CARRIL_EMAIL_WORKERS, thread_name_prefix='email-prioritario')
+                self._pool_email.submit(self._enviar_email_sync, alerta, detectado)
+        ALERTAS_ENVIADAS.inc(etiqueta=alerta['type'])
+        return tiempos
+
+    def _enviar_email_sync(self, alerta, detectado):
+        try:
+            email = self._mensaje_email(alerta)
+            if email is None:
+                return
+            self._send_email_sync(*email)
+            LATENCIA_ALERTA.observar(time.time() - detectado, 'email')
+            log.info("Email de alerta enviado: %s", alerta['type'])
+        except Exception as e:
+            log.exception("Error enviando email: %s", e)
+
+    async def _enviar_notificaciones(self, alerta, canales):
         try:
             if not isinstance(alerta, dict) or 'type' not in alerta:
                 raise ValueError(f"Formato de alerta inválido: {alerta}")
 
-            print(f"Procesando alerta: {alerta['type']}")
+            log.debug("Procesando alerta: %s", alerta['type'])
+
+            # En modo sharded la registra el proceso fan-out al recibirla
+            if self.canal_fanout is None:
+                self.alertas_recientes.registrar(alerta)
             
             tareas = []
             
             if 'email' in canales:
-                print("Enviando notificación por email...")
                 tareas.append(self._enviar_email(alerta))
                 
             if 'database' in canales:
-                print("Almacenando alerta en base de datos...")
                 try:
                     self._almacenar_alerta_bd(alerta)
                 except Exception as e:
-                    print(f"Error almacenando en BD: {e}")
+                    log.error("Error almacenando en BD: %s", e)
                     
             if 'websocket' in canales:
-                print("Enviando notificación por WebSocket...")
                 tareas.append(self._enviar_websocket(alerta))
             
             # Ejecutar tareas asíncronas en paralelo
@@ -345,5 +492,4 @@ class NotificationEngine:
                 await asyncio.gather(*tareas, return_exceptions=True)
                 
         except Exception as e:
-            print(f"Error en enviar_notificaciones: {e}")
-            traceback.print_exc()
\ No newline at end of file
+            log.exception("Error en enviar_notificaciones: %s", e)
\ No newline at end of file
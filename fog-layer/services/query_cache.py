@@ -0,0 +1,65 @@
+# fog-layer/services/query_cache.py
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from services.metrics import registro
+
+TSDB_CACHE_MAX = int(os.getenv('TSDB_CACHE_MAX', '128'))
+# Los rangos se alinean a múltiplos de este tamaño para que "últimas 24 h"
+# pedidas con segundos de diferencia compartan la misma entrada
+TSDB_CACHE_BUCKET_S = int(os.getenv('TSDB_CACHE_BUCKET_S', '60'))
+# Vigencia de una entrada cuyo rango toca el presente (aún llegan datos)
+TSDB_CACHE_TTL_S = float(os.getenv('TSDB_CACHE_TTL_S', '30'))
+# Vigencia de una entrada de rango ya cerrado
+TSDB_CACHE_TTL_HISTORICO_S = float(os.getenv('TSDB_CACHE_TTL_HISTORICO_S', '600'))
+
+CONSULTAS_CACHE = registro.contador(
+    'transwatch_tsdb_cache_total', 'Consultas a InfluxDB resueltas por la caché', etiqueta='resultado'
+)
+
+
+def alinear_rango(inicio_s, fin_s, bucket_s=TSDB_CACHE_BUCKET_S):
+    """Extiende [inicio, fin] (epoch s) a los límites de bucket que lo contienen"""
+    inicio = (int(inicio_s) // bucket_s) * bucket_s
+    fin = -(-int(fin_s) // bucket_s) * bucket_s
+    return inicio, fin
+
+
+class CacheConsultas:
+    """
+    Caché LRU con vencimiento por entrada para resultados de consultas. La
+    clave es (consulta normalizada, parámetros ya alineados). Los valores se
+    comparten entre llamadas: quien los reciba no debe modificarlos.
+    """
+
+    def __init__(self, max_entradas=TSDB_CACHE_MAX):
+        self.max_entradas = max_entradas
+        self._entradas = OrderedDict()  # clave -> (vence, valor)
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada[0] > ahora:
+                self._entradas.move_to_end(clave)
+                CONSULTAS_CACHE.inc(etiqueta='acierto')
+                return entrada[1]
+            if entrada is not None:
+                del self._entradas[clave]
+        CONSULTAS_CACHE.inc(etiqueta='fallo')
+        return None
+
+    def guardar(self, clave, valor, ttl_s):
+        with self._lock:
+            self._entradas[clave] = (time.monotonic() + ttl_s, valor)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
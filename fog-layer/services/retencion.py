@@ -0,0 +1,360 @@
+# fog-layer/services/retencion.py
+"""
+Retención por niveles y compactación (rollups) de InfluxDB 3 Core.
+
+Cada measurement tiene una política con niveles, por ejemplo:
+  crudo (7 días) -> rollup 1m (90 días) -> rollup 1h (sin límite)
+
+Cada nivel vive en su propia base de datos, y la expiración la hace el motor
+con el retention period de esa base: InfluxDB 3 Core no permite borrar filas
+por rango. Por eso la retención es de la base y no del measurement: la
+`retencion` de un nivel solo describe el retention period de su base (para
+calcular el borde de expiración), y dos niveles en la misma base deben
+declarar la misma. El nivel crudo usa INFLUXDB_RETENCION salvo que la
+política le asigne su propia `database`. Bases sugeridas:
+
+  influxdb3 create database transwatch     --retention-period 7d
+  influxdb3 create database transwatch_1m  --retention-period 90d
+  influxdb3 create database transwatch_1h
+
+Este job hace la parte "rollup-then-delete" de forma segura. Agrega cada
+nivel a partir del anterior en tramos, y la marca de agua (hasta dónde se
+agregó) solo avanza cuando el tramo quedó escrito. Si los datos de un nivel
+van a expirar antes de ser agregados, lo reporta. También informa el uso de
+disco por nivel.
+
+Los niveles agregados guardan formas combinables: <campo>_sum, _min, _max,
+<bandera>_true y muestras. Promedio = <campo>_sum / muestras.
+
+El promedio es por muestra, no ponderado por tiempo. Con la compresión del
+gateway activa (DEADBAND_ENABLED) los puntos crudos no son equiespaciados:
+un valor estable cuenta una vez cada heartbeat y un tramo cambiante cuenta
+cada lectura, así que el promedio se sesga hacia los periodos con cambios.
+Mínimo, máximo y conteos de banderas no se ven afectados; para el promedio
+en el tiempo use TimeSeriesManager.consultar_serie_reconstruida.
+
+  python -m services.retencion --una-vez
+  python -m services.retencion --cada 3600
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+from dotenv import load_dotenv
+
+from services.log_config import configurar_logging, obtener_logger
+from services.tsdb_manager import TimeSeriesManager, CAMPOS_BOOLEANOS_INFLUX
+
+load_dotenv()
+
+log = obtener_logger("transwatch.retencion")
+
+INFLUXDB_DATABASE = os.getenv("INFLUXDB_DATABASE", "transwatch")
+# Retention period de INFLUXDB_DATABASE (el del --retention-period al crearla): borde de expiración del crudo
+INFLUXDB_RETENCION = os.getenv("INFLUXDB_RETENCION", "7d") or None
+# Directorio de datos de InfluxDB (bind mount de docker-compose) para medir el disco por nivel
+INFLUXDB_DATA_DIR = os.path.expanduser(os.getenv("INFLUXDB_DATA_DIR", "~/.influxdb3/core/data"))
+# Archivo JSON con políticas propias (ver POLITICAS_DEFAULT); vacío = default
+RETENCION_POLITICAS = os.getenv("RETENCION_POLITICAS", "")
+# Marcas de agua de los rollups
+RETENCION_ESTADO = os.path.expanduser(os.getenv("RETENCION_ESTADO", "~/.transwatch/retencion.json"))
+# Espera antes de agregar un bucket, para datos que llegan tarde
+RETENCION_GRACIA_S = int(os.getenv("RETENCION_GRACIA_S", "300"))
+# Tamaño del tramo de origen procesado por consulta (memoria acotada)
+RETENCION_TRAMO_S = int(os.getenv("RETENCION_TRAMO_S", str(6 * 3600)))
+# Se avisa si la marca de agua queda a menos de esto del borde de expiración del nivel origen
+RETENCION_MARGEN_S = int(os.getenv("RETENCION_MARGEN_S", str(24 * 3600)))
+
+_DURACION_RE = re.compile(r'^(\d+)([smhd])$')
+_SEGUNDOS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+_UNIDADES_SQL = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+
+POLITICAS_DEFAULT = {
+    "sensor_reading": {
+        "tags": ["device_id"],
+        "campos": ["temp_celsius", "humedad_porcentaje", "luz_adc", "distancia_cm"],
+        "banderas": list(CAMPOS_BOOLEANOS_INFLUX),
+        "niveles": [
+            {"nombre": "crudo"},
+            {"nombre": "1m", "intervalo": "1m", "retencion": "90d"},
+            {"nombre": "1h", "intervalo": "1h", "retencion": None},
+        ]
+    },
+    # Alertas (services/alert_store.py): conteos por tipo y prioridad
+    "alerta": {
+        "tags": ["tipo", "prioridad", "device_id"],
+        "niveles": [
+            {"nombre": "crudo"},
+            {"nombre": "1h", "intervalo": "1h", "retencion": None},
+        ]
+    }
+}
+
+
+def duracion_a_segundos(texto):
+    if texto is None:
+        return None
+    coincidencia = _DURACION_RE.match(str(texto))
+    if not coincidencia:
+        raise ValueError(f"Duración inválida: {texto!r} (ej. 30s, 5m, 1h, 7d)")
+    cantidad, unidad = coincidencia.groups()
+    return int(cantidad) * _SEGUNDOS[unidad]
+
+
+def _iso(segundos):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(segundos))
+
+
+class Nivel:
+    """Un nivel de retención: dónde vive, con qué resolución y cuánto dura"""
+
+    def __init__(self, measurement, nombre, retencion=None, intervalo=None, database=None, es_crudo=False):
+        self.nombre = nombre
+        self.es_crudo = es_crudo
+        self.intervalo = intervalo
+        self.intervalo_s = duracion_a_segundos(intervalo)
+        self.retencion_s = duracion_a_segundos(retencion)
+        self.retencion = retencion
+        self.database = database or (INFLUXDB_DATABASE if es_crudo else f"{INFLUXDB_DATABASE}_{nombre}")
+        self.measurement = measurement if es_crudo else f"{measurement}_{nombre}"
+
+    def __repr__(self):
+        return f"<Nivel {self.database}.{self.measurement} retención={self.retencion or '∞'}>"
+
+
+class PoliticaRetencion:
+    """Niveles de un measurement y las columnas que se agregan entre ellos"""
+
+    def __init__(self, measurement, niveles, tags=(), campos=(), banderas=()):
+        self.measurement = measurement
+        self.tags = list(tags)
+        self.campos = list(campos)
+        self.banderas = list(banderas)
+        self.niveles = []
+        for i, n in enumerate(niveles):
+            es_crudo = i == 0
+            if es_crudo and "database" not in n:
+                if n.get("retencion", INFLUXDB_RETENCION) != INFLUXDB_RETENCION:
+                    raise ValueError(
+                        f"El crudo de {measurement} comparte {INFLUXDB_DATABASE} (retención {INFLUXDB_RETENCION}): "
+                        f"para otra retención asígnele su propia 'database'"
+                    )
+                retencion = INFLUXDB_RETENCION
+            else:
+                retencion = n.get("retencion")
+            self.niveles.append(Nivel(measurement, n["nombre"], retencion, n.get("intervalo"), n.get("database"),
+                                      es_crudo=es_crudo))
+        for anterior, nivel in zip(self.niveles, self.niveles[1:]):
+            if not nivel.intervalo_s:
+                raise ValueError(f"El nivel '{nivel.nombre}' de {measurement} necesita 'intervalo'")
+            if anterior.intervalo_s and nivel.intervalo_s % anterior.intervalo_s:
+                raise ValueError(f"El intervalo de '{nivel.nombre}' debe ser múltiplo del de '{anterior.nombre}'")
+
+    def consulta_rollup(self, origen, destino):
+        """SQL que agrega [$inicio, $fin) del nivel origen a la resolución del destino"""
+        cantidad, unidad = _DURACION_RE.match(destino.intervalo).groups()
+        bucket = f"date_bin(INTERVAL '{cantidad} {_UNIDADES_SQL[unidad]}', time)"
+        columnas = [f'{bucket} AS time'] + [f'"{t}"' for t in self.tags]
+        if origen.es_crudo:
+            for c in self.campos:
+                columnas += [f'sum("{c}") AS "{c}_sum"', f'min("{c}") AS "{c}_min"', f'max("{c}") AS "{c}_max"']
+            columnas += [f'sum(CAST("{b}" AS BIGINT)) AS "{b}_true"' for b in self.banderas]
+            columnas.append('count(*) AS muestras')
+        else:
+            for c in self.campos:
+                columnas += [f'sum("{c}_sum") AS "{c}_sum"', f'min("{c}_min") AS "{c}_min"',
+                             f'max("{c}_max") AS "{c}_max"']
+            columnas += [f'sum("{b}_true") AS "{b}_true"' for b in self.banderas]
+            columnas.append('sum(muestras) AS muestras')
+
+        agrupacion = ", ".join(["1"] + [str(i + 2) for i in range(len(self.tags))])
+        return f"""
+            SELECT {", ".join(columnas)}
+            FROM "{origen.measurement}"
+            WHERE time >= $inicio AND time < $fin
+            GROUP BY {agrupacion}
+        """
+
+
+def cargar_politicas(ruta=RETENCION_POLITICAS):
+    definicion = POLITICAS_DEFAULT
+    if ruta:
+        with open(ruta, encoding="utf-8") as f:
+            definicion = json.load(f)
+    politicas = [
+        PoliticaRetencion(measurement, p["niveles"], p.get("tags", ()), p.get("campos", ()), p.get("banderas", ()))
+        for measurement, p in definicion.items()
+    ]
+    # La expiración es de la base: niveles que la comparten no pueden declarar retenciones distintas
+    por_base = {}
+    for politica in politicas:
+        for nivel in politica.niveles:
+            otro = por_base.setdefault(nivel.database, nivel)
+            if otro.retencion_s != nivel.retencion_s:
+                raise ValueError(
+                    f"{otro.measurement} y {nivel.measurement} comparten la base {nivel.database} con retenciones "
+                    f"distintas ({otro.retencion or '∞'} y {nivel.retencion or '∞'})"
+                )
+    return politicas
+
+
+class GestorRetencion:
+    """Ejecuta los rollups de todas las políticas y reporta atraso y disco por nivel"""
+
+    def __init__(self, politicas=None, tsdb=None, ruta_estado=RETENCION_ESTADO):
+        self.politicas = politicas if politicas is not None else cargar_politicas()
+        self.tsdb = tsdb or TimeSeriesManager()
+        self.ruta_estado = ruta_estado
+        self.marcas = self._leer_estado()
+
+    def _leer_estado(self):
+        try:
+            with open(self.ruta_estado, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.error("Estado de retención ilegible (%s); se recalcula desde el borde de retención", e)
+            return {}
+
+    def _guardar_estado(self):
+        # Escritura atómica: un corte a mitad no deja marcas corruptas
+        os.makedirs(os.path.dirname(self.ruta_estado) or ".", exist_ok=True)
+        temporal = self.ruta_estado + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(self.marcas, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, self.ruta_estado)
+
+    def _clave(self, destino):
+        return f"{destino.database}.{destino.measurement}"
+
+    def rollup(self, politica, origen, destino, ahora=None):
+        """Agrega origen -> destino por tramos hasta el último bucket cerrado. Retorna filas escritas."""
+        ahora = ahora if ahora is not None else time.time()
+        limite = int((ahora - RETENCION_GRACIA_S) // destino.intervalo_s * destino.intervalo_s)
+        if not origen.es_crudo:
+            # No se adelanta al nivel origen: solo se agrega lo que éste ya tiene completo
+            limite = min(limite, self.marcas.get(self._clave(origen), limite))
+        clave = self._clave(destino)
+
+        marca = self.marcas.get(clave)
+        if marca is None:
+            # Primera ejecución: desde lo más antiguo que el origen todavía conserva
+            inicio_origen = ahora - origen.retencion_s if origen.retencion_s else ahora - 30 * 86400
+            marca = int(inicio_origen // destino.intervalo_s * destino.intervalo_s)
+
+        tramo = max(destino.intervalo_s, RETENCION_TRAMO_S // destino.intervalo_s * destino.intervalo_s)
+        consulta = politica.consulta_rollup(origen, destino)
+        escritas = 0
+        while marca < limite:
+            fin = min(marca + tramo, limite)
+            df = self.tsdb.client.query(
+                query=consulta, mode="pandas", database=origen.database,
+                query_parameters={"inicio": _iso(marca), "fin": _iso(fin)}
+            )
+            if not df.empty:
+                self.tsdb.client.write_dataframe(
+                    df, measurement=destino.measurement, timestamp_column="time",
+                    tags=politica.tags, database=destino.database
+                )
+                escritas += len(df)
+            # La marca solo avanza con el tramo ya escrito (reintentar reescribe los mismos puntos)
+            marca = fin
+            self.marcas[clave] = marca
+            self._guardar_estado()
+
+        log.info("Rollup %s -> %s al día hasta %s (%d filas)", origen.measurement, clave, _iso(marca), escritas)
+        return escritas
+
+    def atraso(self, origen, destino, ahora=None):
+        """Segundos de margen entre la marca de agua y el borde de expiración del origen (negativo = pérdida)"""
+        if not origen.retencion_s:
+            return None
+        ahora = ahora if ahora is not None else time.time()
+        marca = self.marcas.get(self._clave(destino), 0)
+        return marca - (ahora - origen.retencion_s)
+
+    def uso_disco(self, nivel):
+        """Bytes en disco de la tabla del nivel (object store 'file'); None si no se encuentra"""
+        total, encontrado = 0, False
+        if not os.path.isdir(INFLUXDB_DATA_DIR):
+            return None
+        for raiz, directorios, archivos in os.walk(INFLUXDB_DATA_DIR):
+            partes = raiz.split(os.sep)
+            # .../dbs/<database>-<id>/<tabla>-<id>/...
+            if "dbs" not in partes:
+                continue
+            indice = partes.index("dbs")
+            if len(partes) < indice + 3:
+                continue
+            db, tabla = partes[indice + 1], partes[indice + 2]
+            if db.rsplit("-", 1)[0] != nivel.database or tabla.rsplit("-", 1)[0] != nivel.measurement:
+                continue
+            encontrado = True
+            total += sum(os.path.getsize(os.path.join(raiz, a)) for a in archivos)
+        return total if encontrado else None
+
+    def ejecutar(self):
+        """Una pasada completa: rollups, verificación de expiración y reporte"""
+        reporte = []
+        for politica in self.politicas:
+            for origen, destino in zip(politica.niveles, politica.niveles[1:]):
+                try:
+                    self.rollup(politica, origen, destino)
+                except Exception as e:
+                    log.exception("Rollup %s -> %s falló: %s", origen.measurement, destino.measurement, e)
+
+                margen = self.atraso(origen, destino)
+                if margen is not None and margen < RETENCION_MARGEN_S:
+                    log.error("Los datos de %s expirarán antes de agregarse a %s (margen %.1f h)",
+                              origen, destino, margen / 3600)
+
+            for nivel in politica.niveles:
+                reporte.append({
+                    "measurement": nivel.measurement,
+                    "database": nivel.database,
+                    "retencion": nivel.retencion or "infinita",
+                    "resolucion": nivel.intervalo or "cruda",
+                    "bytes": self.uso_disco(nivel)
+                })
+        return reporte
+
+
+def _imprimir_reporte(reporte):
+    print(f"{'Nivel':<40} {'Retención':>10} {'Resolución':>10} {'Disco':>12}")
+    for fila in reporte:
+        disco = f"{fila['bytes'] / 1e6:,.1f} MB" if fila['bytes'] is not None else "n/d"
+        print(f"{fila['database'] + '.' + fila['measurement']:<40} {fila['retencion']:>10} "
+              f"{fila['resolucion']:>10} {disco:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rollups y retención por niveles de TRANSWATCH")
+    grupo = parser.add_mutually_exclusive_group()
+    grupo.add_argument('--una-vez', action='store_true', help="Una sola pasada (para cron/systemd timer)")
+    grupo.add_argument('--cada', type=int, default=3600, help="Segundos entre pasadas (default 3600)")
+    args = parser.parse_args()
+
+    configurar_logging()
+    gestor = GestorRetencion()
+    try:
+        while True:
+            _imprimir_reporte(gestor.ejecutar())
+            if args.una_vez:
+                break
+            time.sleep(args.cada)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gestor.tsdb.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
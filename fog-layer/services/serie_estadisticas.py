@@ -0,0 +1,163 @@
+# fog-layer/services/serie_estadisticas.py
+
+import math
+import time
+
+import numpy as np
+
+# Tamaños de bucket (s). Cada uno es múltiplo del anterior y divide el día, así los
+# buckets de un paso fino se agrupan exactamente en los de un paso más grueso
+PASOS_BUCKET = (1, 5, 10, 30, 60, 300, 600, 1800, 3600, 10800, 21600, 43200, 86400)
+# Buckets pedidos a la BD por cada pixel de ancho (la media luego se reduce con LTTB)
+SOBREMUESTREO = 2
+
+
+def elegir_paso(duracion_s, max_buckets):
+    """Menor paso de PASOS_BUCKET que cubre la duración con a lo sumo max_buckets"""
+    minimo = duracion_s / max(1, max_buckets)
+    for paso in PASOS_BUCKET:
+        if paso >= minimo:
+            return paso
+    return PASOS_BUCKET[-1] * math.ceil(minimo / PASOS_BUCKET[-1])
+
+
+def lttb(x, y, n_salida):
+    """
+    Largest-Triangle-Three-Buckets: elige n_salida puntos de (x, y) que
+    conservan la forma visual de la serie (picos incluidos). O(n).
+    """
+    n = len(x)
+    if n_salida >= n or n_salida < 3:
+        return x, y
+    indices = np.empty(n_salida, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    # Límites de los n_salida-2 buckets interiores
+    bordes = np.linspace(1, n - 1, n_salida - 1).astype(np.int64)
+    anterior = 0
+    for i in range(n_salida - 2):
+        inicio, fin = bordes[i], bordes[i + 1]
+        # Punto C: promedio del bucket siguiente (o el último punto)
+        sig_inicio, sig_fin = fin, bordes[i + 2] if i + 2 < len(bordes) else n
+        if sig_fin <= sig_inicio:
+            sig_fin = sig_inicio + 1
+        cx, cy = x[sig_inicio:sig_fin].mean(), y[sig_inicio:sig_fin].mean()
+        ax, ay = x[anterior], y[anterior]
+        areas = np.abs((ax - cx) * (y[inicio:fin] - ay) - (ax - x[inicio:fin]) * (cy - ay))
+        anterior = inicio + int(areas.argmax())
+        indices[i + 1] = anterior
+    return x[indices], y[indices]
+
+
+def reagrupar(t, minimo, media, maximo, conteo, paso):
+    """Agrupa buckets finos en buckets de `paso` (media ponderada por muestras)"""
+    if len(t) == 0:
+        return t, minimo, media, maximo, conteo
+    grupos = (t // paso) * paso
+    nuevos, inicios = np.unique(grupos, return_index=True)
+    suma = np.add.reduceat(media * conteo, inicios)
+    n = np.add.reduceat(conteo, inicios)
+    return (nuevos, np.minimum.reduceat(minimo, inicios), suma / n,
+            np.maximum.reduceat(maximo, inicios), n)
+
+
+class SerieCacheada:
+    """
+    Buckets min/media/max ya consultados para un campo. Al pedir un rango que
+    extiende o contiene al anterior solo se consultan los tramos que faltan
+    (y el último bucket si aún podía recibir datos); al ampliar tanto que el
+    paso crece, lo ya consultado se reagrupa en memoria.
+
+    `consultar(inicio, fin, paso)` devuelve filas (t_epoch, min, media, max, muestras)
+    de [inicio, fin) con t alineado a `paso`. No es thread-safe: se usa desde
+    un solo hilo (el trabajador de fondo de la GUI).
+    """
+
+    def __init__(self, consultar, sobremuestreo=SOBREMUESTREO):
+        self.consultar = consultar
+        self.sobremuestreo = sobremuestreo
+        self.paso = None
+        self._vaciar()
+
+    def _vaciar(self):
+        vacio = np.empty(0)
+        self.t, self.minimo, self.media, self.maximo, self.conteo = vacio, vacio, vacio, vacio, vacio
+        self.inicio = self.fin = self.cerrado_hasta = None
+
+    def _recortar(self, desde=None, hasta=None):
+        mascara = np.ones(len(self.t), dtype=bool)
+        if desde is not None:
+            mascara &= self.t >= desde
+        if hasta is not None:
+            mascara &= self.t < hasta
+        self.t, self.minimo, self.media, self.maximo, self.conteo = (
+            arreglo[mascara] for arreglo in (self.t, self.minimo, self.media, self.maximo, self.conteo)
+        )
+
+    def _cambiar_paso(self, paso):
+        """Reagrupa lo consultado a un paso más grueso; los buckets de los bordes quedan incompletos"""
+        self.t, self.minimo, self.media, self.maximo, self.conteo = reagrupar(
+            self.t, self.minimo, self.media, self.maximo, self.conteo, paso
+        )
+        self.inicio = -(-self.inicio // paso) * paso
+        self.cerrado_hasta = (self.cerrado_hasta // paso) * paso
+        self.fin = self.cerrado_hasta
+        self._recortar(self.inicio, self.cerrado_hasta)
+        self.paso = paso
+
+    def obtener(self, inicio, fin, ancho_px, ahora=None):
+        """Buckets de [inicio, fin] (epoch s) para un gráfico de ancho_px pixeles"""
+        ahora = ahora if ahora is not None else time.time()
+        paso = elegir_paso(fin - inicio, ancho_px * self.sobremuestreo)
+        inicio = (int(inicio) // paso) * paso
+        fin = -(-int(fin) // paso) * paso
+
+        reutilizable = (
+            self.paso is not None and paso >= self.paso and paso % self.paso == 0
+            and inicio <= self.fin and fin >= self.inicio
+        )
+        if reutilizable and paso != self.paso:
+            self._cambiar_paso(paso)
+            reutilizable = self.inicio < self.cerrado_hasta and inicio <= self.fin and fin >= self.inicio
+        if not reutilizable:
+            self.paso = paso
+            self._vaciar()
+            self.inicio = self.fin = self.cerrado_hasta = inicio
+
+        tramos = []
+        if inicio < self.inicio:
+            tramos.append((inicio, self.inicio))
+        if fin > self.cerrado_hasta:
+            # Lo posterior a cerrado_hasta pudo recibir datos después de consultarse
+            self._recortar(hasta=self.cerrado_hasta)
+            tramos.append((self.cerrado_hasta, fin))
+
+        for desde, hasta in tramos:
+            filas = self.consultar(desde, hasta, paso)
+            if filas:
+                nuevos = np.array(filas, dtype=float).T
+                self.t, self.minimo, self.media, self.maximo, self.conteo = (
+                    np.concatenate((actual, nuevo))
+                    for actual, nuevo in zip((self.t, self.minimo, self.media, self.maximo, self.conteo), nuevos)
+                )
+        if tramos:
+            orden = np.argsort(self.t, kind='stable')
+            self.t, self.minimo, self.media, self.maximo, self.conteo = (
+                arreglo[orden] for arreglo in (self.t, self.minimo, self.media, self.maximo, self.conteo)
+            )
+            self.inicio = min(self.inicio, inicio)
+            if fin > self.cerrado_hasta:
+                self.fin = max(self.fin, fin)
+                self.cerrado_hasta = min(self.fin, (int(ahora) // paso) * paso)
+
+        mascara = (self.t >= inicio) & (self.t < fin)
+        t, media = self.t[mascara], self.media[mascara]
+        t_linea, media_linea = lttb(t, media, ancho_px)
+        return {
+            'paso': paso,
+            'tramos_consultados': tramos,
+            't': t,
+            'minimo': self.minimo[mascara],
+            'maximo': self.maximo[mascara],
+            't_media': t_linea,
+            'media': media_linea
+        }
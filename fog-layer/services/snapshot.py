@@ -0,0 +1,238 @@
+# fog-layer/services/snapshot.py
+
+import io
+import os
+import time
+import zlib
+import pickle
+import struct
+import threading
+
+from services.log_config import obtener_logger
+from services.metrics import registro, LATENCIA_ETAPA
+
+log = obtener_logger("transwatch.snapshot")
+
+# Directorio local de los snapshots (uno por proceso del gateway)
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', 'snapshots')
+# Cada cuánto se captura el estado en memoria (0 = sin snapshots)
+SNAPSHOT_INTERVALO_S = float(os.getenv('SNAPSHOT_INTERVALO_S', '30'))
+# Un snapshot más antiguo que esto no se restaura (las ventanas ya no describen el presente)
+SNAPSHOT_MAX_EDAD_S = float(os.getenv('SNAPSHOT_MAX_EDAD_S', '900'))
+
+# Archivo: cabecera fija + cuerpo pickle comprimido con zlib
+MAGIA = b'TWSN'
+VERSION = 1
+_CABECERA = struct.Struct('<4sHdI')   # magia, versión, creado (epoch s), crc32 del cuerpo
+
+SNAPSHOTS = registro.contador('transwatch_snapshots_total', 'Snapshots de estado escritos o leídos', etiqueta='resultado')
+
+
+class SnapshotInvalido(ValueError):
+    """El archivo no es un snapshot de esta versión o está dañado."""
+
+
+class _UnpicklerTipos(pickle.Unpickler):
+    # Solo tipos básicos (dict, list, tuple, str, bytes, números, None): ninguna clase ni función
+    def find_class(self, modulo, nombre):
+        raise pickle.UnpicklingError(f"Tipo no permitido en snapshot: {modulo}.{nombre}")
+
+
+def codificar(estado, creado):
+    cuerpo = zlib.compress(pickle.dumps(estado, protocol=pickle.HIGHEST_PROTOCOL), 1)
+    return _CABECERA.pack(MAGIA, VERSION, creado, zlib.crc32(cuerpo)) + cuerpo
+
+
+def decodificar(datos):
+    """bytes -> (estado, creado). Lanza SnapshotInvalido si no se puede leer."""
+    if len(datos) < _CABECERA.size:
+        raise SnapshotInvalido("archivo truncado")
+    magia, version, creado, crc = _CABECERA.unpack_from(datos)
+    if magia != MAGIA or version != VERSION:
+        raise SnapshotInvalido(f"formato desconocido ({magia!r} v{version})")
+    cuerpo = memoryview(datos)[_CABECERA.size:]
+    if zlib.crc32(cuerpo) != crc:
+        raise SnapshotInvalido("crc32 no coincide")
+    try:
+        return _UnpicklerTipos(io.BytesIO(zlib.decompress(cuerpo))).load(), creado
+    except (zlib.error, pickle.UnpicklingError, EOFError) as e:
+        raise SnapshotInvalido(str(e)) from e
+
+
+def escribir_atomico(ruta, datos):
+    """Escribe en un temporal del mismo directorio y lo renombra: nunca queda un archivo a medias"""
+    directorio = os.path.dirname(ruta) or '.'
+    os.makedirs(directorio, exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    try:
+        with open(temporal, 'wb') as f:
+            f.write(datos)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, ruta)
+    except BaseException:
+        try:
+            os.remove(temporal)
+        except OSError:
+            pass
+        raise
+    try:
+        # El rename es durable solo cuando se sincroniza el directorio (no disponible en Windows)
+        descriptor = os.open(directorio, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+    except (OSError, AttributeError):
+        pass
+
+
+class GestorSnapshots:
+    """
+    Guarda periódicamente el estado en memoria de los componentes registrados
+    (ventanas de QC, compresión, alertas recientes) en un archivo binario
+    local y lo restaura al arrancar si no está vencido.
+
+    Cada componente aporta `exportar()` -> tipos básicos y `restaurar(estado)`.
+    `tal_vez_capturar()` se llama desde el hilo dueño del estado (el del
+    micro-lote), así la copia es consistente; la serialización y la escritura
+    ocurren en el hilo del gestor. Con `iniciar(periodico=True)` el propio
+    hilo del gestor captura (componentes con su propio lock).
+    """
+
+    def __init__(self, nombre, directorio=SNAPSHOT_DIR, intervalo_s=SNAPSHOT_INTERVALO_S,
+                 max_edad_s=SNAPSHOT_MAX_EDAD_S):
+        self.nombre = nombre
+        self.ruta = os.path.join(directorio, f"{nombre}.snap")
+        self.intervalo_s = intervalo_s
+        self.max_edad_s = max_edad_s
+        self._componentes = {}          # nombre -> (exportar, restaurar)
+        self._pendiente = None          # (estado, creado) esperando ser escrito
+        self._lock = threading.Lock()
+        self._hay_pendiente = threading.Event()
+        self._detener = threading.Event()
+        self._proxima = time.monotonic() + intervalo_s
+        self._periodico = False
+        self._hilo = None
+
+    @property
+    def habilitado(self):
+        return self.intervalo_s > 0
+
+    def registrar(self, componente, exportar, restaurar):
+        self._componentes[componente] = (exportar, restaurar)
+
+    def capturar(self):
+        """Estado actual de todos los componentes (copia en tipos básicos)"""
+        return {componente: exportar() for componente, (exportar, _) in self._componentes.items()}
+
+    def tal_vez_capturar(self):
+        """Captura si ya pasó el intervalo; barato cuando no toca"""
+        if not self.habilitado or time.monotonic() < self._proxima:
+            return False
+        self._proxima = time.monotonic() + self.intervalo_s
+        try:
+            estado = self.capturar()
+        except Exception as e:
+            log.exception("Error capturando estado para snapshot: %s", e)
+            return False
+        with self._lock:
+            # Si el anterior aún no se escribió, se reemplaza: solo importa el más reciente
+            self._pendiente = (estado, time.time())
+        self._hay_pendiente.set()
+        return True
+
+    def guardar(self, estado=None, creado=None):
+        """Escribe un snapshot de forma síncrona. Retorna el tamaño en bytes."""
+        estado = estado if estado is not None else self.capturar()
+        with LATENCIA_ETAPA.medir('snapshot_guardar'):
+            datos = codificar(estado, creado if creado is not None else time.time())
+            escribir_atomico(self.ruta, datos)
+        SNAPSHOTS.inc(etiqueta='guardado')
+        log.debug("Snapshot %s escrito (%d bytes)", self.ruta, len(datos))
+        return len(datos)
+
+    def leer(self, ahora=None):
+        """Estado del snapshot si existe, es válido y no está vencido; si no, None"""
+        ahora = ahora if ahora is not None else time.time()
+        try:
+            with open(self.ruta, 'rb') as f:
+                datos = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            log.warning("No se pudo leer el snapshot %s: %s", self.ruta, e)
+            return None
+        try:
+            estado, creado = decodificar(datos)
+        except SnapshotInvalido as e:
+            SNAPSHOTS.inc(etiqueta='invalido')
+            log.warning("Snapshot %s descartado: %s", self.ruta, e)
+            return None
+        edad = ahora - creado
+        if edad > self.max_edad_s:
+            SNAPSHOTS.inc(etiqueta='vencido')
+            log.info("Snapshot %s descartado: tiene %.0f s (máximo %.0f s)", self.ruta, edad, self.max_edad_s)
+            return None
+        return estado, edad
+
+    def restaurar(self, ahora=None):
+        """Restaura los componentes registrados. Retorna los nombres restaurados."""
+        if not self.habilitado:
+            return []
+        with LATENCIA_ETAPA.medir('snapshot_restaurar'):
+            leido = self.leer(ahora)
+            if leido is None:
+                return []
+            estado, edad = leido
+            restaurados = []
+            for componente, (_, restaurar) in self._componentes.items():
+                if componente not in estado:
+                    continue
+                try:
+                    restaurar(estado[componente])
+                    restaurados.append(componente)
+                except Exception as e:
+                    log.warning("No se pudo restaurar '%s' desde el snapshot: %s", componente, e)
+        SNAPSHOTS.inc(etiqueta='restaurado')
+        log.info("Estado restaurado desde %s (%.0f s de antigüedad): %s",
+                 self.ruta, edad, ', '.join(restaurados) or 'nada')
+        return restaurados
+
+    def iniciar(self, periodico=False):
+        if not self.habilitado or (self._hilo and self._hilo.is_alive()):
+            return
+        self._periodico = periodico
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name=f"snapshot-{self.nombre}", daemon=True)
+        self._hilo.start()
+
+    def detener(self, guardar_final=True):
+        """Detiene el hilo y escribe un último snapshot (llamar cuando el estado ya no cambia)"""
+        self._detener.set()
+        self._hay_pendiente.set()
+        if self._hilo:
+            self._hilo.join(5)
+        if guardar_final and self.habilitado and self._componentes:
+            try:
+                self.guardar()
+            except Exception as e:
+                log.error("No se pudo escribir el snapshot final %s: %s", self.ruta, e)
+
+    def _bucle(self):
+        while not self._detener.is_set():
+            if self._periodico:
+                self._hay_pendiente.wait(max(0.0, self._proxima - time.monotonic()))
+                self.tal_vez_capturar()
+            else:
+                self._hay_pendiente.wait(1.0)
+            with self._lock:
+                pendiente, self._pendiente = self._pendiente, None
+                self._hay_pendiente.clear()
+            if pendiente is None:
+                continue
+            try:
+                self.guardar(*pendiente)
+            except Exception as e:
+                SNAPSHOTS.inc(etiqueta='error')
+                log.error("No se pudo escribir el snapshot %s: %s", self.ruta, e)
@@ -1,15 +1,63 @@
 # fog-layer/services/tsdb_manager.py
 
 import os
+import re
 import time
 from influxdb_client_3 import InfluxDBClient3
 from dotenv import load_dotenv
-import pandas as pd
-from datetime import datetime, timedelta
+import pyarrow as pa
+import pyarrow.compute as pc
+from services.lectura import Lectura
+from services.query_cache import (
+    CacheConsultas, alinear_rango,
+    TSDB_CACHE_BUCKET_S, TSDB_CACHE_TTL_S, TSDB_CACHE_TTL_HISTORICO_S
+)
+from services.log_config import obtener_logger
+from services.metrics import LATENCIA_ETAPA
+from datetime import datetime, timedelta, timezone
 
 # Cargar variables de entorno desde .env
 load_dotenv()
 
+log = obtener_logger("transwatch.tsdb")
+
+# Campos del measurement 'sensor_reading' (ver _limpiar_campos)
+CAMPOS_BOOLEANOS_INFLUX = (
+    "vehiculo_en_entrada_detectado", "barrera_abierta",
+    "luces_parking_encendidas", "alarma_temperatura_activa"
+)
+CAMPOS_EXPORTABLES = ("temp_celsius", "humedad_porcentaje", "luz_adc", "distancia_cm") + CAMPOS_BOOLEANOS_INFLUX
+
+INTERVALO_RE = re.compile(r'^(\d{1,4})([smhd])$')
+UNIDADES_INTERVALO = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+
+LIMITE_MAXIMO_HISTORICO = 10000
+# El histórico inicial de los clientes WebSocket debe estar casi al día
+TTL_HISTORICO_RECIENTE_S = 5
+
+# Caché de resultados compartida por todas las instancias del proceso
+_cache = CacheConsultas()
+
+
+def _epoch_ns(fecha):
+    """Fecha ISO 8601 (o datetime) -> epoch en ns, asumiendo UTC si no trae zona"""
+    if not isinstance(fecha, datetime):
+        try:
+            fecha = datetime.fromisoformat(str(fecha).replace('Z', '+00:00'))
+        except ValueError:
+            # Formatos que fromisoformat no acepta: pandas solo en ese caso
+            import pandas as pd
+            marca = pd.Timestamp(fecha)
+            return (marca if marca.tzinfo is not None else marca.tz_localize('UTC')).value
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    delta = fecha - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1_000_000_000 + delta.microseconds * 1000
+
+
+def _iso_epoch(segundos):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(segundos))
+
 class TimeSeriesManager:
     def __init__(self):
         # Parámetros de InfluxDB
@@ -18,7 +66,7 @@ class TimeSeriesManager:
         self.database = os.getenv("INFLUXDB_DATABASE")
 
         if not self.token:
-            print("Error: INFLUXDB_TOKEN no está definido en tu archivo .env")
+            log.error("INFLUXDB_TOKEN no está definido en tu archivo .env")
 
         try:
             # Inicializar cliente
@@ -27,54 +75,100 @@ class TimeSeriesManager:
                 token=self.token,
                 database=self.database
             )
-            print(f"Cliente InfluxDB inicializado. Conectado a '{self.host}' (DB: '{self.database}')")
+            log.info("Cliente InfluxDB inicializado. Conectado a '%s' (DB: '%s')", self.host, self.database)
         except Exception as e:
-            print(f"Error al inicializar cliente InfluxDB: {e}")
+            log.error("Error al inicializar cliente InfluxDB: %s", e)
             self.client = None
 
+    def _construir_punto(self, datos, device_id, qc_status, timestamp=None):
+        """Construye el punto 'sensor_reading' (precisión ms) a partir de una lectura."""
+        if isinstance(datos, Lectura):
+            fields_limpios = datos.campos_influx()
+        else:
+            fields_limpios = self._limpiar_campos(datos)
+
+        # Creamos el punto de datos como un diccionario
+        return {
+            "measurement": "sensor_reading",
+            "tags": {
+                "device_id": device_id,
+                "qc_status": str(qc_status)
+            },
+            "fields": fields_limpios,
+            "time": int((timestamp if timestamp is not None else time.time()) * 1000)
+        }
+
+    def _limpiar_campos(self, datos):
+        """Campos (fields) a partir de un diccionario con nombres del payload."""
+        return {
+            "temp_celsius": float(datos.get("temperatura_celsius", 0.0) or 0.0),
+            "humedad_porcentaje": float(datos.get("humedad_porcentaje", 0.0) or 0.0),
+            "luz_adc": float(datos.get("luz_adc", 0.0) or 0.0),
+            "distancia_cm": float(datos.get("distancia_cm", 0.0) or 0.0),
+            "vehiculo_en_entrada_detectado": bool(datos.get("vehiculo_en_entrada_detectado", False)),
+            "barrera_abierta": bool(datos.get("barrera_abierta", False)),
+            "luces_parking_encendidas": bool(datos.get("luces_parking_encendidas", False)),
+            "alarma_temperatura_activa": bool(datos.get("alarma_temperatura_activa", False))
+        }
+
     def almacenar_lectura(self, datos, device_id, qc_status):
         """
         Almacena un diccionario de datos de sensores en InfluxDB.
         """
         if not self.client:
-            print("Cliente InfluxDB no inicializado.")
+            log.warning("Cliente InfluxDB no inicializado.")
             return False
 
         try:
-            # Limpiamos los campos (fields)
-            fields_limpios = {
-                "temp_celsius": float(datos.get("temperatura_celsius", 0.0) or 0.0),
-                "humedad_porcentaje": float(datos.get("humedad_porcentaje", 0.0) or 0.0),
-                "luz_adc": float(datos.get("luz_adc", 0.0) or 0.0),
-                "distancia_cm": float(datos.get("distancia_cm", 0.0) or 0.0),
-                "vehiculo_en_entrada_detectado": bool(datos.get("vehiculo_en_entrada_detectado", False)),
-                "barrera_abierta": bool(datos.get("barrera_abierta", False)),
-                "luces_parking_encendidas": bool(datos.get("luces_parking_encendidas", False)),
-                "alarma_temperatura_activa": bool(datos.get("alarma_temperatura_activa", False))
-            }
-            
-            # Creamos el punto de datos como un diccionario
-            point = {
-                "measurement": "sensor_reading",
-                "tags": {
-                    "device_id": device_id, 
-                    "qc_status": str(qc_status)
-                },
-                "fields": fields_limpios,
-                "time": int(time.time())
-            }
-
-            self.client.write(record=point, write_precision="s")
-            print(f"Datos almacenados en InfluxDB para {device_id}")
+            point = self._construir_punto(datos, device_id, qc_status)
+            with LATENCIA_ETAPA.medir('almacenar_lectura'):
+                self.client.write(record=point, write_precision="ms")
+            log.debug("Datos almacenados en InfluxDB", extra={'device_id': device_id})
             return True
 
         except Exception as e:
-            print(f"Error almacenando en InfluxDB: {e}")
+            log.error("Error almacenando en InfluxDB: %s", e)
             return False
-        
+
+    def almacenar_lote(self, lecturas, qc_status):
+        """
+        Almacena varias lecturas en una sola escritura a InfluxDB.
+        `lecturas` es una lista de tuplas (datos, device_id, timestamp).
+        """
+        if not self.client:
+            log.warning("Cliente InfluxDB no inicializado.")
+            return False
+        if not lecturas:
+            return True
+
+        try:
+            points = [
+                self._construir_punto(datos, device_id, qc_status, timestamp)
+                for datos, device_id, timestamp in lecturas
+            ]
+            with LATENCIA_ETAPA.medir('almacenar_lectura'):
+                self.client.write(record=points, write_precision="ms")
+            log.debug("Lote de %d lecturas almacenado en InfluxDB", len(points))
+            return True
+
+        except Exception as e:
+            log.error("Error almacenando lote en InfluxDB: %s", e)
+            return False
+
     def consultar_historico_temperatura(self, limite=30):
         """Consulta simple para historial de temperatura (usado por WebSocket)."""
         if not self.client: return []
+        try:
+            # LIMIT no admite parámetros enlazados: se valida como entero acotado
+            limite = max(1, min(int(limite), LIMITE_MAXIMO_HISTORICO))
+        except (TypeError, ValueError):
+            log.warning("Límite de histórico inválido: %r", limite)
+            return []
+
+        clave = ('historico_temperatura', limite)
+        resultado = _cache.obtener(clave)
+        if resultado is not None:
+            return resultado
         try:
             query = f"""
                 SELECT "time", "temp_celsius" 
@@ -84,45 +178,224 @@ class TimeSeriesManager:
                 LIMIT {limite}
             """
             table = self.client.query(query=query)
-            df = table.to_pandas()
-            if df.empty: return []
-            
-            df = df.rename(columns={"temp_celsius": "y"}) 
-            df['x'] = (df['time'].astype(int) / 1_000_000).astype(int)
-            return df[['x', 'y']].to_dict('records')[::-1]
+            if table.num_rows == 0: return []
+
+            # Directo desde las columnas Arrow: pandas no se importa al conectar el primer panel
+            tiempos_ns = table.column('time').cast(pa.int64()).to_pylist()
+            temperaturas = table.column('temp_celsius').to_pylist()
+            resultado = [{'x': t // 1_000_000, 'y': y} for t, y in zip(tiempos_ns, temperaturas)][::-1]
+            _cache.guardar(clave, resultado, TTL_HISTORICO_RECIENTE_S)
+            return resultado
         except Exception as e:
-            print(f"Error consultando histórico: {e}")
+            log.error("Error consultando histórico: %s", e)
             return []
 
     def consultar_rango_fechas(self, fecha_inicio, fecha_fin):
-        """Consulta datos para Clustering e Inferencia dentro de un rango."""
+        """
+        Consulta datos para Clustering e Inferencia dentro de un rango.
+        El rango consultado se alinea a TSDB_CACHE_BUCKET_S y se guarda en caché;
+        cada llamada recorta el resultado alineado al rango pedido.
+        """
         if not self.client:
-            print("Cliente DB no conectado.")
+            log.warning("Cliente DB no conectado.")
+            return []
+
+        try:
+            inicio_ns, fin_ns = _epoch_ns(fecha_inicio), _epoch_ns(fecha_fin)
+        except (TypeError, ValueError) as e:
+            log.error("Rango de fechas inválido (%r a %r): %s", fecha_inicio, fecha_fin, e)
             return []
+
+        inicio_alineado, fin_alineado = alinear_rango(inicio_ns // 1_000_000_000, -(-fin_ns // 1_000_000_000))
+        clave = ('rango_fechas', inicio_alineado, fin_alineado)
         
-        query = f"""
+        query = """
             SELECT "time", "temp_celsius", "humedad_porcentaje"
             FROM "sensor_reading"
-            WHERE time >= '{fecha_inicio}' AND time <= '{fecha_fin}'
+            WHERE time >= $inicio AND time <= $fin
             AND "temp_celsius" > 0
             ORDER BY time ASC
         """
         try:
-            print(f"Consultando rango: {fecha_inicio} a {fecha_fin}")
-            table = self.client.query(query=query)
+            table = _cache.obtener(clave)
+            if table is None:
+                log.info("Consultando rango: %s a %s", fecha_inicio, fecha_fin)
+                table = self.client.query(
+                    query=query,
+                    query_parameters={"inicio": _iso_epoch(inicio_alineado), "fin": _iso_epoch(fin_alineado)}
+                )
+                # Un rango que toca el presente todavía puede recibir datos
+                cerrado = fin_alineado < time.time() - TSDB_CACHE_BUCKET_S
+                _cache.guardar(clave, table, TSDB_CACHE_TTL_HISTORICO_S if cerrado else TSDB_CACHE_TTL_S)
+
+            if table.num_rows:
+                tipo_tiempo = table.schema.field("time").type
+                columna = table["time"]
+                table = table.filter(pc.and_(
+                    pc.greater_equal(columna, pa.scalar(inicio_ns, pa.timestamp('ns')).cast(tipo_tiempo)),
+                    pc.less_equal(columna, pa.scalar(fin_ns, pa.timestamp('ns')).cast(tipo_tiempo))
+                ))
             df = table.to_pandas()
             
             if df.empty:
-                print("No se encontraron datos en ese rango.")
+                log.info("No se encontraron datos en ese rango.")
                 return []
             
             df['time'] = df['time'].astype(str)
             return df.to_dict('records')
             
         except Exception as e:
-            print(f"Error consultando rango de fechas: {e}")
+            log.error("Error consultando rango de fechas: %s", e)
+            return []
+
+    def iterar_rango_fechas(self, fecha_inicio, fecha_fin, columnas=("temp_celsius", "humedad_porcentaje")):
+        """
+        Igual que consultar_rango_fechas pero sin materializar el resultado:
+        produce los RecordBatch de Arrow a medida que llegan del servidor
+        (memoria acotada para rangos grandes).
+        """
+        if not self.client:
+            log.warning("Cliente DB no conectado.")
+            return
+
+        lista_columnas = ", ".join(f'"{c}"' for c in columnas)
+        query = f"""
+            SELECT "time", {lista_columnas}
+            FROM "sensor_reading"
+            WHERE time >= $inicio AND time <= $fin
+            AND "temp_celsius" > 0
+            ORDER BY time ASC
+        """
+        lector = self.client.query(
+            query=query,
+            mode="reader",
+            query_parameters={"inicio": fecha_inicio, "fin": fecha_fin}
+        )
+        for lote in lector:
+            if lote.num_rows:
+                yield lote
+
+    def consultar_serie_reconstruida(self, campo, fecha_inicio, fecha_fin, intervalo="1m",
+                                     metodo="escalon", device_id=None):
+        """
+        Serie regular de un campo a partir de puntos comprimidos (services/deadband.py):
+        rellena los buckets vacíos con el último valor ('escalon', para DEADBAND_MODO=deadband)
+        o interpolando entre puntos guardados ('lineal', para swinging_door).
+        """
+        if not self.client:
+            log.warning("Cliente DB no conectado.")
+            return []
+        if campo not in CAMPOS_EXPORTABLES:
+            raise ValueError(f"Campo desconocido: {campo!r}")
+        if metodo not in ("escalon", "lineal"):
+            raise ValueError(f"Método de reconstrucción desconocido: {metodo!r}")
+        coincidencia = INTERVALO_RE.match(intervalo)
+        if not coincidencia:
+            raise ValueError(f"Intervalo inválido: {intervalo!r} (ej. 30s, 5m, 1h, 1d)")
+        cantidad, unidad = coincidencia.groups()
+
+        # Las banderas no se interpolan
+        if campo in CAMPOS_BOOLEANOS_INFLUX:
+            agregado = f'locf(bool_or("{campo}"))'
+        else:
+            relleno = "locf" if metodo == "escalon" else "interpolate"
+            agregado = f'{relleno}(avg("{campo}"))'
+
+        parametros = {"inicio": fecha_inicio, "fin": fecha_fin}
+        filtro_dispositivo = ""
+        if device_id:
+            parametros["device_id"] = device_id
+            filtro_dispositivo = "AND device_id = $device_id"
+
+        query = f"""
+            SELECT date_bin_gapfill(INTERVAL '{cantidad} {UNIDADES_INTERVALO[unidad]}', time) AS time,
+                   {agregado} AS valor
+            FROM "sensor_reading"
+            WHERE time >= $inicio AND time <= $fin {filtro_dispositivo}
+            GROUP BY 1
+            ORDER BY 1 ASC
+        """
+        try:
+            df = self.client.query(query=query, query_parameters=parametros).to_pandas()
+            if df.empty:
+                return []
+            df = df.dropna(subset=["valor"])
+            df['time'] = df['time'].astype(str)
+            return df.to_dict('records')
+        except Exception as e:
+            log.error("Error reconstruyendo la serie %s: %s", campo, e)
             return []
 
+    def lector_exportacion(self, fecha_inicio, fecha_fin, dispositivos=None, campos=None, intervalo=None):
+        """
+        RecordBatchReader de Arrow con los puntos 'sensor_reading' del rango,
+        opcionalmente filtrados por dispositivo y campos. Con `intervalo`
+        (p. ej. '1m', '1h') se agrega en el servidor: promedio para los campos
+        numéricos y OR para los booleanos.
+        """
+        if not self.client:
+            raise ConnectionError("Cliente InfluxDB no inicializado.")
+
+        campos = list(campos or CAMPOS_EXPORTABLES)
+        desconocidos = [c for c in campos if c not in CAMPOS_EXPORTABLES]
+        if desconocidos:
+            raise ValueError(f"Campos no exportables: {', '.join(desconocidos)}")
+
+        parametros = {"inicio": fecha_inicio, "fin": fecha_fin}
+        filtro_dispositivos = ""
+        if dispositivos:
+            marcadores = []
+            for i, device_id in enumerate(dispositivos):
+                parametros[f"d{i}"] = device_id
+                marcadores.append(f"$d{i}")
+            filtro_dispositivos = f"AND device_id IN ({', '.join(marcadores)})"
+
+        if intervalo:
+            coincidencia = INTERVALO_RE.match(intervalo)
+            if not coincidencia:
+                raise ValueError(f"Intervalo inválido: {intervalo!r} (ej. 30s, 5m, 1h, 1d)")
+            cantidad, unidad = coincidencia.groups()
+            agregados = ", ".join(
+                f'bool_or("{c}") AS "{c}"' if c in CAMPOS_BOOLEANOS_INFLUX else f'avg("{c}") AS "{c}"'
+                for c in campos
+            )
+            query = f"""
+                SELECT date_bin(INTERVAL '{cantidad} {UNIDADES_INTERVALO[unidad]}', time) AS time,
+                       device_id, {agregados}
+                FROM "sensor_reading"
+                WHERE time >= $inicio AND time <= $fin {filtro_dispositivos}
+                GROUP BY 1, device_id
+                ORDER BY 1 ASC
+            """
+        else:
+            columnas = ", ".join(f'"{c}"' for c in campos)
+            query = f"""
+                SELECT time, device_id, {columnas}
+                FROM "sensor_reading"
+                WHERE time >= $inicio AND time <= $fin {filtro_dispositivos}
+                ORDER BY time ASC
+            """
+
+        log.info("Exportando rango %s a %s", fecha_inicio, fecha_fin,
+                 extra={'dispositivos': len(dispositivos or ()), 'intervalo': intervalo or 'crudo'})
+        return self.client.query(query=query, mode="reader", query_parameters=parametros)
+
+    def tabla_lecturas(self, fecha_inicio, fecha_fin, campos=CAMPOS_EXPORTABLES):
+        """
+        Lecturas crudas de [inicio, fin) como tabla Arrow ordenada por dispositivo
+        y tiempo (cada dispositivo queda contiguo; sin pasar por pandas).
+        """
+        if not self.client:
+            raise ConnectionError("Cliente InfluxDB no inicializado.")
+        columnas = ", ".join(f'"{c}"' for c in campos)
+        query = f"""
+            SELECT time, device_id, {columnas}
+            FROM "sensor_reading"
+            WHERE time >= $inicio AND time < $fin
+            ORDER BY device_id, time ASC
+        """
+        return self.client.query(query=query, query_parameters={"inicio": fecha_inicio, "fin": fecha_fin})
+
     # --- MÉTODO RECUPERADO PARA EL DASHBOARD ADMIN (CON ZONA HORARIA) ---
     def obtener_estadisticas_dashboard(self):
         """
@@ -130,6 +403,12 @@ class TimeSeriesManager:
         CONVIERTE DE UTC A ZONA HORARIA LOCAL (SONORA).
         """
         if not self.client: return {}
+        # pandas se carga en la primera consulta del dashboard, no al importar el gateway
+        import pandas as pd
+
+        resultado = _cache.obtener(('estadisticas_dashboard',))
+        if resultado is not None:
+            return resultado
         
         # Definir la zona horaria local
         ZONA_LOCAL = 'America/Hermosillo' 
@@ -209,12 +488,14 @@ class TimeSeriesManager:
                 resultado["ambiental"]["hum"] = df_e['hum'].round(1).tolist()
 
         except Exception as e:
-            print(f"Error generando estadísticas: {e}")
-            import traceback; traceback.print_exc()
+            log.exception("Error generando estadísticas: %s", e)
+        else:
+            # Solo se cachean las estadísticas completas
+            _cache.guardar(('estadisticas_dashboard',), resultado, TSDB_CACHE_TTL_S)
         
         return resultado
 
     def close(self):
         if self.client:
             self.client.close()
-            print("Cliente InfluxDB cerrado.")
\ No newline at end of file
+            log.debug("Cliente InfluxDB cerrado.")
\ No newline at end of file
@@ -0,0 +1,262 @@
+# fog-layer/services/vivacidad.py
+
+import os
+import time
+import threading
+
+from services.log_config import obtener_logger
+from services.metrics import registro
+
+log = obtener_logger("transwatch.vivacidad")
+
+VIVACIDAD_ENABLED = os.getenv('VIVACIDAD_ENABLED', 'true').lower() in ('1', 'true', 'si', 'yes')
+# Un dispositivo sin datos durante este tiempo pasa a offline
+VIVACIDAD_TIMEOUT_S = float(os.getenv('VIVACIDAD_TIMEOUT_S', '60'))
+# Timeout adaptativo: si el dispositivo reporta espaciado, se espera FACTOR veces su gap medio (0 = fijo)
+VIVACIDAD_FACTOR_GAP = float(os.getenv('VIVACIDAD_FACTOR_GAP', '5'))
+# Resolución y tamaño de la rueda de temporizadores
+VIVACIDAD_RESOLUCION_S = float(os.getenv('VIVACIDAD_RESOLUCION_S', '1'))
+VIVACIDAD_RANURAS = int(os.getenv('VIVACIDAD_RANURAS', '512'))
+
+# Gaps observados antes de usar el timeout adaptativo
+_MIN_GAPS_ADAPTATIVO = 3
+
+CAMBIOS_VIVACIDAD = registro.contador(
+    'transwatch_vivacidad_cambios_total', 'Transiciones de dispositivos a offline u online', etiqueta='estado'
+)
+GAPS_VIVACIDAD = registro.histograma(
+    'transwatch_vivacidad_gap_segundos', 'Tiempo entre mensajes consecutivos de un dispositivo',
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+
+
+class RuedaTemporizadores:
+    """
+    Rueda de temporizadores hasheada: `programar` es O(1) y `avanzar` solo
+    recorre las ranuras de los ticks transcurridos. Un vencimiento más lejano
+    que una vuelta completa queda en su ranura hasta la vuelta que le toca.
+    """
+
+    def __init__(self, resolucion_s=VIVACIDAD_RESOLUCION_S, ranuras=VIVACIDAD_RANURAS, ahora=None):
+        self.resolucion_s = resolucion_s
+        self.n = max(1, ranuras)
+        self._ranuras = [[] for _ in range(self.n)]
+        self._tick = int((ahora if ahora is not None else time.time()) // resolucion_s)
+        self.pendientes = 0
+
+    def programar(self, clave, vence):
+        # Nunca en un tick ya procesado: lo vencido sale en el próximo avance
+        tick = max(int(vence // self.resolucion_s), self._tick + 1)
+        self._ranuras[tick % self.n].append((tick, clave))
+        self.pendientes += 1
+
+    def avanzar(self, ahora):
+        """Claves cuyo tick ya llegó"""
+        objetivo = int(ahora // self.resolucion_s)
+        vencidas = []
+        if objetivo <= self._tick:
+            return vencidas
+        # Tras una pausa de más de una vuelta basta recorrer cada ranura una vez
+        pasos = min(objetivo - self._tick, self.n)
+        for tick in range(objetivo - pasos + 1, objetivo + 1):
+            ranura = self._ranuras[tick % self.n]
+            if not ranura:
+                continue
+            quedan = []
+            for entrada in ranura:
+                if entrada[0] <= objetivo:
+                    vencidas.append(entrada[1])
+                else:
+                    quedan.append(entrada)
+            self._ranuras[tick % self.n] = quedan
+        self.pendientes -= len(vencidas)
+        self._tick = objetivo
+        return vencidas
+
+
+class _Dispositivo:
+    __slots__ = ('ultimo', 'vence', 'en_rueda', 'online', 'n_gaps', 'gap_medio', 'gap_m2', 'gap_max', 'caidas')
+
+    def __init__(self, ultimo):
+        self.ultimo = ultimo
+        self.vence = 0.0
+        self.en_rueda = False
+        self.online = True
+        self.n_gaps = 0
+        self.gap_medio = 0.0     # media y M2 de Welford (varianza incremental)
+        self.gap_m2 = 0.0
+        self.gap_max = 0.0
+        self.caidas = 0
+
+
+class MonitorVivacidad:
+    """
+    Detecta dispositivos que dejan de reportar. Cada mensaje solo actualiza el
+    último visto y las estadísticas de gaps del dispositivo (O(1)); la rueda
+    no se toca mientras el dispositivo ya tenga un temporizador. Al vencer
+    el temporizador se compara con el último visto real: si el dispositivo
+    siguió reportando se reprograma, si no pasa a offline.
+
+    `al_cambiar(device_id, online, info)` se llama fuera del lock en cada
+    transición (offline y de vuelta online).
+    """
+
+    def __init__(self, al_cambiar=None, timeout_s=VIVACIDAD_TIMEOUT_S, factor_gap=VIVACIDAD_FACTOR_GAP,
+                 resolucion_s=VIVACIDAD_RESOLUCION_S, ranuras=VIVACIDAD_RANURAS):
+        self.al_cambiar = al_cambiar
+        self.timeout_s = timeout_s
+        self.factor_gap = factor_gap
+        self.resolucion_s = resolucion_s
+        self._rueda = RuedaTemporizadores(resolucion_s, ranuras)
+        self._dispositivos = {}
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+        registro.gauge('transwatch_dispositivos', 'Dispositivos conocidos por estado de vivacidad',
+                       self.conteo_por_estado, etiqueta='estado')
+        registro.gauge('transwatch_dispositivo_sin_datos_segundos', 'Segundos desde el último mensaje por dispositivo',
+                       lambda: {d: round(time.time() - e.ultimo, 1) for d, e in list(self._dispositivos.items())},
+                       etiqueta='device_id')
+
+    def _timeout(self, d):
+        if self.factor_gap and d.n_gaps >= _MIN_GAPS_ADAPTATIVO:
+            return max(self.timeout_s, self.factor_gap * d.gap_medio)
+        return self.timeout_s
+
+    def _programar(self, d, device_id):
+        self._rueda.programar(device_id, d.vence)
+        d.en_rueda = True
+
+    def vistos(self, pares):
+        """Registra mensajes [(device_id, ts_recepcion)] de un lote (un solo lock por lote)"""
+        cambios = []
+        with self._lock:
+            for device_id, ts in pares:
+                d = self._dispositivos.get(device_id)
+                if d is None:
+                    d = self._dispositivos[device_id] = _Dispositivo(ts)
+                    d.vence = ts + self.timeout_s
+                    self._programar(d, device_id)
+                    continue
+                gap = ts - d.ultimo
+                if gap <= 0:
+                    continue  # desordenado dentro del lote o repetido
+                d.ultimo = ts
+                if not d.online:
+                    # El hueco de la caída no entra en las estadísticas de reporte normal
+                    d.online = True
+                    cambios.append((device_id, True, self._info(d, device_id, ts, gap)))
+                else:
+                    d.n_gaps += 1
+                    delta = gap - d.gap_medio
+                    d.gap_medio += delta / d.n_gaps
+                    d.gap_m2 += delta * (gap - d.gap_medio)
+                    d.gap_max = max(d.gap_max, gap)
+                    GAPS_VIVACIDAD.observar(gap)
+                d.vence = ts + self._timeout(d)
+                if not d.en_rueda:
+                    self._programar(d, device_id)
+        self._notificar(cambios)
+
+    def visto(self, device_id, ts=None):
+        self.vistos([(device_id, ts if ts is not None else time.time())])
+
+    def revisar(self, ahora=None):
+        """Procesa los temporizadores vencidos; lo llama el hilo del monitor en cada tick"""
+        ahora = ahora if ahora is not None else time.time()
+        cambios = []
+        with self._lock:
+            for device_id in self._rueda.avanzar(ahora):
+                d = self._dispositivos.get(device_id)
+                if d is None:
+                    continue
+                d.en_rueda = False
+                if d.vence > ahora:
+                    self._programar(d, device_id)
+                elif d.online:
+                    d.online = False
+                    d.caidas += 1
+                    cambios.append((device_id, False, self._info(d, device_id, ahora, ahora - d.ultimo)))
+        self._notificar(cambios)
+        return len(cambios)
+
+    def _notificar(self, cambios):
+        for device_id, online, info in cambios:
+            CAMBIOS_VIVACIDAD.inc(etiqueta='online' if online else 'offline')
+            if online:
+                log.info("Dispositivo %s volvió a reportar tras %.0f s", device_id, info['segundos_sin_datos'])
+            else:
+                log.warning("Dispositivo %s sin datos desde hace %.0f s", device_id, info['segundos_sin_datos'])
+            if self.al_cambiar is not None:
+                try:
+                    self.al_cambiar(device_id, online, info)
+                except Exception as e:
+                    log.exception("Error notificando cambio de vivacidad de %s: %s", device_id, e)
+
+    def _info(self, d, device_id, ahora, sin_datos):
+        return {
+            'device_id': device_id,
+            'online': d.online,
+            'ultimo_visto': d.ultimo,
+            'segundos_sin_datos': round(sin_datos, 1),
+            'timeout_s': round(self._timeout(d), 1),
+            'gap_medio_s': round(d.gap_medio, 2),
+            'gap_desviacion_s': round((d.gap_m2 / d.n_gaps) ** 0.5, 2) if d.n_gaps else 0.0,
+            'gap_max_s': round(d.gap_max, 2),
+            'gaps': d.n_gaps,
+            'caidas': d.caidas
+        }
+
+    def estadisticas(self, device_id=None, ahora=None):
+        """Estado y estadísticas de gaps por dispositivo (todos o uno)"""
+        ahora = ahora if ahora is not None else time.time()
+        with self._lock:
+            elegidos = self._dispositivos.items() if device_id is None else (
+                [(device_id, self._dispositivos[device_id])] if device_id in self._dispositivos else []
+            )
+            return [self._info(d, dispositivo, ahora, ahora - d.ultimo) for dispositivo, d in elegidos]
+
+    def conteo_por_estado(self):
+        with self._lock:
+            online = sum(1 for d in self._dispositivos.values() if d.online)
+            return {'online': online, 'offline': len(self._dispositivos) - online}
+
+    # --- Snapshot de arranque en caliente ---
+    def exportar(self):
+        with self._lock:
+            return {
+                device_id: (d.ultimo, d.online, d.n_gaps, d.gap_medio, d.gap_m2, d.gap_max, d.caidas)
+                for device_id, d in self._dispositivos.items()
+            }
+
+    def restaurar(self, estado, ahora=None):
+        """Los dispositivos online reciben un timeout completo desde ahora (el gateway estuvo detenido)"""
+        ahora = ahora if ahora is not None else time.time()
+        with self._lock:
+            for device_id, (ultimo, online, n_gaps, gap_medio, gap_m2, gap_max, caidas) in estado.items():
+                d = self._dispositivos[device_id] = _Dispositivo(ultimo)
+                d.online, d.n_gaps, d.gap_medio, d.gap_m2, d.gap_max, d.caidas = (
+                    online, n_gaps, gap_medio, gap_m2, gap_max, caidas
+                )
+                if online:
+                    d.vence = ahora + self._timeout(d)
+                    self._programar(d, device_id)
+
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._detener.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="vivacidad", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        if self._hilo:
+            self._hilo.join(5)
+
+    def _bucle(self):
+        while not self._detener.wait(self.resolucion_s):
+            try:
+                self.revisar()
+            except Exception as e:
+                log.exception("Error revisando vivacidad de dispositivos: %s", e)
@@ -0,0 +1,117 @@
+"""
+Benchmark de arranque de los puntos de entrada del fog layer de TRANSWATCH.
+
+Importa cada módulo en un proceso nuevo (sin caché de módulos del padre) y
+mide el tiempo de importación, el RSS máximo del proceso y qué dependencias
+pesadas (pandas, scikit-learn, ...) quedaron cargadas. Sirve para detectar
+que alguien volvió a importar pandas o el motor de ML a nivel de módulo en
+el camino de ingesta.
+
+Uso:
+  python tests/bench_arranque.py
+  python tests/bench_arranque.py --modulos data_collector,api_async --repeticiones 5
+  python tests/bench_arranque.py --prohibidos pandas,sklearn --max-segundos 1.5 --guardar arranque.json
+
+Termina con código 1 si algún módulo carga un paquete prohibido o supera
+--max-segundos (mediana), para poder usarlo en CI.
+"""
+
+import os
+import sys
+import json
+import platform
+import argparse
+import statistics
+import subprocess
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULOS = (
+    'data_collector',
+    'gateway_sharded',
+    'api_async',
+    'ingesta_tcp',
+    'services.notification_engine',
+    'services.tsdb_manager',
+)
+PESADOS = ('pandas', 'sklearn', 'scipy', 'matplotlib', 'numpy', 'pyarrow')
+
+# Se ejecuta en el hijo: mide solo el import del módulo, no el arranque del intérprete
+_SONDA = """
+import sys, json, time, resource
+inicio = time.perf_counter()
+import {modulo}
+segundos = time.perf_counter() - inicio
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss_kb //= 1024
+print(json.dumps({{
+    'segundos': segundos,
+    'rss_mb': rss_kb / 1024,
+    'cargados': [p for p in {pesados!r} if p in sys.modules]
+}}))
+"""
+
+
+def medir(modulo, pesados):
+    entorno = dict(os.environ, LOG_LEVEL='WARNING', METRICS_PORT='0', PYTHONDONTWRITEBYTECODE='1')
+    proceso = subprocess.run(
+        [sys.executable, '-c', _SONDA.format(modulo=modulo, pesados=tuple(pesados))],
+        cwd=RAIZ, env=entorno, capture_output=True, text=True, timeout=120
+    )
+    if proceso.returncode != 0:
+        raise RuntimeError(proceso.stderr.strip().splitlines()[-1] if proceso.stderr.strip() else 'falló el import')
+    return json.loads(proceso.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modulos', default=','.join(MODULOS), help='Módulos a importar, separados por coma')
+    parser.add_argument('--repeticiones', type=int, default=3, help='Procesos por módulo (se reporta la mediana)')
+    parser.add_argument('--prohibidos', default='', help='Paquetes que no deben cargarse al importar, p. ej. pandas,sklearn')
+    parser.add_argument('--max-segundos', type=float, default=0, help='Tiempo máximo de import (mediana); 0 = sin límite')
+    parser.add_argument('--guardar', help='Archivo JSON con los resultados')
+    args = parser.parse_args()
+
+    prohibidos = [p for p in args.prohibidos.split(',') if p]
+    pesados = list(dict.fromkeys(PESADOS + tuple(prohibidos)))
+    resultados = {}
+    fallas = []
+
+    print(f"{'módulo':32} {'import s':>9} {'RSS MB':>8}  pesados cargados")
+    for modulo in (m for m in args.modulos.split(',') if m):
+        try:
+            muestras = [medir(modulo, pesados) for _ in range(max(1, args.repeticiones))]
+        except (RuntimeError, subprocess.TimeoutExpired) as e:
+            print(f"{modulo:32} {'error':>9}           {e}")
+            fallas.append(f"{modulo}: {e}")
+            continue
+        segundos = statistics.median(m['segundos'] for m in muestras)
+        rss_mb = statistics.median(m['rss_mb'] for m in muestras)
+        cargados = muestras[-1]['cargados']
+        resultados[modulo] = {'segundos': round(segundos, 4), 'rss_mb': round(rss_mb, 1), 'cargados': cargados}
+        print(f"{modulo:32} {segundos:9.3f} {rss_mb:8.1f}  {', '.join(cargados) or '-'}")
+
+        for paquete in prohibidos:
+            if paquete in cargados:
+                fallas.append(f"{modulo} carga {paquete} al importarse")
+        if args.max_segundos and segundos > args.max_segundos:
+            fallas.append(f"{modulo} tarda {segundos:.3f} s en importarse (máximo {args.max_segundos} s)")
+
+    if args.guardar:
+        with open(args.guardar, 'w', encoding='utf-8') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'plataforma': platform.platform(),
+                'repeticiones': args.repeticiones,
+                'modulos': resultados
+            }, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados guardados en {args.guardar}")
+
+    for falla in fallas:
+        print(f"FALLA: {falla}")
+    sys.exit(1 if fallas else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""
+Benchmark extremo a extremo del gateway de TRANSWATCH.
+
+Simula N dispositivos publicando a una tasa configurable (con outliers,
+tormentas de alertas y timestamps desordenados) y ejecuta el pipeline real
+de data_collector (decode, QC, alertas, micro-lotes) con InfluxDB, Azure y
+SMTP sustituidos por stubs con latencia configurable.
+
+Modos:
+  - directo (default): los mensajes entran por on_message_local, sin broker.
+  - --broker: se publican a un broker MQTT local (p. ej. Mosquitto de
+    docker-compose) y el gateway los recibe por su cliente paho real.
+
+Ejemplo:
+  python tests/benchmark_gateway.py --dispositivos 200 --tasa 2 --duracion 30
+  python tests/benchmark_gateway.py --broker --outliers 0.02 --tormenta 0.1 --json resultado.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import threading
+
+# Configuración previa a importar el gateway: sin endpoint de métricas y logs mínimos
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('EMAIL_FROM', 'benchmark@transwatch.local')
+os.environ.setdefault('EMAIL_PASSWORD', 'benchmark')
+os.environ.setdefault('EMAIL_TO', 'benchmark@transwatch.local')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.log_config import configurar_logging
+configurar_logging()
+
+import paho.mqtt.client as mqtt
+import data_collector as dc
+import services.notification_engine as notification_module
+from services.tsdb_manager import TimeSeriesManager
+from services.ingest_batcher import MicroBatcher
+from services.metrics import LATENCIA_ETAPA, RESULTADOS_QC
+from services.carriles import LATENCIA_ALERTA, ALERTAS_FUERA_PRESUPUESTO
+
+
+# --- Stubs de servicios externos ---
+class InfluxStub:
+    def __init__(self, latencia_ms):
+        self.latencia = latencia_ms / 1000.0
+        self.puntos = 0
+        self.escrituras = 0
+
+    def write(self, record=None, write_precision=None, **kwargs):
+        if self.latencia:
+            time.sleep(self.latencia)
+        self.escrituras += 1
+        self.puntos += len(record) if isinstance(record, list) else 1
+
+    def query(self, *args, **kwargs):
+        raise RuntimeError("Consultas no disponibles en el benchmark")
+
+    def close(self):
+        pass
+
+
+class TSDBStub(TimeSeriesManager):
+    cliente_compartido = None
+
+    def __init__(self):
+        self.client = TSDBStub.cliente_compartido
+
+
+class AzureStub:
+    """Sumidero de lecturas limpias: calcula la latencia desde el envío del simulador"""
+
+    def __init__(self, latencia_ms):
+        self.latencia = latencia_ms / 1000.0
+        self.latencias = []
+        self._lock = threading.Lock()
+
+    def send_message(self, message):
+        if self.latencia:
+            time.sleep(self.latencia)
+        enviado = json.loads(message.data).get('t_envio')
+        if enviado is not None:
+            with self._lock:
+                self.latencias.append(time.time() - enviado)
+
+
+# --- Simulador de dispositivos ---
+class SimuladorDispositivos:
+    def __init__(self, n, outliers, tormenta, desorden, semilla=42):
+        self.rng = random.Random(semilla)
+        self.dispositivos = [
+            {
+                'device_id': f"bench-{i:05d}",
+                'temp': self.rng.uniform(18.0, 30.0),
+                'hum': self.rng.uniform(35.0, 70.0),
+                'luz': self.rng.randint(500, 3500),
+                'tormenta': self.rng.random() < tormenta
+            }
+            for i in range(n)
+        ]
+        self.outliers = outliers
+        self.desorden = desorden
+
+    def mensaje(self, indice):
+        d = self.dispositivos[indice % len(self.dispositivos)]
+        temp = d['temp'] + self.rng.gauss(0, 0.3)
+        if d['tormenta']:
+            temp = self.rng.uniform(51.0, 58.0)  # dispara incendio_posible/temperatura_alta
+        elif self.rng.random() < self.outliers:
+            temp += self.rng.choice((-1, 1)) * self.rng.uniform(10.0, 25.0)
+
+        ahora = time.time()
+        marca = ahora - self.rng.uniform(1, 30) if self.rng.random() < self.desorden else ahora
+        vehiculo = self.rng.random() < 0.05
+        return json.dumps({
+            'device_id': d['device_id'],
+            'timestamp': time.strftime('%H:%M:%S', time.localtime(marca)),
+            'temperatura_celsius': round(temp, 2),
+            'humedad_porcentaje': round(d['hum'] + self.rng.gauss(0, 0.5), 2),
+            'luz_adc': d['luz'] + self.rng.randint(-20, 20),
+            'distancia_cm': 8 if vehiculo else 120 + self.rng.randint(-2, 2),
+            'vehiculo_en_entrada_detectado': vehiculo,
+            'barrera_abierta': vehiculo,
+            'luces_parking_encendidas': d['luz'] < 1000,
+            'alarma_temperatura_activa': d['tormenta'],
+            't_envio': ahora
+        }).encode('utf-8')
+
+
+class _MensajeDirecto:
+    __slots__ = ('payload', 'topic')
+
+    def __init__(self, payload, topic):
+        self.payload = payload
+        self.topic = topic
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for linea in f:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100.0))]
+
+
+def esperar_loop(loop, timeout):
+    """Espera a que terminen broadcast/alertas pendientes en el loop asíncrono"""
+    async def pendientes():
+        actual = asyncio.current_task()
+        tareas = [t for t in asyncio.all_tasks() if t is not actual]
+        if tareas:
+            await asyncio.wait(tareas, timeout=timeout)
+    asyncio.run_coroutine_threadsafe(pendientes(), loop).result()
+
+
+def preparar_gateway(args):
+    influx = InfluxStub(args.lat_influx_ms)
+    azure = AzureStub(args.lat_azure_ms)
+    TSDBStub.cliente_compartido = influx
+
+    dc.tsdbmanager = TSDBStub()
+    dc.notification_engine.alert_store.tsdb = dc.tsdbmanager
+    dc.azure_client = azure
+    notification_module.TimeSeriesManager = TSDBStub
+    dc.notification_engine._send_email_sync = lambda *a, **k: time.sleep(args.lat_smtp_ms / 1000.0)
+
+    # Loop equivalente al del servidor WebSocket (sin abrir el puerto)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="benchmark-loop", daemon=True).start()
+    dc.websocket_loop = loop
+    return influx, azure
+
+
+def ejecutar(args):
+    influx, azure = preparar_gateway(args)
+    simulador = SimuladorDispositivos(args.dispositivos, args.outliers, args.tormenta, args.desorden)
+    total_objetivo = int(args.dispositivos * args.tasa * args.duracion)
+    intervalo = 1.0 / (args.dispositivos * args.tasa)
+
+    publicador = None
+    if args.broker:
+        dc.iniciar_gateway_mqtt()
+        publicador = mqtt.Client()
+        publicador.connect(dc.LOCAL_MQTT_BROKER or 'localhost', dc.LOCAL_MQTT_PORT, 60)
+        publicador.loop_start()
+        time.sleep(1)  # dar tiempo a la suscripción del gateway
+    else:
+        dc.micro_batcher = MicroBatcher(dc.procesar_lote, dc.MQTT_BATCH_SIZE, dc.MQTT_BATCH_MS)
+        dc.iniciar_carriles()
+        dc.micro_batcher.iniciar()
+
+    rss_inicial = rss_mb()
+    uso_inicial = resource.getrusage(resource.RUSAGE_SELF)
+    inicio = time.perf_counter()
+
+    for i in range(total_objetivo):
+        objetivo = inicio + i * intervalo
+        espera = objetivo - time.perf_counter()
+        if espera > 0:
+            time.sleep(espera)
+        payload = simulador.mensaje(i)
+        if publicador:
+            publicador.publish(dc.LOCAL_MQTT_TOPIC, payload, qos=dc.LOCAL_MQTT_QOS)
+        else:
+            dc.on_message_local(None, None, _MensajeDirecto(payload, dc.LOCAL_MQTT_TOPIC))
+    fin_envio = time.perf_counter()
+
+    # Esperar a que el pipeline termine de procesar lo enviado
+    limite = time.perf_counter() + args.drenado
+    while time.perf_counter() < limite:
+        if sum(RESULTADOS_QC.valores().values()) >= total_objetivo:
+            break
+        time.sleep(0.05)
+    # Vacía la E/S pendiente del carril de telemetría y las alertas prioritarias
+    dc.detener_carriles()
+    esperar_loop(dc.websocket_loop, max(0.0, limite - time.perf_counter()))
+    fin = time.perf_counter()
+
+    uso_final = resource.getrusage(resource.RUSAGE_SELF)
+    procesados = sum(RESULTADOS_QC.valores().values())
+    duracion = fin - inicio
+    cpu = (uso_final.ru_utime - uso_inicial.ru_utime) + (uso_final.ru_stime - uso_inicial.ru_stime)
+
+    etapas = {}
+    for etapa, (cuenta, suma) in sorted(LATENCIA_ETAPA.resumen().items()):
+        etapas[etapa] = {
+            'llamadas': cuenta,
+            'total_s': round(suma, 4),
+            'media_ms': round(suma / cuenta * 1000, 4) if cuenta else None,
+            'p99_ms_bucket': (LATENCIA_ETAPA.percentil(99, etapa) or 0) * 1000,
+            # La espera en cola se solapa entre mensajes: su suma no es tiempo del pipeline
+            'porcentaje_duracion': round(100.0 * suma / duracion, 1) if duracion and etapa != 'espera_cola' else None
+        }
+
+    alertas = {}
+    for canal, (cuenta, suma) in sorted(LATENCIA_ALERTA.resumen().items()):
+        alertas[canal] = {
+            'entregas': cuenta,
+            'media_ms': round(suma / cuenta * 1000, 3) if cuenta else None,
+            'p50_ms_bucket': (LATENCIA_ALERTA.percentil(50, canal) or 0) * 1000,
+            'p99_ms_bucket': (LATENCIA_ALERTA.percentil(99, canal) or 0) * 1000
+        }
+
+    resultado = {
+        'config': vars(args),
+        'enviados': total_objetivo,
+        'procesados': procesados,
+        'por_resultado': RESULTADOS_QC.valores(),
+        'duracion_s': round(duracion, 3),
+        'tasa_envio_msgs_s': round(total_objetivo / (fin_envio - inicio), 1),
+        'throughput_msgs_s': round(procesados / duracion, 1) if duracion else None,
+        'latencia_p50_ms': round((percentil(azure.latencias, 50) or 0) * 1000, 3),
+        'latencia_p99_ms': round((percentil(azure.latencias, 99) or 0) * 1000, 3),
+        'cpu_s': round(cpu, 3),
+        'cpu_porcentaje': round(100.0 * cpu / duracion, 1) if duracion else None,
+        'rss_inicial_mb': round(rss_inicial, 1),
+        'rss_final_mb': round(rss_mb(), 1),
+        'influx_puntos': influx.puntos,
+        'influx_escrituras': influx.escrituras,
+        'etapas': etapas,
+        'alertas_prioritarias': alertas,
+        'alertas_fuera_presupuesto': sum(ALERTAS_FUERA_PRESUPUESTO.valores().values())
+    }
+
+    if publicador:
+        publicador.loop_stop()
+        publicador.disconnect()
+    if dc.local_mqtt_client:
+        dc.local_mqtt_client.loop_stop()
+        dc.local_mqtt_client.disconnect()
+    if dc.micro_batcher:
+        dc.micro_batcher.detener()
+    return resultado
+
+
+def imprimir_reporte(r):
+    print("\n=== Benchmark gateway TRANSWATCH ===")
+    print(f"Enviados / procesados : {r['enviados']} / {r['procesados']}  {r['por_resultado']}")
+    print(f"Duración              : {r['duracion_s']} s (envío a {r['tasa_envio_msgs_s']} msgs/s)")
+    print(f"Throughput            : {r['throughput_msgs_s']} msgs/s")
+    print(f"Latencia e2e p50/p99  : {r['latencia_p50_ms']} / {r['latencia_p99_ms']} ms")
+    print(f"CPU                   : {r['cpu_s']} s ({r['cpu_porcentaje']}% de un núcleo)")
+    print(f"RSS inicial / final   : {r['rss_inicial_mb']} / {r['rss_final_mb']} MB")
+    print(f"InfluxDB              : {r['influx_puntos']} puntos en {r['influx_escrituras']} escrituras")
+    if r['alertas_prioritarias']:
+        print(f"\nAlertas prioritarias (detección -> entrega), fuera de presupuesto: {r['alertas_fuera_presupuesto']}")
+        print("Canal        entregas   media ms   p50 ms   p99 ms")
+        for canal, a in r['alertas_prioritarias'].items():
+            print(f"{canal:<12} {a['entregas']:>8} {a['media_ms']:>10} {a['p50_ms_bucket']:>8} {a['p99_ms_bucket']:>8}")
+    print("\nEtapa                      llamadas   total s   media ms   p99 ms   % tiempo")
+    for etapa, e in r['etapas'].items():
+        print(f"{etapa:<26} {e['llamadas']:>8} {e['total_s']:>9} {e['media_ms']:>10} {e['p99_ms_bucket']:>8} {e['porcentaje_duracion'] if e['porcentaje_duracion'] is not None else '-':>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark extremo a extremo del gateway")
+    parser.add_argument('--dispositivos', type=int, default=100)
+    parser.add_argument('--tasa', type=float, default=1.0, help="Mensajes por segundo por dispositivo")
+    parser.add_argument('--duracion', type=float, default=20.0, help="Segundos de envío")
+    parser.add_argument('--outliers', type=float, default=0.01, help="Probabilidad de valor atípico")
+    parser.add_argument('--tormenta', type=float, default=0.0, help="Fracción de dispositivos en tormenta de alertas")
+    parser.add_argument('--desorden', type=float, default=0.0, help="Probabilidad de timestamp desordenado")
+    parser.add_argument('--broker', action='store_true', help="Publicar a través del broker MQTT local")
+    parser.add_argument('--lat-influx-ms', type=float, default=2.0)
+    parser.add_argument('--lat-azure-ms', type=float, default=0.0)
+    parser.add_argument('--lat-smtp-ms', type=float, default=50.0)
+    parser.add_argument('--drenado', type=float, default=30.0, help="Segundos máximos para vaciar el pipeline")
+    parser.add_argument('--json', help="Archivo donde guardar el resultado")
+    args = parser.parse_args()
+
+    resultado = ejecutar(args)
+    imprimir_reporte(resultado)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(resultado, f, indent=2)
+        print(f"\nResultado guardado en {args.json}")
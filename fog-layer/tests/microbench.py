@@ -0,0 +1,347 @@
+"""
+Microbenchmarks de los hot paths del fog layer de TRANSWATCH.
+
+Mide funciones que corren por mensaje o por petición (QC, validación rápida,
+evaluación de alertas, serialización de telemetría, análisis ML) y guarda los
+resultados como baseline JSON para comparar antes/después de cada optimización.
+
+Uso:
+  python tests/microbench.py ejecutar --guardar baseline.json
+  python tests/microbench.py ejecutar --filtro qc --guardar despues.json
+  python tests/microbench.py comparar baseline.json despues.json --umbral 10
+
+`comparar` termina con código 1 si algún caso es más lento que el baseline
+por encima del umbral (en %), para poder usarlo en CI.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import statistics
+
+# Configuración previa a importar el gateway: sin endpoint de métricas y logs mínimos
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('METRICS_PORT', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.log_config import configurar_logging
+configurar_logging()
+
+from quality.qc import SimpleQualityControl
+from services.lectura import Lectura, parsear_lectura
+
+# Tiempo mínimo por ronda; el número de llamadas por ronda se calibra para alcanzarlo
+TIEMPO_RONDA_S = 0.2
+RONDAS = 7
+SEMILLA = 42
+
+CASOS = []
+
+
+def caso(nombre, rondas=RONDAS):
+    """Registra una función preparadora: recibe nada y retorna el callable a medir"""
+    def decorador(preparar):
+        CASOS.append((nombre, preparar, rondas))
+        return preparar
+    return decorador
+
+
+def _lectura_dict(rng, temperatura=None):
+    return {
+        "device_id": f"ESP32-{rng.randint(0, 999):03d}",
+        "timestamp": int(time.time() * 1000),
+        "temperatura_celsius": round(temperatura if temperatura is not None else rng.gauss(24.0, 0.3), 2),
+        "humedad_porcentaje": round(rng.gauss(55.0, 0.5), 2),
+        "luz_adc": rng.randint(1500, 1600),
+        "distancia_cm": rng.randint(110, 130),
+        "vehiculo_en_entrada_detectado": False,
+        "barrera_abierta": False,
+        "luces_parking_encendidas": True,
+        "alarma_temperatura_activa": False
+    }
+
+
+# --- QC ---
+def _preparar_qc(ventana):
+    rng = random.Random(SEMILLA)
+    qc = SimpleQualityControl(window_size=ventana)
+    for sensor in qc.sensor_data:
+        qc.sensor_data[sensor] = [rng.gauss(50.0, 1.0) for _ in range(ventana)]
+    datos = [
+        {sensor: rng.gauss(50.0, 1.0) for sensor in qc.sensor_data}
+        for _ in range(256)
+    ]
+    estado = {'i': 0}
+
+    def medir():
+        estado['i'] = (estado['i'] + 1) & 255
+        qc.aplicar_qc(datos[estado['i']])
+    return medir
+
+
+for _ventana in (10, 100, 1000):
+    caso(f"qc.aplicar_qc[ventana={_ventana}]")(lambda v=_ventana: _preparar_qc(v))
+
+
+# --- Validación rápida ---
+@caso("data_collector.validacion_rapida")
+def _preparar_validacion():
+    import data_collector as dc
+    lectura = Lectura.desde_dict(_lectura_dict(random.Random(SEMILLA)))
+    return lambda: dc.validacion_rapida(lectura)
+
+
+# --- Alertas ---
+def _preparar_alertas(n_reglas, como_lectura):
+    from services.notification_engine import NotificationEngine
+    engine = NotificationEngine()
+    # Reglas extra con la misma forma que las de _cargar_reglas_alertas (umbrales que no disparan)
+    for i in range(max(0, n_reglas - len(engine.alert_rules))):
+        engine.alert_rules[f"regla_sintetica_{i}"] = {
+            "condition": lambda data, u=100.0 + i: data.get("temperatura_celsius", 0) > u,
+            "message": lambda data: f"Regla sintética: {data.get('temperatura_celsius')}°C",
+            "priority": "low",
+            "channels": ["database"]
+        }
+    datos = _lectura_dict(random.Random(SEMILLA), temperatura=36.0)  # dispara temperatura_alta
+    lectura = Lectura.desde_dict(datos)
+    if como_lectura:
+        return lambda: engine.evaluar_alertas(lectura)
+    return lambda: engine.evaluar_alertas(dict(datos))
+
+
+for _reglas in (4, 50, 200):
+    caso(f"alertas.evaluar_alertas[reglas={_reglas},dict]")(lambda n=_reglas: _preparar_alertas(n, False))
+    caso(f"alertas.evaluar_alertas[reglas={_reglas},lectura]")(lambda n=_reglas: _preparar_alertas(n, True))
+
+
+# --- Serialización de telemetría ---
+@caso("telemetria.json_dumps[dict]")
+def _preparar_dumps():
+    datos = _lectura_dict(random.Random(SEMILLA))
+    return lambda: json.dumps(datos)
+
+
+@caso("telemetria.lectura_a_json[payload]")
+def _preparar_a_json_payload():
+    lectura = parsear_lectura(json.dumps(_lectura_dict(random.Random(SEMILLA))).encode('utf-8'))
+    return lectura.a_json
+
+
+@caso("telemetria.lectura_a_json[sin_payload]")
+def _preparar_a_json():
+    return Lectura.desde_dict(_lectura_dict(random.Random(SEMILLA))).a_json
+
+
+@caso("telemetria.parsear_lectura")
+def _preparar_parseo():
+    payload = json.dumps(_lectura_dict(random.Random(SEMILLA))).encode('utf-8')
+    return lambda: parsear_lectura(payload)
+
+
+# --- Snapshot de arranque en caliente ---
+def _preparar_snapshot(n_dispositivos, operacion):
+    import tempfile
+    from services.snapshot import GestorSnapshots
+    rng = random.Random(SEMILLA)
+    engines = {}
+    for i in range(n_dispositivos):
+        qc = engines[f"ESP32-{i:04d}"] = SimpleQualityControl()
+        for sensor in qc.sensor_data:
+            qc.sensor_data[sensor] = [rng.gauss(50.0, 1.0) for _ in range(qc.window_size)]
+
+    def restaurar(estado):
+        for device_id, ventanas in estado.items():
+            engines.setdefault(device_id, SimpleQualityControl()).restaurar_ventanas(ventanas)
+
+    gestor = GestorSnapshots('microbench', directorio=tempfile.mkdtemp(), intervalo_s=1)
+    gestor.registrar('qc', lambda: {d: e.exportar_ventanas() for d, e in engines.items()}, restaurar)
+    gestor.guardar()
+    return gestor.guardar if operacion == 'guardar' else gestor.restaurar
+
+
+for _dispositivos in (100, 1000):
+    for _operacion in ('guardar', 'restaurar'):
+        caso(f"snapshot.{_operacion}[dispositivos={_dispositivos}]")(
+            lambda n=_dispositivos, o=_operacion: _preparar_snapshot(n, o)
+        )
+
+
+# --- Vivacidad de dispositivos ---
+@caso("vivacidad.vistos[dispositivos=10000,lote=50]")
+def _preparar_vivacidad():
+    from services.vivacidad import MonitorVivacidad
+    monitor = MonitorVivacidad(timeout_s=60)
+    dispositivos = [f"ESP32-{i:05d}" for i in range(10000)]
+    estado = {'i': 0, 't': time.time()}
+    monitor.vistos([(d, estado['t']) for d in dispositivos])
+
+    def medir():
+        i = estado['i']
+        estado['i'] = (i + 50) % len(dispositivos)
+        estado['t'] += 0.01
+        monitor.vistos([(d, estado['t']) for d in dispositivos[i:i + 50]])
+    return medir
+
+
+# --- ML ---
+def _preparar_ml(filas):
+    from services.ml_engine import MachineLearningEngine
+    rng = random.Random(SEMILLA)
+    # Misma forma que consultar_rango_fechas: time, temp_celsius, humedad_porcentaje
+    inicio = int(time.time()) - filas
+    historico = [
+        {"time": inicio + i, "temp_celsius": rng.gauss(24.0, 3.0), "humedad_porcentaje": rng.gauss(55.0, 8.0)}
+        for i in range(filas)
+    ]
+    engine = MachineLearningEngine()
+    return lambda: engine.procesar_datos(historico)
+
+
+def registrar_casos_ml(tamanos):
+    for filas in tamanos:
+        # Las corridas grandes tardan segundos: menos rondas
+        caso(f"ml.procesar_datos[filas={filas}]", rondas=3 if filas >= 100000 else RONDAS)(
+            lambda f=filas: _preparar_ml(f)
+        )
+
+
+# --- Ejecución ---
+def _calibrar(funcion):
+    """Número de llamadas por ronda para que una ronda dure al menos TIEMPO_RONDA_S"""
+    n = 1
+    while True:
+        inicio = time.perf_counter()
+        for _ in range(n):
+            funcion()
+        transcurrido = time.perf_counter() - inicio
+        if transcurrido >= TIEMPO_RONDA_S:
+            return n
+        n *= 10 if transcurrido < TIEMPO_RONDA_S / 10 else 2
+
+
+def medir_caso(nombre, preparar, rondas):
+    funcion = preparar()
+    funcion()  # calentamiento (imports perezosos, cachés)
+    n = _calibrar(funcion)
+    tiempos = []
+    for _ in range(rondas):
+        inicio = time.perf_counter()
+        for _ in range(n):
+            funcion()
+        tiempos.append((time.perf_counter() - inicio) / n)
+    mediana = statistics.median(tiempos)
+    return {
+        "llamadas_por_ronda": n,
+        "rondas": rondas,
+        "min_s": min(tiempos),
+        "mediana_s": mediana,
+        "media_s": statistics.fmean(tiempos),
+        "desviacion_s": statistics.pstdev(tiempos),
+        "ops_por_s": 1.0 / mediana if mediana else None
+    }
+
+
+def _formatear_tiempo(segundos):
+    if segundos >= 1:
+        return f"{segundos:8.3f} s "
+    if segundos >= 1e-3:
+        return f"{segundos * 1e3:8.3f} ms"
+    if segundos >= 1e-6:
+        return f"{segundos * 1e6:8.3f} µs"
+    return f"{segundos * 1e9:8.1f} ns"
+
+
+def ejecutar(args):
+    registrar_casos_ml(args.tamanos_ml)
+    seleccion = [c for c in CASOS if not args.filtro or any(f in c[0] for f in args.filtro)]
+    if not seleccion:
+        print("Ningún caso coincide con el filtro")
+        return 1
+
+    resultados = {}
+    print(f"{'Caso':<48} {'mediana':>11} {'min':>11} {'ops/s':>12}")
+    for nombre, preparar, rondas in seleccion:
+        try:
+            r = medir_caso(nombre, preparar, rondas)
+        except ImportError as e:
+            print(f"{nombre:<48} omitido ({e})")
+            continue
+        resultados[nombre] = r
+        print(f"{nombre:<48} {_formatear_tiempo(r['mediana_s']):>11} {_formatear_tiempo(r['min_s']):>11} "
+              f"{r['ops_por_s']:>12,.0f}")
+
+    if args.guardar:
+        baseline = {
+            "generado": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "python": platform.python_version(),
+            "plataforma": platform.platform(),
+            "procesador": platform.processor() or platform.machine(),
+            "casos": resultados
+        }
+        with open(args.guardar, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados guardados en {args.guardar}")
+    return 0
+
+
+def comparar(args):
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)["casos"]
+    with open(args.nuevo, encoding='utf-8') as f:
+        nuevo = json.load(f)["casos"]
+
+    regresiones = []
+    print(f"{'Caso':<48} {'base':>11} {'nuevo':>11} {'cambio':>9}")
+    for nombre in sorted(set(base) | set(nuevo)):
+        if nombre not in base or nombre not in nuevo:
+            estado = "solo en base" if nombre in base else "nuevo"
+            print(f"{nombre:<48} {'':>11} {'':>11} {estado:>9}")
+            continue
+        antes, despues = base[nombre][args.metrica], nuevo[nombre][args.metrica]
+        cambio = (despues - antes) / antes * 100.0 if antes else 0.0
+        marca = ''
+        if cambio > args.umbral:
+            marca = '  << REGRESIÓN'
+            regresiones.append(nombre)
+        elif cambio < -args.umbral:
+            marca = '  mejora'
+        print(f"{nombre:<48} {_formatear_tiempo(antes):>11} {_formatear_tiempo(despues):>11} "
+              f"{cambio:>+8.1f}%{marca}")
+
+    if regresiones:
+        print(f"\n{len(regresiones)} regresión(es) por encima del {args.umbral:.0f}%")
+        return 1
+    print(f"\nSin regresiones por encima del {args.umbral:.0f}%")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de TRANSWATCH fog layer")
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    p_ejecutar = sub.add_parser('ejecutar', help="Ejecuta los casos y opcionalmente guarda un baseline JSON")
+    p_ejecutar.add_argument('--filtro', nargs='*', help="Solo casos cuyo nombre contenga alguno de estos textos")
+    p_ejecutar.add_argument('--guardar', help="Archivo JSON donde guardar los resultados")
+    p_ejecutar.add_argument('--tamanos-ml', type=int, nargs='*', default=[1000, 100000, 1000000],
+                            help="Filas para ml.procesar_datos (default: 1k, 100k, 1M)")
+    p_ejecutar.set_defaults(funcion=ejecutar)
+
+    p_comparar = sub.add_parser('comparar', help="Compara dos baselines y marca regresiones")
+    p_comparar.add_argument('base')
+    p_comparar.add_argument('nuevo')
+    p_comparar.add_argument('--umbral', type=float, default=10.0, help="Regresión tolerada en %% (default 10)")
+    p_comparar.add_argument('--metrica', choices=['mediana_s', 'min_s', 'media_s'], default='mediana_s')
+    p_comparar.set_defaults(funcion=comparar)
+
+    args = parser.parse_args()
+    sys.exit(args.funcion(args))
+
+
+if __name__ == "__main__":
+    main()
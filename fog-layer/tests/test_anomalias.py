@@ -0,0 +1,69 @@
+"""
+Pruebas del puntaje de anomalías multivariado (MachineLearningEngine.puntuar_anomalias).
+
+  python -m pytest tests/test_anomalias.py -q
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.ml_engine import MachineLearningEngine
+
+# Paso del DHT11 (°C, %), del ADC de luz y del ultrasónico
+RESOLUCION = [1, 1, 1, 1]
+
+
+def _enteros(semilla, n=600, prob_humedad=0.05):
+    """Lecturas como las del firmware: temperatura y humedad enteras, humedad casi siempre 55"""
+    rng = np.random.default_rng(semilla)
+    return np.column_stack([
+        np.round(24 + rng.normal(0, 0.4, n)),
+        55 + (rng.random(n) < prob_humedad),
+        1500 + rng.integers(-20, 21, n),
+        100 + rng.integers(-2, 3, n),
+    ]).astype(float)
+
+
+def test_datos_enteros_sin_falsos_positivos():
+    motor = MachineLearningEngine()
+    for semilla in range(5):
+        for prob in (0.02, 0.05, 0.1):
+            puntaje, _ = motor.puntuar_anomalias(_enteros(semilla, prob_humedad=prob), resolucion=RESOLUCION)
+            assert (puntaje >= 1).sum() <= 1, (semilla, prob, puntaje.max())
+
+
+def test_datos_enteros_sin_resolucion_no_explotan():
+    # MAD = 0 en la humedad: la variable se omite en lugar de usar una escala diminuta
+    puntaje, _ = MachineLearningEngine().puntuar_anomalias(_enteros(0, prob_humedad=0.05))
+    assert (puntaje >= 1).sum() <= 1
+    assert puntaje.max() < 10
+
+
+def test_datos_enteros_detecta_saltos():
+    X = _enteros(1)
+    X[100, 0] = 31      # +7 °C
+    X[200, 1] = 63      # +8 % de humedad
+    puntaje, variable = MachineLearningEngine().puntuar_anomalias(X, resolucion=RESOLUCION)
+    assert set(np.flatnonzero(puntaje >= 1)) == {100, 200}
+    assert variable[100] == 0 and variable[200] == 1
+
+
+def test_datos_continuos_cuantil():
+    X = np.random.default_rng(0).normal(size=(20000, 4))
+    puntaje, _ = MachineLearningEngine().puntuar_anomalias(X, cuantil=0.999)
+    assert 0.0003 <= (puntaje >= 1).mean() <= 0.003
+
+
+def test_banderas_condicionan_el_centro():
+    # Un vehículo en la entrada (bandera 1, distancia 8 cm) no es anómalo por sí solo
+    rng = np.random.default_rng(2)
+    n = 720
+    vehiculo = rng.random(n) < 0.02
+    distancia = np.where(vehiculo, 8.0, 100 + rng.normal(0, 2, n))
+    X = np.column_stack([24 + rng.normal(0, 0.3, n), distancia, vehiculo])
+    puntaje, _ = MachineLearningEngine().puntuar_anomalias(X, binarias=[False, False, True])
+    assert not (puntaje[vehiculo] >= 1).any()
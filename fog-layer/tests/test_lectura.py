@@ -0,0 +1,27 @@
+"""
+Pruebas del esquema de lectura (services/lectura.py).
+
+  python -m pytest tests/test_lectura.py -q
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.lectura import ErrorEsquema, parsear_lectura
+
+
+def test_banderas_booleanas_y_enteras():
+    lectura = parsear_lectura(b'{"temperatura_celsius": 25, "barrera_abierta": true, "vehiculo_detectado_entrada": 1}')
+    assert lectura.barrera_abierta is True
+    assert lectura.vehiculo_en_entrada_detectado is True
+    assert lectura.alarma_temperatura_activa is False
+
+
+@pytest.mark.parametrize('valor', ['"false"', '"0"', '2', '0.0', '[]'])
+def test_banderas_invalidas_se_rechazan(valor):
+    with pytest.raises(ErrorEsquema):
+        parsear_lectura(f'{{"temperatura_celsius": 25, "barrera_abierta": {valor}}}'.encode())
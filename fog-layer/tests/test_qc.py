@@ -0,0 +1,44 @@
+"""
+Pruebas del control de calidad por sensor (quality/qc.py).
+
+  python -m pytest tests/test_qc.py -q
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quality.qc import SimpleQualityControl
+
+
+def _lectura(temperatura, humedad=55):
+    return {'temperatura_celsius': temperatura, 'humedad_porcentaje': humedad, 'luz_adc': 1500, 'distancia_cm': 100}
+
+
+def test_zscore_acepta_escalon_de_un_paso():
+    # DHT11 en grados enteros: tras una ventana estable, un cambio real de 1 °C se mantiene
+    qc = SimpleQualityControl(detectores=['zscore'])
+    for i in range(20):
+        assert qc.aplicar_qc(_lectura(25), ts=i * 6)['todos_aprobados']
+    for i in range(20, 60):
+        resultado = qc.aplicar_qc(_lectura(26), ts=i * 6)
+        assert resultado['todos_aprobados'], (i, resultado['resultados']['temperatura_celsius'])
+
+
+def test_zscore_acepta_escalon_en_humedad():
+    qc = SimpleQualityControl(detectores=['zscore'])
+    for i in range(20):
+        qc.aplicar_qc(_lectura(25, 55), ts=i * 6)
+    assert all(qc.aplicar_qc(_lectura(25, 57), ts=i * 6)['todos_aprobados'] for i in range(20, 40))
+
+
+def test_zscore_rechaza_atipico():
+    qc = SimpleQualityControl(detectores=['zscore'])
+    for i in range(20):
+        qc.aplicar_qc(_lectura(25), ts=i * 6)
+    resultado = qc.aplicar_qc(_lectura(40), ts=120)
+    assert not resultado['todos_aprobados']
+    assert resultado['resultados']['temperatura_celsius']['razon'].startswith('Valor atípico')
+    # El atípico no entra a la ventana: la siguiente lectura normal pasa
+    assert qc.aplicar_qc(_lectura(25), ts=126)['todos_aprobados']